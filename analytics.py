@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""
+Category analytics over all stored analyses.
+
+The summary tables (see CategoryStat, ConfidenceBucket and CategoryPair in
+db_setup.py) are updated in the same transaction as each analysis' result
+rows, so reading the aggregates costs O(categories) however many results
+are stored. If the tables ever drift from analysis_results (e.g. after rows
+were edited by hand) they can be recomputed:
+
+    python analytics.py rebuild [path/to/comb_analyzer.db]
+"""
+import os
+import sys
+from sqlalchemy import text
+from sqlalchemy.dialects.sqlite import insert
+from db_setup import CategoryStat, ConfidenceBucket, CategoryPair, COMBCategory
+
+# Width of the confidence histogram buckets
+BUCKET_WIDTH = 10
+
+def confidence_bucket(confidence):
+    """Lower bound of the histogram bucket of a confidence (0 to 100)."""
+    return min(100 - BUCKET_WIDTH, max(0, int(confidence // BUCKET_WIDTH) * BUCKET_WIDTH))
+
+def _increment(session, model, key, values):
+    """Add values to the counters of a summary row, creating it if needed."""
+    statement = insert(model.__table__).values(**key, **values)
+    statement = statement.on_conflict_do_update(
+        index_elements=list(key),
+        set_={name: model.__table__.c[name] + statement.excluded[name] for name in values}
+    )
+    session.execute(statement)
+
+def record_analysis(session, category_confidences):
+    """
+    Add one analysis to the summary tables.
+
+    Called by the database writer with the analysis' result rows, so the
+    summaries are committed atomically with them.
+
+    Args:
+        session: The writer's Session
+        category_confidences: (category_id, confidence) of each result row,
+            in the order the rows are inserted
+    """
+    if not category_confidences:
+        return
+    # Stable sort: ties keep insertion order, as rebuild() does with the row ids
+    ranked = sorted(category_confidences, key=lambda item: -item[1])
+    for rank, (category_id, confidence) in enumerate(ranked):
+        _increment(session, CategoryStat, {'category_id': category_id},
+                   {'result_count': 1, 'top_count': 1 if rank == 0 else 0, 'confidence_sum': confidence})
+        _increment(session, ConfidenceBucket,
+                   {'category_id': category_id, 'bucket': confidence_bucket(confidence)},
+                   {'result_count': 1})
+    if len(ranked) > 1:
+        _increment(session, CategoryPair,
+                   {'first_category_id': ranked[0][0], 'second_category_id': ranked[1][0]},
+                   {'analysis_count': 1})
+
+def rebuild(connection):
+    """
+    Recompute the summary tables from analysis_results.
+
+    Args:
+        connection: A Connection or Session inside a transaction
+    """
+    statements = [
+        "DELETE FROM analytics_category_stats",
+        "DELETE FROM analytics_confidence_buckets",
+        "DELETE FROM analytics_category_pairs",
+        # Rank the results of each analysis the way record_analysis() does
+        """CREATE TEMP TABLE ranked_results AS
+            SELECT session_id, category_id, confidence,
+                   ROW_NUMBER() OVER (PARTITION BY session_id ORDER BY confidence DESC, id) AS rank
+            FROM analysis_results""",
+        """INSERT INTO analytics_category_stats (category_id, result_count, top_count, confidence_sum)
+            SELECT category_id, count(*), sum(rank = 1), sum(confidence)
+            FROM ranked_results GROUP BY category_id""",
+        f"""INSERT INTO analytics_confidence_buckets (category_id, bucket, result_count)
+            SELECT category_id,
+                   min({100 - BUCKET_WIDTH}, max(0, CAST(confidence / {BUCKET_WIDTH} AS INTEGER) * {BUCKET_WIDTH})) AS bucket,
+                   count(*)
+            FROM ranked_results GROUP BY category_id, bucket""",
+        """INSERT INTO analytics_category_pairs (first_category_id, second_category_id, analysis_count)
+            SELECT first.category_id, second.category_id, count(*)
+            FROM ranked_results first
+            JOIN ranked_results second ON second.session_id = first.session_id AND second.rank = 2
+            WHERE first.rank = 1
+            GROUP BY first.category_id, second.category_id""",
+        "DROP TABLE ranked_results",
+    ]
+    for statement in statements:
+        connection.execute(text(statement))
+
+def summarize(session):
+    """
+    Read the aggregates from the summary tables.
+
+    Returns:
+        A JSON-serializable dictionary with the number of analyses and
+        results, each category's counts, mean confidence and confidence
+        histogram, and the co-occurrence counts of the top two categories
+    """
+    names = dict(session.query(COMBCategory.id, COMBCategory.name).all())
+    stats = {row.category_id: row for row in session.query(CategoryStat).all()}
+
+    histograms = {}
+    for row in session.query(ConfidenceBucket).all():
+        histograms.setdefault(row.category_id, {})[row.bucket] = row.result_count
+
+    categories = []
+    for category_id, name in sorted(names.items()):
+        stat = stats.get(category_id)
+        result_count = stat.result_count if stat else 0
+        buckets = histograms.get(category_id, {})
+        categories.append({
+            'id': category_id,
+            'category': name,
+            'results': result_count,
+            'top': stat.top_count if stat else 0,
+            'mean_confidence': round(stat.confidence_sum / result_count, 2) if result_count else None,
+            'confidence_histogram': {
+                f"{bucket}-{bucket + BUCKET_WIDTH}": buckets.get(bucket, 0)
+                for bucket in range(0, 100, BUCKET_WIDTH)
+            }
+        })
+
+    pairs = session.query(CategoryPair).order_by(
+        CategoryPair.analysis_count.desc(), CategoryPair.first_category_id, CategoryPair.second_category_id
+    ).all()
+    return {
+        # Every analysis with results has exactly one top category
+        'analyses': sum(category['top'] for category in categories),
+        'results': sum(category['results'] for category in categories),
+        'categories': categories,
+        'top_two': [
+            {
+                'first': names.get(pair.first_category_id, pair.first_category_id),
+                'second': names.get(pair.second_category_id, pair.second_category_id),
+                'analyses': pair.analysis_count
+            }
+            for pair in pairs
+        ]
+    }
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != 'rebuild':
+        sys.exit("Usage: python analytics.py rebuild [path/to/comb_analyzer.db]")
+    path = sys.argv[2] if len(sys.argv) > 2 else 'comb_analyzer.db'
+    if not os.path.exists(path):
+        sys.exit(f"{path} does not exist")
+    # Through get_engine so the database is migrated and the tables exist
+    from db_setup import get_engine
+    with get_engine(f'sqlite:///{path}').begin() as connection:
+        rebuild(connection)
+    print(f"Rebuilt the analytics summary tables of {path}")
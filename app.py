@@ -1,13 +1,64 @@
 import os
 import json
+import hmac
+import itertools
+import threading
 import time
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context
 from model_handler import LlamaModelHandler
+from worker_pool import ModelWorkerPool, PoolFullError
+from jobs import JobManager
+from history import AnalysisHistory
+from db_setup import create_session_factory, reset_engines_after_fork
+import analytics
+from config import load_inference_config
+import metrics
+from profiling import RequestProfiler, summarize_trace
 
 app = Flask(__name__)
 
+# Number of model worker processes; 0 runs the model inside the web process
+NUM_WORKERS = int(os.environ.get('COMB_WORKERS', '0'))
+# Requests allowed to wait for a free worker before new ones get a 503
+QUEUE_SIZE = int(os.environ.get('COMB_QUEUE_SIZE', '16'))
+# Seconds a request may wait for a worker's result, queueing included
+REQUEST_TIMEOUT = float(os.environ.get('COMB_REQUEST_TIMEOUT', '600'))
+# CPU threads per worker (defaults to an even share of the cores)
+THREADS_PER_WORKER = int(os.environ['COMB_THREADS_PER_WORKER']) if 'COMB_THREADS_PER_WORKER' in os.environ else None
+# Concurrent requests decoded together in one model context (0 disables batching)
+BATCH_SEQUENCES = int(os.environ.get('COMB_BATCH_SEQUENCES', '0'))
+# Background threads processing bulk analysis jobs
+JOB_WORKERS = int(os.environ.get('COMB_JOB_WORKERS', '1'))
+# Load and warm up the model at startup instead of on the first request
+EAGER_LOAD = os.environ.get('COMB_EAGER_LOAD', '0').lower() in ('1', 'true', 'yes')
+# Token required by the /admin endpoints; without one they are closed
+ADMIN_TOKEN = os.environ.get('COMB_ADMIN_TOKEN')
+# Open the /admin endpoints to anyone when no token is set, for local development only
+ADMIN_OPEN = os.environ.get('COMB_ADMIN_OPEN', '0').lower() in ('1', 'true', 'yes')
+
+# Request profiling; the settings can be changed at runtime through /admin/profiling
+profiler = RequestProfiler(
+    # Add the phase breakdown to every response, not only those asking for it with profile=1
+    include_in_response=os.environ.get('COMB_PROFILE', '0').lower() in ('1', 'true', 'yes'),
+    # Requests slower than this many seconds go to the slow-request log (0 disables it)
+    slow_threshold=float(os.environ.get('COMB_SLOW_REQUEST_SECONDS', '30')),
+    slow_log_path=os.environ.get('COMB_SLOW_LOG', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                'slow_requests.log')),
+    # Fraction of /analyze requests run under cProfile
+    sample_rate=float(os.environ.get('COMB_PROFILE_SAMPLE_RATE', '0')),
+    profile_dir=os.environ.get('COMB_PROFILE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                 'profiles'))
+)
+
 # Initialize the model handler (lazy loading - will only load when needed)
 model_handler = None
+model_handler_lock = threading.Lock()
+
+# Set once the model is loaded and warmed up
+model_ready = threading.Event()
+
+# Requests waiting for the model (or a free worker), computed when /metrics is scraped
+metrics.QUEUE_DEPTH.set_function(lambda: model_handler.queue_depth() if model_handler is not None else 0)
 
 def get_model_handler():
     """
@@ -15,16 +66,106 @@ def get_model_handler():
     until it's actually needed.
     """
     global model_handler
-    if model_handler is None:
-        print("Initializing model handler...")
-        start_time = time.time()
-        model_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 
-                                "Llama-3.2-3B-Instruct-Q8_0.gguf")
-        model_handler = LlamaModelHandler(model_path)
-        load_time = time.time() - start_time
-        print(f"Model loaded in {load_time:.2f} seconds")
+    with model_handler_lock:
+        if model_handler is None:
+            load_model_handler()
     return model_handler
 
+def load_model_handler():
+    """Load the model handler (or start the worker pool). Called with the lock held."""
+    global model_handler
+    print("Initializing model handler...")
+    start_time = time.time()
+    model_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                            "Llama-3.2-3B-Instruct-Q8_0.gguf")
+    # Thread counts, batch and context sizes etc. from comb_config.json / COMB_* variables
+    inference_config = load_inference_config()
+    if NUM_WORKERS > 0:
+        # The pool offers the same code_text/stream_code_text interface
+        model_handler = ModelWorkerPool(model_path, NUM_WORKERS, queue_size=QUEUE_SIZE,
+                                        threads_per_worker=THREADS_PER_WORKER,
+                                        inference_config=inference_config,
+                                        request_timeout=REQUEST_TIMEOUT)
+    elif BATCH_SEQUENCES > 0:
+        # Each batched sequence needs room for its text and generated tokens
+        inference_config['n_ctx'] = max(inference_config['n_ctx'],
+                                        2048 + inference_config['max_tokens'] * BATCH_SEQUENCES)
+        model_handler = LlamaModelHandler(model_path, batch_sequences=BATCH_SEQUENCES,
+                                          **inference_config)
+    else:
+        model_handler = LlamaModelHandler(model_path, **inference_config)
+    load_time = time.time() - start_time
+    metrics.MODEL_LOAD_TIME.set(load_time)
+    print(f"Model loaded in {load_time:.2f} seconds")
+
+def warm_up_model():
+    """
+    Load the model and run a dummy completion so the first request doesn't
+    pay for loading or one-off start-up costs, then mark the app ready.
+    """
+    handler = get_model_handler()
+    if isinstance(handler, ModelWorkerPool):
+        # Each worker warms itself up before reporting ready
+        if not handler.wait_until_ready():
+            print("No model worker could load the model, see /readyz")
+            return
+    else:
+        handler.warm_up()
+    model_ready.set()
+    metrics.MODEL_READY.set(1)
+
+def start_background_services(requeue_jobs=True):
+    """
+    Start the background work of a serving process: the eager model
+    warm-up (when enabled) and the job workers.
+    
+    Args:
+        requeue_jobs: Requeue job items interrupted by a previous run; turn
+            this off when several serving processes share the database
+    """
+    if EAGER_LOAD and not model_ready.is_set():
+        threading.Thread(target=warm_up_model, daemon=True).start()
+    get_job_manager(requeue=requeue_jobs)
+
+def reset_after_fork():
+    """
+    Prepare a process forked from the master.
+    
+    Database connections must not be shared across processes, so the ones
+    inherited from the master (e.g. from requeueing interrupted jobs, or
+    from preloading the model) are discarded without being closed. With a
+    preloaded model, the background database writer and taxonomy polling,
+    whose threads didn't survive the fork, are restarted.
+    """
+    reset_engines_after_fork()
+    if isinstance(model_handler, LlamaModelHandler):
+        model_handler.db_session.get_bind().dispose(close=False)
+        model_handler.result_writer.reset_after_fork()
+        if model_handler.taxonomy_watcher is not None:
+            model_handler.taxonomy_watcher.reset_after_fork()
+
+def shutdown_services():
+    """Write out pending results before the serving process exits."""
+    if isinstance(model_handler, LlamaModelHandler):
+        model_handler.close()
+    elif isinstance(model_handler, ModelWorkerPool):
+        model_handler.shutdown()
+
+job_manager = None
+job_manager_lock = threading.Lock()
+
+def get_job_manager(requeue=True):
+    """
+    Start the job manager on first use. Interrupted jobs resume as soon as
+    it starts; the model itself is only loaded once there is an item to process.
+    """
+    global job_manager
+    with job_manager_lock:
+        if job_manager is None:
+            job_manager = JobManager(get_model_handler, num_workers=JOB_WORKERS)
+            job_manager.start(requeue=requeue)
+    return job_manager
+
 @app.route('/')
 def index():
     """Render the main page with the text input form."""
@@ -40,6 +181,11 @@ def analyze():
     # Get the text from the form
     text = request.form.get('text', '')
     
+    # Allow callers to skip the result cache and force a fresh model run
+    use_cache = request.form.get('no_cache', '').lower() not in ('1', 'true', 'yes')
+    # Ask for the per-phase timing breakdown
+    want_profile = profiler.wants_profile(request.form.get('profile', '').lower() in ('1', 'true', 'yes'))
+    
     if not text:
         return jsonify({'error': 'No text provided'})
     
@@ -48,18 +194,304 @@ def analyze():
         handler = get_model_handler()
         
         # Time the analysis
+        trace = {}
         start_time = time.time()
-        results = handler.code_text(text)
+        with profiler.sample('analyze') as profile_path:
+            results = handler.code_text(text, use_cache=use_cache, trace=trace)
         analysis_time = time.time() - start_time
+        metrics.REQUEST_LATENCY.labels(endpoint='analyze').observe(analysis_time)
+        profiler.record('analyze', analysis_time, text, trace, results, profile_path)
         
         # Add timing information to the results
         results['analysis_time'] = f"{analysis_time:.2f} seconds"
+        if want_profile:
+            results['profile'] = summarize_trace(trace)
         print(f"Analysis completed in {analysis_time:.2f} seconds")
         
         return jsonify(results)
+    except PoolFullError as e:
+        return busy_response(e)
+    except Exception as e:
+        return jsonify({'error': f'Error analyzing text: {str(e)}'})
+
+def busy_response(error):
+    """Build the 503 response returned when the request queue is full."""
+    response = jsonify({'error': 'The server is busy, please try again shortly.'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+@app.route('/analyze/stream', methods=['POST'])
+def analyze_stream():
+    """
+    Analyze the submitted text and stream the generation as Server-Sent Events.
+    
+    Emits a `token` event for each chunk of generated text and a final
+    `result` event with the same payload as /analyze. Generation stops as
+    soon as the model closes the JSON object.
+    """
+    text = request.form.get('text', '')
+    use_cache = request.form.get('no_cache', '').lower() not in ('1', 'true', 'yes')
+    want_profile = profiler.wants_profile(request.form.get('profile', '').lower() in ('1', 'true', 'yes'))
+    
+    if not text:
+        return jsonify({'error': 'No text provided'})
+    
+    def sse(event, data):
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    
+    trace = {}
+    start_time = time.time()
+    try:
+        handler = get_model_handler()
+        events = handler.stream_code_text(text, use_cache=use_cache, trace=trace)
+        # Start the stream here so a full queue is reported as a 503
+        first_event = next(events)
+    except PoolFullError as e:
+        return busy_response(e)
+    except Exception as e:
+        return jsonify({'error': f'Error analyzing text: {str(e)}'})
+    
+    def generate():
+        try:
+            for event, payload in itertools.chain([first_event], events):
+                if event == 'token':
+                    yield sse('token', {'text': payload})
+                else:
+                    analysis_time = time.time() - start_time
+                    metrics.REQUEST_LATENCY.labels(endpoint='analyze_stream').observe(analysis_time)
+                    profiler.record('analyze_stream', analysis_time, text, trace, payload)
+                    payload['analysis_time'] = f"{analysis_time:.2f} seconds"
+                    if want_profile:
+                        payload['profile'] = summarize_trace(trace)
+                    print(f"Analysis completed in {analysis_time:.2f} seconds")
+                    yield sse('result', payload)
+        except Exception as e:
+            yield sse('result', {'error': f'Error analyzing text: {str(e)}'})
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/analyze/document', methods=['POST'])
+def analyze_document():
+    """
+    Analyze a long transcript in overlapping windows of speaker turns.
+
+    Returns the document-level categories, each with the number of windows
+    that found it, and the per-window `spans` with their character offsets,
+    speakers and categories. /analyze switches to this mode by itself for
+    texts that don't fit in the context; this endpoint uses it for any text.
+    """
+    text = request.form.get('text', '')
+    use_cache = request.form.get('no_cache', '').lower() not in ('1', 'true', 'yes')
+
+    if not text:
+        return jsonify({'error': 'No text provided'})
+
+    try:
+        handler = get_model_handler()
+        trace = {}
+        start_time = time.time()
+        results = handler.code_document(text, use_cache=use_cache, trace=trace)
+        analysis_time = time.time() - start_time
+        metrics.REQUEST_LATENCY.labels(endpoint='analyze_document').observe(analysis_time)
+        profiler.record('analyze_document', analysis_time, text, trace, results)
+
+        results['analysis_time'] = f"{analysis_time:.2f} seconds"
+        print(f"Document analysis of {trace.get('windows', 0)} windows completed in {analysis_time:.2f} seconds")
+        return jsonify(results)
+    except PoolFullError as e:
+        return busy_response(e)
     except Exception as e:
         return jsonify({'error': f'Error analyzing text: {str(e)}'})
 
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    """
+    Accept a whole transcript for background analysis and return its job ID.
+    
+    The transcript is sent either as an uploaded `file` or as a `transcript`
+    form field. The `format` field ('text', 'csv' or 'jsonl') defaults to the
+    file extension, or plain text.
+    """
+    upload = request.files.get('file')
+    if upload is not None:
+        content = upload.read().decode('utf-8')
+        extension = os.path.splitext(upload.filename or '')[1].lower()
+        default_format = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}.get(extension, 'text')
+    else:
+        content = request.form.get('transcript', '')
+        default_format = 'text'
+    source_format = request.form.get('format', default_format)
+    
+    try:
+        job_id, total_items = get_job_manager().create_job(content, source_format)
+    except (ValueError, UnicodeDecodeError) as e:
+        return jsonify({'error': f'Invalid transcript: {str(e)}'}), 400
+    
+    return jsonify({'job_id': job_id, 'total_items': total_items, 'status': 'queued'}), 202
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    """Report a job's progress and a page of its results (`page`, `per_page`)."""
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = min(500, max(1, request.args.get('per_page', 50, type=int)))
+    
+    job = get_job_manager().get_job(job_id, page=page, per_page=per_page)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+analysis_history = None
+analysis_history_lock = threading.Lock()
+
+def get_analysis_history():
+    """Create the history reader on first use."""
+    global analysis_history
+    with analysis_history_lock:
+        if analysis_history is None:
+            analysis_history = AnalysisHistory()
+    return analysis_history
+
+@app.route('/history')
+def list_history():
+    """
+    List past analyses, newest first, one page at a time.
+    
+    Query parameters: `limit` (default 20, at most 100), `cursor` (the
+    `next_cursor` of the previous page), `category` (name or id) and
+    `min_confidence`. Items carry a short preview of the text; fetch
+    /history/<session_id> for the full text.
+    """
+    history = get_analysis_history()
+    limit = request.args.get('limit', 20, type=int)
+    min_confidence = request.args.get('min_confidence', type=float)
+    try:
+        category = request.args.get('category')
+        category_id = history.resolve_category(category) if category else None
+        page = history.list_page(limit=limit, cursor=request.args.get('cursor'),
+                                 category_id=category_id, min_confidence=min_confidence)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(page)
+
+@app.route('/categories')
+def list_categories():
+    """List the categories of the taxonomy (id and name), e.g. for the history filter."""
+    return jsonify({'categories': get_analysis_history().categories()})
+
+@app.route('/history/<session_id>')
+def get_history_item(session_id):
+    """Return one past analysis with its full text."""
+    item = get_analysis_history().get(session_id)
+    if item is None:
+        return jsonify({'error': 'Analysis not found'}), 404
+    return jsonify(item)
+
+@app.route('/analytics')
+def analytics_summary():
+    """
+    Category distribution, confidence histograms and top-two co-occurrence
+    counts over all stored analyses, read from the summary tables.
+    """
+    session = create_session_factory()()
+    try:
+        return jsonify(analytics.summarize(session))
+    finally:
+        session.close()
+
+@app.route('/healthz')
+def healthz():
+    """Liveness probe: the process is up and serving requests."""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+def readyz():
+    """
+    Readiness probe. With eager loading it only succeeds once the model is
+    loaded and warmed up; otherwise the model loads on the first request.
+    With model workers, it fails once no worker could load the model and
+    lists the workers that were given up on.
+    """
+    ready = model_ready.is_set() or not EAGER_LOAD
+    body = {'model_loaded': model_ready.is_set()}
+    if isinstance(model_handler, ModelWorkerPool):
+        failed_workers = model_handler.failed_workers()
+        if failed_workers:
+            body['failed_workers'] = failed_workers
+        if model_handler.failed():
+            ready = False
+    body['ready'] = ready
+    response = jsonify(body)
+    response.status_code = 200 if ready else 503
+    return response
+
+@app.route('/metrics')
+def metrics_page():
+    """Expose latency, token, cache and queue metrics in the Prometheus text format."""
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+def admin_allowed():
+    """
+    Check the X-Admin-Token header against COMB_ADMIN_TOKEN. Without a
+    token, the /admin endpoints are denied unless COMB_ADMIN_OPEN is set.
+    """
+    if ADMIN_TOKEN is None:
+        return ADMIN_OPEN
+    return hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN)
+
+@app.route('/admin/profiling', methods=['GET', 'POST'])
+def admin_profiling():
+    """
+    Show or change the profiling settings without a restart.
+    
+    POST accepts `include_in_response` (0/1), `slow_threshold` (seconds)
+    and `sample_rate` (0 to 1) as form fields or JSON.
+    """
+    if not admin_allowed():
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    if request.method == 'POST':
+        values = request.get_json(silent=True) or request.form
+        try:
+            include = values.get('include_in_response')
+            profiler.update(
+                include_in_response=None if include is None else str(include).lower() in ('1', 'true', 'yes'),
+                slow_threshold=float(values['slow_threshold']) if 'slow_threshold' in values else None,
+                sample_rate=float(values['sample_rate']) if 'sample_rate' in values else None
+            )
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    
+    return jsonify(profiler.settings())
+
+@app.route('/admin/taxonomy/reload', methods=['POST'])
+def admin_reload_taxonomy():
+    """
+    Reload the taxonomy from the database without reloading the model.
+    
+    Model workers reload before their next analysis. Other serving
+    processes (e.g. gunicorn workers) pick the change up when they next
+    poll for taxonomy changes.
+    """
+    if not admin_allowed():
+        return jsonify({'error': 'Forbidden'}), 403
+    if model_handler is None:
+        # The taxonomy is read when the model is loaded
+        return jsonify({'loaded': False})
+    try:
+        return jsonify(model_handler.reload_taxonomy())
+    except ValueError as e:
+        # E.g. an import left no categories; the handler keeps the current taxonomy
+        return jsonify({'error': str(e)}), 409
+
+@app.route('/pool/stats')
+def pool_stats():
+    """Report queue depth and per-worker utilisation of the model worker pool."""
+    if not isinstance(model_handler, ModelWorkerPool):
+        return jsonify({'error': 'The model worker pool is not enabled'}), 404
+    return jsonify(model_handler.stats())
+
 if __name__ == '__main__':
     # Create templates directory if it doesn't exist
     os.makedirs('templates', exist_ok=True)
@@ -67,5 +499,9 @@ if __name__ == '__main__':
     # Set larger max content length for JSON responses (to handle history)
     app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 MB
     
+    # Warm up the model and resume unfinished jobs (only in the reloader's serving process)
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_services()
+    
     # Run the Flask app
     app.run(debug=True) 
\ No newline at end of file
@@ -0,0 +1,432 @@
+# batch_engine.py
+
+import codecs
+import ctypes
+import threading
+from collections import deque
+import numpy as np
+import llama_cpp
+
+# Sequence 0 holds the shared prompt prefix; requests use sequences 1..N
+PREFIX_SEQ_ID = 0
+
+class _Request:
+    """A generation request waiting for, or occupying, a sequence slot."""
+    def __init__(self, tokens, max_tokens, grammar, stop, prefix=None):
+        self.tokens = tokens
+        self.prefix = prefix
+        self.cells = 0  # KV cells reserved for the request once admitted
+        self.max_tokens = max_tokens
+        self.grammar = grammar
+        self.stop = stop
+        self.events = deque()
+        self.ready = threading.Event()
+        self.cancelled = False
+
+    def emit(self, event, payload=None):
+        self.events.append((event, payload))
+        self.ready.set()
+
+class _Sequence:
+    """Decoding state of a request while it occupies a sequence in the context."""
+    def __init__(self, seq_id, request, position, grammar, pending):
+        self.seq_id = seq_id
+        self.request = request
+        self.pending = list(pending)  # prompt tokens not yet evaluated
+        self.position = position
+        self.grammar = grammar
+        self.last_token = None
+        self.n_generated = 0
+        self.logits_index = None
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        self.text = ''
+        self.emitted = 0
+
+class BatchedInferenceEngine:
+    """
+    Continuous-batching inference over a single llama context.
+
+    Concurrent requests are decoded together as separate sequences of one
+    context, so a single copy of the weights serves all of them and each
+    decode step runs one batched forward pass. New requests are admitted and
+    finished ones retired between steps. The shared prompt prefix is
+    evaluated once into sequence 0 and its KV cells are shared with every
+    request sequence instead of being recomputed.
+
+    The engine takes exclusive ownership of the llama context; the high-level
+    Llama generation methods must not be used alongside it.
+    """
+    def __init__(self, llama, max_sequences=4, temperature=0.1, top_p=0.9, top_k=40):
+        """
+        Initialize the engine and start its decoding thread.
+
+        Args:
+            llama: A loaded llama_cpp.Llama instance
+            max_sequences: Maximum number of requests decoded together
+            temperature: Sampling temperature (0 for greedy decoding)
+            top_p: Nucleus sampling threshold
+            top_k: Number of top tokens to sample from
+        """
+        self.llama = llama
+        self.ctx = llama.ctx
+        self.n_ctx = llama.n_ctx()
+        self.n_batch = llama.n_batch
+        self.n_vocab = llama.n_vocab()
+        self.token_eos = llama.token_eos()
+        self.max_sequences = max_sequences
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+
+        self._batch = llama_cpp.llama_batch_init(self.n_batch, 0, max_sequences + 1)
+
+        # Candidate array reused for sampling every sequence
+        self._candidates_data = np.zeros(self.n_vocab, dtype=np.dtype(
+            [('id', np.intc), ('logit', np.single), ('p', np.single)], align=True
+        ))
+        self._token_ids = np.arange(self.n_vocab, dtype=np.intc)
+        self._candidates = llama_cpp.llama_token_data_array(
+            data=self._candidates_data.ctypes.data_as(llama_cpp.llama_token_data_p),
+            size=self.n_vocab,
+            sorted=False
+        )
+
+        self._commands = deque()
+        self._condition = threading.Condition()
+        self._active = {}  # seq_id -> _Sequence
+        self._free_seq_ids = list(range(1, max_sequences + 1))
+        self._prefix_tokens = []
+        self._prefix_length = 0
+        self._reserved = 0  # KV cells reserved by active sequences
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def set_prefix(self, tokens):
+        """
+        Evaluate a new shared prompt prefix.
+
+        Requests submitted earlier finish on the old prefix first. Blocks
+        until the new prefix is evaluated.
+
+        Args:
+            tokens: Prefix tokens, including the BOS token
+        """
+        done = {'event': threading.Event(), 'error': None}
+        with self._condition:
+            self._commands.append(('prefix', tokens, done))
+            self._condition.notify()
+        done['event'].wait()
+        if done['error'] is not None:
+            raise done['error']
+
+    def queue_depth(self):
+        """Number of requests waiting to be admitted."""
+        with self._condition:
+            return sum(1 for kind, payload, done in self._commands if kind == 'generate')
+
+    def generate(self, tokens, max_tokens, grammar=None, stop=(), prefix=None):
+        """
+        Generate a completion of the shared prefix followed by the given tokens.
+
+        Closing the returned generator cancels the request and frees its
+        sequence at the next step.
+
+        Args:
+            tokens: Prompt tokens following the prefix
+            max_tokens: Maximum number of tokens to generate
+            grammar: Optional LlamaGrammar constraining the output
+            stop: Strings that end the generation when produced
+            prefix: Prefix tokens the prompt was built for. If the shared
+                prefix is a different one when the request starts (it was
+                replaced meanwhile), the request evaluates this prefix in
+                its own sequence instead of sharing the cells. None always
+                shares the current prefix
+
+        Yields:
+            Chunks of generated text
+        """
+        request = _Request(tokens, max_tokens, grammar, list(stop), prefix)
+        with self._condition:
+            self._commands.append(('generate', request, None))
+            self._condition.notify()
+
+        try:
+            while True:
+                request.ready.wait()
+                request.ready.clear()
+                while request.events:
+                    event, payload = request.events.popleft()
+                    if event == 'text':
+                        yield payload
+                    elif event == 'error':
+                        raise RuntimeError(payload)
+                    else:
+                        return
+        finally:
+            request.cancelled = True
+
+    def _run(self):
+        """Decoding loop: admit requests, run one batched step, repeat."""
+        while True:
+            commands = deque()
+            try:
+                with self._condition:
+                    while not self._active and not self._commands:
+                        self._condition.wait()
+                    commands = deque(self._take_admissible())
+
+                # Removed once started, so a failure leaves the rest to _reset
+                while commands:
+                    kind, payload, done = commands[0]
+                    if kind == 'prefix':
+                        try:
+                            self._evaluate_prefix(payload)
+                        except Exception as e:
+                            done['error'] = e
+                        done['event'].set()
+                    else:
+                        self._start_sequence(payload)
+                    commands.popleft()
+
+                if self._active:
+                    self._step()
+            except Exception as e:
+                # Without the loop every caller would wait forever
+                print(f"Inference engine error: {type(e).__name__}: {e}")
+                self._reset(f"Inference engine error: {e}", commands)
+
+    def _reset(self, message, commands):
+        """
+        Fail every active and queued request after an unexpected error, and free all sequences.
+
+        Args:
+            message: Error message for the requests
+            commands: Commands taken from the queue but not started yet
+        """
+        for sequence in list(self._active.values()):
+            sequence.request.emit('error', message)
+            if sequence.grammar is not None:
+                try:
+                    llama_cpp.llama_grammar_free(sequence.grammar)
+                except Exception:
+                    pass
+        self._active.clear()
+
+        with self._condition:
+            commands.extend(command for command in self._commands if command[0] == 'generate')
+            # Prefix updates still run, they start from a cleared context
+            self._commands = deque(command for command in self._commands if command[0] != 'generate')
+            # Sequences are cleared when started, so the slots can be reused as they are
+            self._free_seq_ids = list(range(1, self.max_sequences + 1))
+            self._reserved = 0
+
+        for kind, payload, done in commands:
+            if kind == 'prefix':
+                done['error'] = RuntimeError(message)
+                done['event'].set()
+            else:
+                payload.emit('error', message)
+
+    def _take_admissible(self):
+        """
+        Pop the queued commands that can start now, in submission order.
+        Called with the condition lock held.
+        """
+        commands = []
+        free_slots = len(self._free_seq_ids)
+        reserved = self._reserved
+        while self._commands:
+            kind, payload, done = self._commands[0]
+            if kind == 'prefix':
+                # Wait for the sequences sharing the old prefix to drain
+                if self._active or commands:
+                    break
+            else:
+                needed = len(payload.tokens) + payload.max_tokens
+                if not self._shares_prefix(payload):
+                    needed += len(payload.prefix)
+                if free_slots == 0 or (
+                    self._prefix_length + reserved + needed > self.n_ctx and (self._active or commands)
+                ):
+                    break
+                free_slots -= 1
+                reserved += needed
+                payload.cells = needed
+            commands.append(self._commands.popleft())
+            if kind == 'prefix':
+                break
+        return commands
+
+    def _evaluate_prefix(self, tokens):
+        """Clear the context and evaluate the prefix into sequence 0."""
+        llama_cpp.llama_kv_cache_clear(self.ctx)
+        for start in range(0, len(tokens), self.n_batch):
+            chunk = tokens[start:start + self.n_batch]
+            self._batch.n_tokens = 0
+            for offset, token in enumerate(chunk):
+                self._add_token(token, start + offset, PREFIX_SEQ_ID, False)
+            if llama_cpp.llama_decode(self.ctx, self._batch) != 0:
+                raise RuntimeError("Failed to evaluate the prompt prefix")
+        self._prefix_tokens = list(tokens)
+        self._prefix_length = len(tokens)
+
+    def _shares_prefix(self, request):
+        """Whether a request's prompt follows the prefix currently in sequence 0."""
+        return request.prefix is None or request.prefix == self._prefix_tokens
+
+    def _start_sequence(self, request):
+        """Give a request a sequence that shares the prefix cells."""
+        if request.cancelled:
+            request.emit('done')
+            return
+
+        seq_id = self._free_seq_ids.pop()
+        llama_cpp.llama_kv_cache_seq_rm(self.ctx, seq_id, -1, -1)
+        if self._shares_prefix(request):
+            llama_cpp.llama_kv_cache_seq_cp(self.ctx, PREFIX_SEQ_ID, seq_id, -1, -1)
+            position, pending = self._prefix_length, request.tokens
+        else:
+            # Its own prefix is evaluated in the sequence like the rest of the prompt
+            position, pending = 0, request.prefix + request.tokens
+
+        grammar = None
+        if request.grammar is not None:
+            # Each sequence advances its own copy of the grammar state
+            grammar = llama_cpp.llama_grammar_copy(request.grammar.grammar)
+
+        self._active[seq_id] = _Sequence(seq_id, request, position, grammar, pending)
+        self._reserved += request.cells
+
+    def _add_token(self, token, position, seq_id, logits):
+        """Append a token to the batch."""
+        index = self._batch.n_tokens
+        self._batch.token[index] = token
+        self._batch.pos[index] = position
+        self._batch.n_seq_id[index] = 1
+        self._batch.seq_id[index][0] = seq_id
+        self._batch.logits[index] = logits
+        self._batch.n_tokens = index + 1
+        return index
+
+    def _step(self):
+        """Run one batched forward pass and sample the next token of each sequence."""
+        for sequence in list(self._active.values()):
+            if sequence.request.cancelled:
+                self._retire(sequence)
+
+        self._batch.n_tokens = 0
+
+        # Decoding sequences first so they advance every step, then prompt chunks
+        for sequence in self._active.values():
+            sequence.logits_index = None
+            if not sequence.pending:
+                sequence.logits_index = self._add_token(
+                    sequence.last_token, sequence.position, sequence.seq_id, True
+                )
+                sequence.position += 1
+
+        for sequence in self._active.values():
+            if not sequence.pending:
+                continue
+            room = self.n_batch - self._batch.n_tokens
+            if room <= 0:
+                break
+            chunk = sequence.pending[:room]
+            sequence.pending = sequence.pending[room:]
+            for offset, token in enumerate(chunk):
+                last = offset == len(chunk) - 1 and not sequence.pending
+                index = self._add_token(token, sequence.position, sequence.seq_id, last)
+                sequence.position += 1
+                if last:
+                    sequence.logits_index = index
+
+        if self._batch.n_tokens == 0:
+            return
+
+        if llama_cpp.llama_decode(self.ctx, self._batch) != 0:
+            for sequence in list(self._active.values()):
+                sequence.request.emit('error', 'Failed to decode batch (context full)')
+                self._retire(sequence, notify=False)
+            return
+
+        for sequence in list(self._active.values()):
+            if sequence.logits_index is not None:
+                self._advance(sequence, self._sample(sequence))
+
+    def _sample(self, sequence):
+        """Sample the next token of a sequence from its logits."""
+        logits = np.ctypeslib.as_array(
+            llama_cpp.llama_get_logits_ith(self.ctx, sequence.logits_index),
+            shape=(self.n_vocab,)
+        )
+        self._candidates_data['id'] = self._token_ids
+        self._candidates_data['logit'] = logits
+        self._candidates_data['p'] = 0
+        self._candidates.size = self.n_vocab
+        self._candidates.sorted = False
+        candidates = ctypes.byref(self._candidates)
+
+        if sequence.grammar is not None:
+            llama_cpp.llama_sample_grammar(self.ctx, candidates, sequence.grammar)
+
+        if self.temperature <= 0:
+            token = llama_cpp.llama_sample_token_greedy(self.ctx, candidates)
+        else:
+            llama_cpp.llama_sample_top_k(self.ctx, candidates, self.top_k, 1)
+            llama_cpp.llama_sample_top_p(self.ctx, candidates, self.top_p, 1)
+            llama_cpp.llama_sample_temp(self.ctx, candidates, self.temperature)
+            token = llama_cpp.llama_sample_token(self.ctx, candidates)
+
+        if sequence.grammar is not None and token != self.token_eos:
+            llama_cpp.llama_grammar_accept_token(self.ctx, sequence.grammar, token)
+        return token
+
+    def _advance(self, sequence, token):
+        """Record a sampled token, emit its text and retire the sequence if finished."""
+        request = sequence.request
+        if token == self.token_eos:
+            self._flush_text(sequence, len(sequence.text))
+            self._retire(sequence)
+            return
+
+        sequence.last_token = token
+        sequence.n_generated += 1
+        sequence.text += sequence.decoder.decode(self.llama.detokenize([token]))
+
+        # Stop strings end the generation without being emitted
+        stop_index = min(
+            (index for index in (sequence.text.find(stop) for stop in request.stop) if index >= 0),
+            default=-1
+        )
+        if stop_index >= 0:
+            self._flush_text(sequence, stop_index)
+            self._retire(sequence)
+            return
+
+        if sequence.n_generated >= request.max_tokens:
+            self._flush_text(sequence, len(sequence.text))
+            self._retire(sequence)
+            return
+
+        # Hold back text that could be the start of a stop string
+        holdback = max((len(stop) - 1 for stop in request.stop), default=0)
+        self._flush_text(sequence, len(sequence.text) - holdback)
+
+    def _flush_text(self, sequence, end):
+        """Emit generated text up to the given offset."""
+        if end > sequence.emitted:
+            sequence.request.emit('text', sequence.text[sequence.emitted:end])
+            sequence.emitted = end
+
+    def _retire(self, sequence, notify=True):
+        """Free a finished sequence's cells, grammar and slot."""
+        llama_cpp.llama_kv_cache_seq_rm(self.ctx, sequence.seq_id, -1, -1)
+        if sequence.grammar is not None:
+            llama_cpp.llama_grammar_free(sequence.grammar)
+        del self._active[sequence.seq_id]
+        with self._condition:
+            self._free_seq_ids.append(sequence.seq_id)
+            self._reserved -= sequence.request.cells
+        if notify:
+            sequence.request.emit('done')
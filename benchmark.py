@@ -0,0 +1,461 @@
+#!/usr/bin/env python
+"""
+Latency and throughput benchmark for the analysis path.
+
+Drives LlamaModelHandler.code_text directly (--target handler) or through
+the Flask /analyze route (--target route) with a fixed sample of coding
+examples at a configurable concurrency, against either the real GGUF model
+(--backend model) or the deterministic stub in stub_llama.py (--backend
+stub). Results are written as JSON, and --compare checks them against an
+earlier run to catch regressions.
+
+--agreement instead codes the samples once with full and once with compact
+responses and reports the token savings and how often the two agree.
+
+Usage:
+    python benchmark.py --backend stub --requests 100 --concurrency 4 --output results.json
+    python benchmark.py --backend stub --compare baseline.json
+    python benchmark.py --backend model --agreement
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from db_setup import setup_database, COMBCategory, CodingExample
+from config import load_inference_config
+
+# Timing differences below this many seconds are never reported as regressions
+MIN_TIME_DELTA = 0.001
+
+# Phases recorded by LlamaModelHandler.code_text, in pipeline order; requests
+# that joined an identical analysis in flight only record coalesce_wait
+PHASES = ['coalesce_wait', 'cache_lookup', 'prefilter', 'prompt_build', 'lock_wait', 'prompt_eval', 'decode', 'parse', 'store']
+
+def percentile(values, pct):
+    """Linearly interpolated percentile of a list of numbers."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * pct / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+class TracingHandler:
+    """
+    Wraps a handler installed in the Flask app so the benchmark still gets
+    the phase trace of requests that go through the /analyze route.
+    """
+    def __init__(self, handler):
+        self.handler = handler
+        self.local = threading.local()
+
+    def code_text(self, text, use_cache=True, trace=None):
+        self.local.trace = trace if trace is not None else {}
+        return self.handler.code_text(text, use_cache=use_cache, trace=self.local.trace)
+
+    def stream_code_text(self, text, use_cache=True, trace=None):
+        self.local.trace = trace if trace is not None else {}
+        return self.handler.stream_code_text(text, use_cache=use_cache, trace=self.local.trace)
+
+def create_handler(args, session, **overrides):
+    """
+    Create a LlamaModelHandler on the chosen backend.
+
+    Args:
+        overrides: Inference settings replacing the configured ones
+    """
+    from model_handler import LlamaModelHandler
+
+    config = dict(load_inference_config(), **overrides)
+    if args.backend == 'stub':
+        from stub_llama import StubLlama
+        categories = [category.name for category in session.query(COMBCategory).order_by(COMBCategory.id)]
+        model = StubLlama(prompt_token_delay=args.prompt_token_delay, token_delay=args.token_delay,
+                          categories=categories, trailing_tokens=args.trailing_tokens)
+        return LlamaModelHandler("stub.gguf", db_session=session, model=model,
+                                 max_tokens=config['max_tokens'],
+                                 prefilter_threshold=config['prefilter_threshold'],
+                                 prefilter_shortlist=config['prefilter_shortlist'],
+                                 fewshot_budget=config['fewshot_budget'],
+                                 fewshot_max_entries=config['fewshot_max_entries'],
+                                 compact_responses=config['compact_responses'],
+                                 compact_explanation_chars=config['compact_explanation_chars'],
+                                 speculative=config['speculative'],
+                                 speculative_tokens=config['speculative_tokens'],
+                                 coalesce_requests=config['coalesce_requests'])
+    return LlamaModelHandler(args.model, db_session=session, **config)
+
+def make_request_function(args, handler):
+    """
+    Build the function that sends one request.
+
+    Returns:
+        A function taking a text and returning (results, trace)
+    """
+    use_cache = args.use_cache
+
+    if args.target == 'handler':
+        def run(text):
+            trace = {}
+            results = handler.code_text(text, use_cache=use_cache, trace=trace)
+            return results, trace
+        return run
+
+    import app as app_module
+    tracing_handler = TracingHandler(handler)
+    app_module.model_handler = tracing_handler
+    # Test clients are cheap but not meant to be shared between threads
+    clients = threading.local()
+
+    def run(text):
+        if not hasattr(clients, 'client'):
+            clients.client = app_module.app.test_client()
+        data = {'text': text}
+        if not use_cache:
+            data['no_cache'] = '1'
+        response = clients.client.post('/analyze', data=data)
+        results = response.get_json() or {'error': f'HTTP {response.status_code}'}
+        if response.status_code != 200 and 'error' not in results:
+            results['error'] = f'HTTP {response.status_code}'
+        return results, getattr(tracing_handler.local, 'trace', {})
+    return run
+
+def run_benchmark(args):
+    """
+    Run the benchmark.
+
+    Returns:
+        A JSON-serializable report
+    """
+    # Work on a copy of the database so results and cache entries from the
+    # benchmark never reach the real one and every run starts from the same state
+    work_dir = tempfile.mkdtemp(prefix='comb-benchmark-')
+    database_path = os.path.join(work_dir, 'benchmark.db')
+    if os.path.exists(args.database):
+        shutil.copyfile(args.database, database_path)
+    session = setup_database(f'sqlite:///{database_path}')
+    handler = None
+
+    try:
+        texts = [example.text for example in
+                 session.query(CodingExample).order_by(CodingExample.id).limit(args.samples)]
+        if not texts:
+            raise RuntimeError("No coding examples in the database; run populate_comb_data.py first")
+
+        load_start = time.perf_counter()
+        handler = create_handler(args, session)
+        load_time = time.perf_counter() - load_start
+        send = make_request_function(args, handler)
+
+        for i in range(args.warmup):
+            send(texts[i % len(texts)])
+
+        def timed_request(i):
+            start = time.perf_counter()
+            try:
+                results, trace = send(texts[i % len(texts)])
+                error = results.get('error')
+            except Exception as e:
+                trace, error = {}, str(e)
+            return time.perf_counter() - start, dict(trace), error
+
+        wall_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            samples = list(executor.map(timed_request, range(args.requests)))
+        wall_time = time.perf_counter() - wall_start
+    finally:
+        if handler is not None:
+            # Let the background writer finish before the database is removed
+            handler.close()
+        session.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return build_report(args, samples, wall_time, load_time)
+
+def run_agreement(args):
+    """
+    Code the samples with full and with compact responses and compare them.
+
+    Returns:
+        A JSON-serializable report with the generated tokens and decode time
+        per mode and the share of texts on which both modes agree
+    """
+    work_dir = tempfile.mkdtemp(prefix='comb-benchmark-')
+    database_path = os.path.join(work_dir, 'benchmark.db')
+    if os.path.exists(args.database):
+        shutil.copyfile(args.database, database_path)
+    session = setup_database(f'sqlite:///{database_path}')
+
+    modes = {}
+    try:
+        texts = [example.text for example in
+                 session.query(CodingExample).order_by(CodingExample.id).limit(args.samples)]
+        if not texts:
+            raise RuntimeError("No coding examples in the database; run populate_comb_data.py first")
+
+        for mode, compact in (('full', False), ('compact', True)):
+            handler = create_handler(args, session, compact_responses=compact)
+            try:
+                outcomes = []
+                for text in texts:
+                    trace = {}
+                    results = handler.code_text(text, use_cache=False, trace=trace)
+                    categories = sorted(results.get('categories', []),
+                                        key=lambda category: category['confidence'], reverse=True)
+                    outcomes.append({
+                        'error': results.get('error'),
+                        'categories': [category['category'] for category in categories],
+                        'generated_tokens': trace.get('generated_tokens', 0),
+                        'decode': trace.get('phases', {}).get('decode', 0.0)
+                    })
+            finally:
+                handler.close()
+            modes[mode] = outcomes
+    finally:
+        session.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    def summary(outcomes):
+        return {
+            'errors': sum(1 for outcome in outcomes if outcome['error']),
+            'generated_per_request': sum(outcome['generated_tokens'] for outcome in outcomes) / len(outcomes),
+            'decode_mean': sum(outcome['decode'] for outcome in outcomes) / len(outcomes)
+        }
+
+    full, compact = summary(modes['full']), summary(modes['compact'])
+    pairs = list(zip(modes['full'], modes['compact']))
+    return {
+        'benchmark': {
+            'backend': args.backend,
+            'samples': len(pairs),
+            'commit': git_commit(),
+            'timestamp': datetime.utcnow().isoformat()
+        },
+        'full': full,
+        'compact': compact,
+        'token_savings': (1 - compact['generated_per_request'] / full['generated_per_request']
+                          if full['generated_per_request'] else None),
+        'agreement': {
+            # Same most confident category (or both found none)
+            'top_category': sum(a['categories'][:1] == b['categories'][:1] for a, b in pairs) / len(pairs),
+            # Same set of categories above the confidence cut-off
+            'categories': sum(set(a['categories']) == set(b['categories']) for a, b in pairs) / len(pairs)
+        }
+    }
+
+def print_agreement(report):
+    """Print a human-readable summary of an agreement report."""
+    for mode in ('full', 'compact'):
+        stats = report[mode]
+        print(f"{mode:<8} {stats['generated_per_request']:6.1f} tokens generated per analysis, "
+              f"decode {stats['decode_mean'] * 1000:8.1f} ms, {stats['errors']} errors")
+    if report['token_savings'] is not None:
+        print(f"Compact responses generate {report['token_savings']:.0%} fewer tokens")
+    agreement = report['agreement']
+    print(f"Agreement on {report['benchmark']['samples']} texts: top category {agreement['top_category']:.0%}, "
+          f"all categories {agreement['categories']:.0%}")
+
+def build_report(args, samples, wall_time, load_time):
+    """Summarize the timed requests."""
+    latencies = [latency for latency, trace, error in samples if error is None]
+    traces = [trace for latency, trace, error in samples if error is None]
+    errors = [error for latency, trace, error in samples if error is not None]
+
+    prompt_tokens = sum(trace.get('prompt_tokens', 0) for trace in traces)
+    cached_prompt_tokens = sum(trace.get('cached_prompt_tokens', 0) for trace in traces)
+    generated_tokens = sum(trace.get('generated_tokens', 0) for trace in traces)
+    decode_time = sum(trace.get('phases', {}).get('decode', 0.0) for trace in traces)
+    draft_tokens = sum(trace.get('draft_tokens', 0) for trace in traces)
+    accepted_tokens = sum(trace.get('accepted_tokens', 0) for trace in traces)
+    verify_steps = sum(trace.get('verify_steps', 0) for trace in traces)
+
+    phases = {}
+    for phase in PHASES:
+        values = [trace['phases'][phase] for trace in traces if phase in trace.get('phases', {})]
+        if values:
+            phases[phase] = {
+                'mean': sum(values) / len(values),
+                'p95': percentile(values, 95),
+                'total': sum(values)
+            }
+
+    return {
+        'benchmark': {
+            'backend': args.backend,
+            'target': args.target,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'samples': args.samples,
+            'use_cache': args.use_cache,
+            'prompt_token_delay': args.prompt_token_delay if args.backend == 'stub' else None,
+            'token_delay': args.token_delay if args.backend == 'stub' else None,
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'timestamp': datetime.utcnow().isoformat()
+        },
+        'model_load_time': load_time,
+        'wall_time': wall_time,
+        'completed': len(latencies),
+        'errors': len(errors),
+        'error_samples': sorted(set(errors))[:5],
+        'throughput': len(latencies) / wall_time if wall_time > 0 else 0.0,
+        'latency': {
+            'mean': sum(latencies) / len(latencies) if latencies else None,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'max': max(latencies) if latencies else None
+        },
+        'tokens': {
+            'prompt': prompt_tokens,
+            'cached_prompt': cached_prompt_tokens,
+            'evaluated_prompt': prompt_tokens - cached_prompt_tokens,
+            'generated': generated_tokens,
+            'prompt_per_request': prompt_tokens / len(traces) if traces else 0.0,
+            'generated_per_request': generated_tokens / len(traces) if traces else 0.0,
+            'generated_per_second': generated_tokens / decode_time if decode_time > 0 else None
+        },
+        'speculative': {
+            'drafted': draft_tokens,
+            'accepted': accepted_tokens,
+            'acceptance_rate': accepted_tokens / draft_tokens if draft_tokens else None,
+            # Each verification step produces the accepted drafts plus one token of the model's own
+            'tokens_per_step': (accepted_tokens + verify_steps) / verify_steps if verify_steps else None
+        },
+        'phases': phases
+    }
+
+def git_commit():
+    """The current commit, to tell which code a result file was produced with."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_reports(baseline, report, threshold):
+    """
+    Compare a run against a baseline.
+
+    Returns:
+        A list of (metric, baseline value, new value, relative change, regressed) tuples
+    """
+    # (metric, value getter, True if higher is better)
+    metrics = [
+        ('latency.p50', lambda r: r['latency']['p50'], False),
+        ('latency.p95', lambda r: r['latency']['p95'], False),
+        ('latency.p99', lambda r: r['latency']['p99'], False),
+        ('throughput', lambda r: r['throughput'], True),
+    ]
+    for phase in PHASES:
+        metrics.append((f'phases.{phase}.mean',
+                        lambda r, phase=phase: r['phases'].get(phase, {}).get('mean'), False))
+
+    rows = []
+    for name, get_value, higher_is_better in metrics:
+        old, new = get_value(baseline), get_value(report)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        if higher_is_better:
+            regressed = -change > threshold
+        else:
+            # Ignore sub-millisecond differences in timings, which are mostly noise
+            regressed = change > threshold and new - old > MIN_TIME_DELTA
+        rows.append((name, old, new, change, regressed))
+    return rows
+
+def print_report(report):
+    """Print a human-readable summary of a report."""
+    latency = report['latency']
+    tokens = report['tokens']
+    print(f"{report['completed']} requests in {report['wall_time']:.2f}s "
+          f"({report['throughput']:.2f} req/s), {report['errors']} errors")
+    if latency['p50'] is not None:
+        print(f"Latency: p50 {latency['p50'] * 1000:.1f} ms, p95 {latency['p95'] * 1000:.1f} ms, "
+              f"p99 {latency['p99'] * 1000:.1f} ms, max {latency['max'] * 1000:.1f} ms")
+    print(f"Tokens per request: {tokens['prompt_per_request']:.0f} prompt "
+          f"({tokens['evaluated_prompt']} evaluated in total), "
+          f"{tokens['generated_per_request']:.0f} generated")
+    if tokens['generated_per_second']:
+        print(f"Decode speed: {tokens['generated_per_second']:.1f} tokens/s")
+    speculative = report.get('speculative', {})
+    if speculative.get('drafted'):
+        print(f"Speculative decoding: {speculative['accepted']} of {speculative['drafted']} drafted tokens accepted "
+              f"({speculative['acceptance_rate']:.0%}), {speculative['tokens_per_step']:.2f} tokens per forward pass")
+    for phase, stats in report['phases'].items():
+        print(f"  {phase:<13} mean {stats['mean'] * 1000:8.2f} ms   p95 {stats['p95'] * 1000:8.2f} ms")
+    for error in report['error_samples']:
+        print(f"Error: {error}")
+
+if __name__ == "__main__":
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Benchmark the COM-B analysis path.")
+    parser.add_argument('--backend', choices=['stub', 'model'], default='stub',
+                        help="Deterministic stub or the real GGUF model")
+    parser.add_argument('--target', choices=['handler', 'route'], default='handler',
+                        help="Call code_text directly or go through the /analyze route")
+    parser.add_argument('--model', default=os.path.join(base_dir, "Llama-3.2-3B-Instruct-Q8_0.gguf"),
+                        help="Path to the GGUF model file")
+    parser.add_argument('--database', default=os.path.join(base_dir, 'comb_analyzer.db'),
+                        help="Database to copy the taxonomy and examples from")
+    parser.add_argument('--requests', type=int, default=50, help="Number of timed requests")
+    parser.add_argument('--concurrency', type=int, default=1, help="Requests in flight at once")
+    parser.add_argument('--warmup', type=int, default=2, help="Untimed requests sent first")
+    parser.add_argument('--samples', type=int, default=20, help="Coding examples cycled through")
+    parser.add_argument('--use-cache', action='store_true',
+                        help="Let repeated texts hit the result cache")
+    parser.add_argument('--prompt-token-delay', type=float, default=0.0005,
+                        help="Stub seconds per evaluated prompt token")
+    parser.add_argument('--token-delay', type=float, default=0.02,
+                        help="Stub seconds per generated token")
+    parser.add_argument('--trailing-tokens', type=int, default=0,
+                        help="Stub tokens of prose generated after the JSON object")
+    parser.add_argument('--output', help="Write the JSON report to this file")
+    parser.add_argument('--compare', help="Compare against an earlier JSON report")
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help="Relative slowdown reported as a regression (default 10%%)")
+    parser.add_argument('--agreement', action='store_true',
+                        help="Compare full and compact responses on the samples instead")
+    args = parser.parse_args()
+
+    if args.agreement:
+        report = run_agreement(args)
+        print_agreement(report)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+                f.write('\n')
+            print(f"Report written to {args.output}")
+        sys.exit(0)
+
+    report = run_benchmark(args)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+        print(f"Report written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        rows = compare_reports(baseline, report, args.threshold)
+        regressions = [row for row in rows if row[4]]
+        print(f"Compared with {args.compare} (commit {baseline['benchmark'].get('commit')}):")
+        for name, old, new, change, regressed in rows:
+            print(f"  {name:<22} {old:10.4f} -> {new:10.4f} ({change:+.1%}){'  REGRESSION' if regressed else ''}")
+        if regressions:
+            sys.exit(1)
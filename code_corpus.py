@@ -0,0 +1,486 @@
+#!/usr/bin/env python
+"""
+Offline COM-B coding of a whole corpus, without the web app.
+
+Items are read as a stream from a JSONL file (objects with a "text" field,
+or plain JSON strings), a CSV file with a "text" column, or a text file
+with one item per line. They are analyzed by several worker processes,
+each running its own LlamaModelHandler on an even share of the CPU cores.
+This process writes the results to the database in large transactions
+and, after each one, records the finished items in a checkpoint file, so
+an interrupted run continues where it stopped when started again with
+the same arguments:
+
+    python code_corpus.py corpus.jsonl [--workers 4] [--batch-size 500] [--database comb_analyzer.db]
+
+Texts too long for the context are analyzed in windows, as with
+/analyze/document. Progress is reported in items per second as the run goes.
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+import uuid
+
+# Items waiting for a worker, per worker; bounds what is read ahead of the workers
+READ_AHEAD_PER_WORKER = 4
+
+def read_corpus(path, source_format=None):
+    """
+    Stream the texts of a corpus file.
+
+    Args:
+        path: The file; the format defaults to its extension
+        source_format: 'jsonl', 'csv' or 'text'
+
+    Yields:
+        (position, text) tuples, position counting the non-empty texts from 0
+
+    Raises:
+        ValueError: If the file cannot be parsed
+    """
+    if source_format is None:
+        extension = os.path.splitext(path)[1].lower()
+        source_format = {'.jsonl': 'jsonl', '.ndjson': 'jsonl', '.csv': 'csv', '.txt': 'text'}.get(extension)
+
+    def texts():
+        if source_format == 'csv':
+            with open(path, newline='', encoding='utf-8-sig') as f:
+                reader = csv.DictReader(f)
+                if not reader.fieldnames or 'text' not in reader.fieldnames:
+                    raise ValueError("CSV corpora need a 'text' column")
+                for record in reader:
+                    yield record['text'] or ''
+        elif source_format == 'jsonl':
+            with open(path, encoding='utf-8') as f:
+                for line_number, line in enumerate(f, start=1):
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        raise ValueError(f"Invalid JSON on line {line_number}")
+                    if isinstance(record, str):
+                        yield record
+                    elif isinstance(record, dict) and isinstance(record.get('text'), str):
+                        yield record['text']
+                    else:
+                        raise ValueError(f"Line {line_number} has no 'text' field")
+        elif source_format == 'text':
+            with open(path, encoding='utf-8') as f:
+                yield from f
+        else:
+            raise ValueError(f"Unsupported corpus format: {source_format or path}")
+
+    position = 0
+    for text in texts():
+        text = text.strip()
+        if text:
+            yield position, text
+            position += 1
+
+class Checkpoint:
+    """
+    The items of a corpus that are done, saved to a JSON file after every
+    committed batch.
+
+    Items finish out of order, so the file keeps the number of leading items
+    that are all done plus the positions done beyond them. Each run gets an
+    ID, and its results are stored under the session IDs "<run id>-<position>",
+    which lets resume() find items committed just before an interruption
+    that the file doesn't list yet.
+    """
+    def __init__(self, path, source):
+        """
+        Args:
+            path: The checkpoint file
+            source: The corpus file
+        """
+        self.path = path
+        self.source = {'path': os.path.abspath(source), 'size': os.path.getsize(source)}
+        self.run_id = uuid.uuid4().hex
+        self.completed = 0      # Items 0 to completed - 1 are all done
+        self.done = set()       # Positions done beyond those
+        self.failed = set()     # Positions whose analysis failed (and count as done)
+        self.retry = set()      # Failed positions to analyze again in this run
+
+    @classmethod
+    def load(cls, path, source, retry_failed=False):
+        """
+        Read a checkpoint of the same corpus, or start a new one if there is no file.
+
+        Raises:
+            ValueError: If the checkpoint belongs to another corpus or the
+                corpus file changed since
+        """
+        checkpoint = cls(path, source)
+        if not os.path.exists(path):
+            return checkpoint
+        with open(path) as f:
+            saved = json.load(f)
+        if saved['source'] != checkpoint.source:
+            raise ValueError(f"{path} belongs to another corpus or {source} changed since; "
+                             f"use --restart to start over")
+        checkpoint.run_id = saved['run_id']
+        checkpoint.completed = saved['completed']
+        checkpoint.done = set(saved['done'])
+        checkpoint.failed = set(saved['failed'])
+        if retry_failed:
+            checkpoint.retry = set(checkpoint.failed)
+        return checkpoint
+
+    def session_id(self, position):
+        return f"{self.run_id}-{position}"
+
+    def resume(self, session):
+        """
+        Mark the items whose results are in the database as done.
+
+        Returns:
+            The number of items found that the file didn't list
+        """
+        from db_setup import AnalysisResult
+        prefix = f"{self.run_id}-"
+        # A range on the indexed column rather than LIKE, which SQLite can't serve from the index
+        rows = session.query(AnalysisResult.session_id).filter(
+            AnalysisResult.session_id >= prefix,
+            AnalysisResult.session_id < f"{self.run_id}."
+        ).distinct()
+        found = 0
+        for (session_id,) in rows:
+            position = int(session_id[len(prefix):])
+            if not self.is_done(position):
+                self.mark(position)
+                found += 1
+        return found
+
+    def is_done(self, position):
+        if position in self.retry:
+            return False
+        return position < self.completed or position in self.done
+
+    def mark(self, position, failed=False):
+        """Record an item as done."""
+        self.retry.discard(position)
+        if failed:
+            self.failed.add(position)
+        else:
+            self.failed.discard(position)
+        if position >= self.completed:
+            self.done.add(position)
+            while self.completed in self.done:
+                self.done.remove(self.completed)
+                self.completed += 1
+
+    def save(self):
+        """Write the checkpoint file, atomically so an interruption never leaves half a file."""
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, 'w') as f:
+            json.dump({
+                'source': self.source,
+                'run_id': self.run_id,
+                'completed': self.completed,
+                'done': sorted(self.done),
+                'failed': sorted(self.failed)
+            }, f)
+        os.replace(temporary_path, self.path)
+
+def _worker_main(worker_id, database_url, backend, model_path, inference_config, use_cache,
+                 task_queue, result_queue):
+    """
+    Entry point of a worker process: analyzes (position, text) tasks without
+    storing the results, which go back to the main process, until it receives None.
+    """
+    # Ctrl+C is handled by the main process, which stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Imported here so the main process never loads the model
+    from db_setup import setup_database, COMBCategory
+    from model_handler import LlamaModelHandler
+
+    session = setup_database(database_url)
+    model = None
+    if backend == 'stub':
+        from stub_llama import StubLlama
+        model = StubLlama(categories=[category.name for category in
+                                      session.query(COMBCategory).order_by(COMBCategory.id)])
+        session.close()
+    handler = LlamaModelHandler(model_path, db_session=session, model=model, record_metrics=False,
+                                **inference_config)
+    result_queue.put(("ready", worker_id, handler.taxonomy.version))
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        position, text = task
+        try:
+            if handler.fits_context(text):
+                results = handler.code_text(text, use_cache=use_cache, store=False)
+            else:
+                results = handler.code_document(text, use_cache=use_cache, store=False)
+        except Exception as e:
+            results = {"error": f"Error analyzing text: {str(e)}"}
+        result_queue.put(("result", position, results))
+
+    # Processes started by multiprocessing skip atexit handlers, so flush explicitly
+    handler.close()
+
+class CorpusRun:
+    """
+    One run over a corpus: feeds the workers, writes their results and
+    keeps the checkpoint.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.database_url = f'sqlite:///{args.database}'
+        self.checkpoint = None
+        self.workers = []
+        self.in_flight = {}         # position -> text of the items handed to the workers
+        self.submitted = 0
+        self.skipped = 0
+        self.reading_done = threading.Event()
+        self.read_error = None
+        self.coded = 0
+        self.failed = 0
+
+    def run(self):
+        """
+        Code the corpus.
+
+        Returns:
+            The process exit status
+        """
+        from db_setup import create_session_factory
+        from taxonomy import TaxonomySnapshot, load_taxonomy
+
+        args = self.args
+        checkpoint_path = args.checkpoint or f"{args.corpus}.checkpoint.json"
+        if args.restart and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        self.checkpoint = Checkpoint.load(checkpoint_path, args.corpus, retry_failed=args.retry_failed)
+
+        self.session = create_session_factory(self.database_url)()
+        found = self.checkpoint.resume(self.session)
+        if found:
+            print(f"Found {found} items stored after the last checkpoint")
+        self.taxonomy = TaxonomySnapshot(*load_taxonomy(self.session))
+        self.session.close()
+        if self.checkpoint.completed or self.checkpoint.done:
+            print(f"Resuming: {self.checkpoint.completed + len(self.checkpoint.done)} items already done")
+
+        self._start_workers()
+        try:
+            if not self._wait_until_ready():
+                return 1
+            reader = threading.Thread(target=self._feed, daemon=True)
+            reader.start()
+            return self._collect()
+        except KeyboardInterrupt:
+            print("Interrupted; run the same command again to resume")
+            return 130
+        finally:
+            self._stop_workers(graceful=False)
+
+    def _start_workers(self):
+        args = self.args
+        from config import load_inference_config
+        inference_config = load_inference_config()
+        threads = args.threads_per_worker or max(1, (multiprocessing.cpu_count() or 1) // args.workers)
+        inference_config['n_threads'] = threads
+        inference_config['n_threads_batch'] = threads
+        # The whole run uses the taxonomy it started with
+        inference_config['taxonomy_poll_interval'] = 0
+
+        # Spawn rather than fork so workers start from a clean interpreter
+        context = multiprocessing.get_context("spawn")
+        self.task_queue = context.Queue(maxsize=args.workers * READ_AHEAD_PER_WORKER)
+        self.result_queue = context.Queue()
+        for worker_id in range(args.workers):
+            process = context.Process(
+                target=_worker_main,
+                args=(worker_id, self.database_url, args.backend, args.model, inference_config,
+                      not args.no_cache, self.task_queue, self.result_queue),
+                daemon=True
+            )
+            process.start()
+            self.workers.append(process)
+        print(f"Started {args.workers} workers with {threads} threads each")
+
+    def _wait_until_ready(self):
+        """Wait for every worker to load its model. Returns False if one failed."""
+        ready = 0
+        while ready < len(self.workers):
+            try:
+                event, worker_id, version = self.result_queue.get(timeout=1)
+            except queue.Empty:
+                if self._dead_worker() is not None:
+                    print("A worker failed to start", file=sys.stderr)
+                    return False
+                continue
+            if version != self.taxonomy.version:
+                print("The taxonomy changed while the workers were starting; run again", file=sys.stderr)
+                return False
+            ready += 1
+        return True
+
+    def _dead_worker(self):
+        for process in self.workers:
+            if not process.is_alive():
+                return process
+        return None
+
+    def _feed(self):
+        """Reader thread: hand the items that aren't done yet to the workers."""
+        try:
+            for position, text in read_corpus(self.args.corpus, self.args.format):
+                if self.checkpoint.is_done(position):
+                    self.skipped += 1
+                    continue
+                self.in_flight[position] = text
+                self.task_queue.put((position, text))
+                self.submitted += 1
+        except (ValueError, OSError, UnicodeDecodeError) as e:
+            self.read_error = e
+        finally:
+            self.reading_done.set()
+
+    def _collect(self):
+        """Receive results, commit them in batches and report progress. Returns the exit status."""
+        args = self.args
+        received = 0
+        batch = []
+        start_time = time.perf_counter()
+        last_commit = last_report = start_time
+        reported = 0
+
+        while True:
+            # Read the flag before the count, which is final once it is set
+            finished = self.reading_done.is_set()
+            if finished and received == self.submitted:
+                break
+            try:
+                event, position, results = self.result_queue.get(timeout=1)
+                received += 1
+                if "error" in results:
+                    self.failed += 1
+                    if args.verbose:
+                        print(f"Item {position} failed: {results['error']}", file=sys.stderr)
+                else:
+                    self.coded += 1
+                batch.append((position, self.in_flight.pop(position), results))
+            except queue.Empty:
+                if self._dead_worker() is not None:
+                    self._commit(batch)
+                    print("A worker died; run the same command again to resume", file=sys.stderr)
+                    return 1
+            except KeyboardInterrupt:
+                # Keep what is already analyzed
+                self._commit(batch)
+                raise
+
+            now = time.perf_counter()
+            if len(batch) >= args.batch_size or (batch and now - last_commit >= args.commit_seconds):
+                self._commit(batch)
+                batch = []
+                last_commit = now
+            if now - last_report >= args.report_seconds:
+                items = self.coded + self.failed
+                print(f"{items} items coded ({self.failed} failed): {items / (now - start_time):.2f} items/s, "
+                      f"{(items - reported) / (now - last_report):.2f} items/s over the last "
+                      f"{now - last_report:.0f}s")
+                last_report = now
+                reported = items
+
+        self._commit(batch)
+        elapsed = time.perf_counter() - start_time
+        # Let the workers write out their result cache entries
+        self._stop_workers()
+        items = self.coded + self.failed
+        print(f"Coded {items} items in {elapsed:.1f}s ({items / elapsed if elapsed > 0 else 0:.2f} items/s); "
+              f"{self.skipped} were already done, {self.failed} failed")
+
+        if self.read_error is not None:
+            print(f"Reading {args.corpus} failed: {self.read_error}", file=sys.stderr)
+            return 1
+        if self.checkpoint.failed:
+            print(f"{len(self.checkpoint.failed)} items failed; rerun with --retry-failed to analyze them again")
+            return 1
+        # The corpus is done, so the next run starts from the beginning
+        os.remove(self.checkpoint.path)
+        return 0
+
+    def _commit(self, batch):
+        """Store a batch of results in one transaction, then record them in the checkpoint."""
+        from model_handler import build_result_write
+
+        if not batch:
+            return
+        session = self.session
+        try:
+            for position, text, results in batch:
+                if "error" in results:
+                    continue
+                write = build_result_write(text, results, self.checkpoint.session_id(position), self.taxonomy,
+                                           spans=results.get("spans"))
+                if write is not None:
+                    write(session)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+        for position, text, results in batch:
+            self.checkpoint.mark(position, failed="error" in results)
+        self.checkpoint.save()
+
+    def _stop_workers(self, graceful=True):
+        """Stop the workers: after their current item, or right away."""
+        for process in self.workers:
+            if graceful and process.is_alive():
+                self.task_queue.put(None)
+        for process in self.workers:
+            if graceful:
+                process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
+
+if __name__ == "__main__":
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Code a whole corpus with the COM-B model, without the web app.")
+    parser.add_argument('corpus', help="JSONL, CSV or text file with one item per record or line")
+    parser.add_argument('--format', choices=['jsonl', 'csv', 'text'], help="Corpus format (defaults to the extension)")
+    parser.add_argument('--workers', type=int, default=1, help="Model worker processes")
+    parser.add_argument('--threads-per-worker', type=int,
+                        help="CPU threads per worker (defaults to an even share of the cores)")
+    parser.add_argument('--database', default=os.path.join(base_dir, 'comb_analyzer.db'),
+                        help="SQLite database the results are written to")
+    parser.add_argument('--batch-size', type=int, default=500, help="Items per database transaction")
+    parser.add_argument('--commit-seconds', type=float, default=60,
+                        help="Commit a smaller batch after this many seconds")
+    parser.add_argument('--report-seconds', type=float, default=10, help="Seconds between progress reports")
+    parser.add_argument('--checkpoint', help="Checkpoint file (defaults to <corpus>.checkpoint.json)")
+    parser.add_argument('--restart', action='store_true', help="Ignore an existing checkpoint and start over")
+    parser.add_argument('--retry-failed', action='store_true', help="Analyze the items that failed before again")
+    parser.add_argument('--no-cache', action='store_true', help="Bypass the result cache")
+    parser.add_argument('--backend', choices=['model', 'stub'], default='model',
+                        help="The real model, or the deterministic stub from stub_llama.py to test a run")
+    parser.add_argument('--model', default=os.path.join(base_dir, "Llama-3.2-3B-Instruct-Q8_0.gguf"),
+                        help="GGUF model file")
+    parser.add_argument('--verbose', action='store_true', help="Print the error of each failed item")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    try:
+        status = CorpusRun(args).run()
+    except ValueError as e:
+        sys.exit(str(e))
+    sys.exit(status)
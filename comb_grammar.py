@@ -0,0 +1,142 @@
+# comb_grammar.py
+
+import json
+import re
+from collections import Counter
+
+def _literal(text):
+    """Quote a string as a GBNF literal."""
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def _bounded_repeat(name, element, max_count):
+    """
+    Build rules matching between 0 and max_count repetitions of element.
+
+    GBNF has no bounded repetition operator, so the bound is expressed as a
+    chain of rules where each one allows one more element than the last.
+    Every step has a single parse path, which keeps grammar sampling cheap.
+
+    Returns:
+        A list of rule lines; the entry rule is named f"{name}-{max_count}"
+    """
+    rules = [f'{name}-1 ::= {element}?']
+    for count in range(2, max_count + 1):
+        rules.append(f'{name}-{count} ::= ({element} {name}-{count - 1})?')
+    return rules
+
+def build_coding_grammar(category_names, max_categories=2, max_explanation_chars=160):
+    """
+    Build a GBNF grammar for the COM-B coding response.
+
+    The grammar only accepts a single {"categories": [...]} object whose
+    category names come from the given list, with integer confidences
+    between 0 and 100 and explanations capped in length. Generation ends
+    at the closing brace.
+
+    Args:
+        category_names: Category names the model may choose from
+        max_categories: Maximum number of entries in the categories list
+        max_explanation_chars: Maximum length of each explanation
+
+    Returns:
+        The grammar as a string
+
+    Raises:
+        ValueError: If there are no categories, which GBNF can't express
+    """
+    if not category_names:
+        raise ValueError("Cannot build a coding grammar without categories")
+    category_alternatives = ' | '.join(_literal(json.dumps(name)) for name in category_names)
+
+    # Up to max_categories comma-separated items
+    items = 'item'
+    for _ in range(max_categories - 1):
+        items = f'item ("," ws {items})?'
+
+    rules = [
+        f'root ::= "{{" ws {_literal(json.dumps("categories"))} ":" ws "[" ws ({items})? ws "]" ws "}}"',
+        f'item ::= "{{" ws {_literal(json.dumps("category"))} ":" ws category "," ws '
+        f'{_literal(json.dumps("explanation"))} ":" ws explanation "," ws '
+        f'{_literal(json.dumps("confidence"))} ":" ws confidence ws "}}"',
+        f'category ::= {category_alternatives}',
+        f'explanation ::= "\\"" explanation-chars-{max_explanation_chars} "\\""',
+        'explanation-char ::= [^"\\\\\\x00-\\x1f] | "\\\\" ["\\\\/bfnrt]',
+        'confidence ::= "100" | [1-9] [0-9] | [0-9]',
+        # Bounded whitespace so the model cannot stall on newlines
+        'ws ::= ws-12',
+    ]
+    rules += _bounded_repeat('explanation-chars', 'explanation-char', max_explanation_chars)
+    rules += _bounded_repeat('ws', '[ \\t\\n]', 12)
+
+    return '\n'.join(rules) + '\n'
+
+def category_codes(category_names):
+    """
+    Assign short codes to category names for the compact response format.
+
+    Codes are the initial of a name's first word followed by the start of
+    each following word. Names start with one letter per word, and only
+    names whose codes collide get longer ones ("Motivation - Reflective"
+    becomes "MR", or "MRE" if another name also has the initials MR).
+
+    Returns:
+        A dictionary of code to category name, in the order of the names
+    """
+    words = [re.findall(r'[A-Za-z0-9]+', name) or ['C'] for name in category_names]
+    lengths = [1] * len(words)
+    for _ in range(5):
+        codes = [(name_words[0][0] + ''.join(word[:length] for word in name_words[1:])).upper()
+                 for name_words, length in zip(words, lengths)]
+        counts = Counter(codes)
+        if len(counts) == len(codes):
+            return dict(zip(codes, category_names))
+        lengths = [length + 1 if counts[code] > 1 else length for code, length in zip(codes, lengths)]
+    # Names too alike to tell apart by their words
+    return {f'C{number}': name for number, name in enumerate(category_names, start=1)}
+
+def build_compact_grammar(codes, max_categories=2, max_explanation_chars=60):
+    """
+    Build a GBNF grammar for the compact coding response.
+
+    The grammar accepts {"c": [["CODE", confidence, "reason"], ...]}, or
+    {"c": [["CODE", confidence], ...]} when explanations are turned off,
+    which takes a fraction of the tokens of the full format.
+
+    Args:
+        codes: Category codes the model may choose from
+        max_categories: Maximum number of entries in the list
+        max_explanation_chars: Maximum length of each reason (0 leaves reasons out)
+
+    Returns:
+        The grammar as a string
+
+    Raises:
+        ValueError: If there are no codes, which GBNF can't express
+    """
+    if not codes:
+        raise ValueError("Cannot build a compact grammar without category codes")
+    code_alternatives = ' | '.join(_literal(json.dumps(code)) for code in codes)
+
+    items = 'item'
+    for _ in range(max_categories - 1):
+        items = f'item ("," ws {items})?'
+
+    if max_explanation_chars > 0:
+        item = 'item ::= "[" code "," ws confidence "," ws explanation "]"'
+    else:
+        item = 'item ::= "[" code "," ws confidence "]"'
+    rules = [
+        f'root ::= "{{" {_literal(json.dumps("c"))} ":" ws "[" ({items})? "]" "}}"',
+        item,
+        f'code ::= {code_alternatives}',
+        'confidence ::= "100" | [1-9] [0-9] | [0-9]',
+        'ws ::= " "?',
+    ]
+    if max_explanation_chars > 0:
+        rules += [
+            f'explanation ::= "\\"" explanation-chars-{max_explanation_chars} "\\""',
+            'explanation-char ::= [^"\\\\\\x00-\\x1f] | "\\\\" ["\\\\/bfnrt]',
+        ]
+        rules += _bounded_repeat('explanation-chars', 'explanation-char', max_explanation_chars)
+
+    return '\n'.join(rules) + '\n'
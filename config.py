@@ -0,0 +1,87 @@
+# config.py
+
+import json
+import os
+
+# Default llama inference parameters
+DEFAULT_INFERENCE_CONFIG = {
+    'n_ctx': 4096,                   # Context window size
+    'n_threads': 6,                  # CPU threads used for decoding (single tokens)
+    'n_threads_batch': None,         # CPU threads used for prompt evaluation (defaults to n_threads)
+    'n_batch': 512,                  # Prompt tokens evaluated per batch
+    'n_gpu_layers': 4,               # Layers offloaded to the GPU, if there is one
+    'use_mmap': True,                # Map the model file instead of reading it into memory
+    'use_mlock': False,              # Lock the model in RAM so it is never swapped out
+    'max_tokens': 1024,              # Maximum tokens generated per analysis
+    'prefilter_threshold': 0,        # Pre-classifier confidence (%) that skips the model (0 disables it)
+    'prefilter_shortlist': 0,        # Pre-classifier categories suggested to the model (0 disables it)
+    'fewshot_budget': 0,             # Prompt tokens of indicators/examples picked per text (0 uses the fixed block)
+    'fewshot_max_entries': 8,        # Maximum indicators/examples picked per text
+    'compact_responses': False,      # Answer with category codes instead of the full JSON format
+    'compact_explanation_chars': 60, # Length cap of compact reasons (0 leaves them out)
+    'speculative': None,             # Speculative decoding: 'prompt_lookup', 'draft' or None (off)
+    'draft_model_path': None,        # Small GGUF model sharing the vocabulary, for 'draft'
+    'speculative_tokens': 8,         # Tokens drafted per verification step
+    'taxonomy_poll_interval': 30,    # Seconds between checks for taxonomy changes (0 disables them)
+    'coalesce_requests': True,       # Identical concurrent requests share one analysis
+}
+
+# The config file is looked up next to the application unless COMB_CONFIG says otherwise
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'comb_config.json')
+
+def _parse_value(key, value):
+    """Convert an environment variable string to the type of the setting."""
+    if key in ('use_mmap', 'use_mlock', 'compact_responses', 'coalesce_requests'):
+        return value.lower() in ('1', 'true', 'yes')
+    if value == '' or value.lower() == 'none':
+        return None
+    if key in ('speculative', 'draft_model_path'):
+        return value
+    if key == 'prefilter_threshold':
+        return float(value)
+    return int(value)
+
+def load_inference_config(path=None):
+    """
+    Load the llama inference parameters.
+
+    Defaults are overridden by the JSON config file, which is in turn
+    overridden by environment variables named after the settings
+    (COMB_N_THREADS, COMB_N_BATCH, COMB_USE_MLOCK, ...).
+
+    Args:
+        path: Config file to read (defaults to $COMB_CONFIG or comb_config.json)
+
+    Returns:
+        A dictionary of inference parameters
+    """
+    config = dict(DEFAULT_INFERENCE_CONFIG)
+
+    path = path or os.environ.get('COMB_CONFIG', DEFAULT_CONFIG_PATH)
+    if os.path.exists(path):
+        with open(path) as f:
+            file_config = json.load(f)
+        unknown = set(file_config) - set(DEFAULT_INFERENCE_CONFIG)
+        if unknown:
+            raise ValueError(f"Unknown settings in {path}: {', '.join(sorted(unknown))}")
+        config.update(file_config)
+
+    for key in DEFAULT_INFERENCE_CONFIG:
+        env_name = 'COMB_' + key.upper()
+        if env_name in os.environ:
+            config[key] = _parse_value(key, os.environ[env_name])
+
+    return config
+
+def save_inference_config(config, path=None):
+    """
+    Write inference parameters to the JSON config file.
+
+    Args:
+        config: Dictionary of inference parameters
+        path: Config file to write (defaults to $COMB_CONFIG or comb_config.json)
+    """
+    path = path or os.environ.get('COMB_CONFIG', DEFAULT_CONFIG_PATH)
+    with open(path, 'w') as f:
+        json.dump(config, f, indent=2)
+        f.write('\n')
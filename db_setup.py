@@ -1,8 +1,12 @@
 # db_setup.py
 
-from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, Text
+import hashlib
+import threading
+from datetime import datetime
+from sqlalchemy import create_engine, event, Column, Integer, String, Float, ForeignKey, Text, DateTime, Index, DDL
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm import relationship, sessionmaker, scoped_session
 
 # Create a base class for our models
 Base = declarative_base()
@@ -19,6 +23,9 @@ class COMBCategory(Base):
     - Motivation - Reflective
     """
     __tablename__ = 'comb_categories'
+    __table_args__ = (
+        Index('ix_comb_categories_name', 'name', unique=True),
+    )
     
     id = Column(Integer, primary_key=True)
     name = Column(String(100), nullable=False)
@@ -35,6 +42,9 @@ class Indicator(Base):
     They can be positive (suggesting inclusion) or negative (suggesting exclusion).
     """
     __tablename__ = 'indicators'
+    __table_args__ = (
+        Index('ix_indicators_natural_key', 'category_id', 'indicator_type', 'text', unique=True),
+    )
     
     id = Column(Integer, primary_key=True)
     category_id = Column(Integer, ForeignKey('comb_categories.id'), nullable=False)
@@ -49,6 +59,9 @@ class CodingExample(Base):
     Examples of coded text to guide the AI in its coding decisions.
     """
     __tablename__ = 'coding_examples'
+    __table_args__ = (
+        Index('ix_coding_examples_natural_key', 'category_id', 'text', unique=True),
+    )
     
     id = Column(Integer, primary_key=True)
     category_id = Column(Integer, ForeignKey('comb_categories.id'), nullable=False)
@@ -58,33 +71,280 @@ class CodingExample(Base):
     # Establish relationship with category
     category = relationship("COMBCategory", back_populates="examples")
 
+class AnalysisText(Base):
+    """
+    A distinct analyzed text, stored once however often it is analyzed.
+    """
+    __tablename__ = 'analysis_texts'
+    __table_args__ = (
+        Index('ix_analysis_texts_hash', 'text_hash', unique=True),
+    )
+    
+    id = Column(Integer, primary_key=True)
+    text_hash = Column(String(64), nullable=False)  # SHA-256 of the text
+    text = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    
+    # Establish relationship with the results
+    results = relationship("AnalysisResult", back_populates="text")
+    
+    @staticmethod
+    def hash_text(text):
+        """Content hash identifying a text."""
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+    
+    @classmethod
+    def get_or_create(cls, session, text):
+        """
+        Find the row of a text, adding it to the session if it's new.
+        
+        Returns:
+            The AnalysisText, flushed so that its id is set
+        """
+        text_hash = cls.hash_text(text)
+        row = session.query(cls).filter(cls.text_hash == text_hash).one_or_none()
+        if row is None:
+            row = cls(text_hash=text_hash, text=text)
+            session.add(row)
+            session.flush()
+        return row
+
 class AnalysisResult(Base):
     """
     Stores the results of AI analysis on transcript text.
     """
     __tablename__ = 'analysis_results'
+    __table_args__ = (
+        Index('ix_analysis_results_session', 'session_id'),
+        Index('ix_analysis_results_category_time', 'category_id', 'created_at'),
+        Index('ix_analysis_results_time', 'created_at'),
+        Index('ix_analysis_results_text', 'text_id'),
+    )
     
     id = Column(Integer, primary_key=True)
-    text_quote = Column(Text, nullable=False)
+    text_id = Column(Integer, ForeignKey('analysis_texts.id'), nullable=False)
     category_id = Column(Integer, ForeignKey('comb_categories.id'), nullable=False)
     confidence = Column(Float, nullable=False)
     session_id = Column(String(100), nullable=False)  # To group results from the same analysis session
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    taxonomy_version = Column(String(16), nullable=True)  # Taxonomy the analysis used, see taxonomy.py
     
-    # Establish relationship with category
+    # Establish relationships with the text and the category
+    text = relationship("AnalysisText", back_populates="results")
     category = relationship("COMBCategory", back_populates="results")
+    
+    @property
+    def text_quote(self):
+        """The analyzed text."""
+        return self.text.text
 
-# Create the database
-def setup_database():
-    # Create a SQLite database file in the current directory
-    engine = create_engine('sqlite:///comb_analyzer.db')
+class AnalysisSpan(Base):
+    """
+    A category found in one window of a long document, see documents.py.
+    The document-level results are stored as AnalysisResult rows of the same session.
+    """
+    __tablename__ = 'analysis_spans'
+    __table_args__ = (
+        Index('ix_analysis_spans_session', 'session_id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    session_id = Column(String(100), nullable=False)
+    start_char = Column(Integer, nullable=False)  # Character offsets of the window in the document
+    end_char = Column(Integer, nullable=False)
+    category_id = Column(Integer, ForeignKey('comb_categories.id'), nullable=False)
+    confidence = Column(Float, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+class TaxonomyRevision(Base):
+    """
+    Single-row counter bumped by triggers on every change to the taxonomy
+    tables, so running servers notice changes with one cheap query.
+    """
+    __tablename__ = 'taxonomy_revision'
+
+    id = Column(Integer, primary_key=True)
+    revision = Column(Integer, nullable=False, default=0)
+
+# Tables whose changes bump the taxonomy revision
+TAXONOMY_TABLES = ('comb_categories', 'indicators', 'coding_examples')
+
+def taxonomy_trigger_statements(table):
+    """SQLite triggers bumping the taxonomy revision on any change to a table."""
+    return [
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_{operation}_revision AFTER {operation.upper()} ON {table}
+            BEGIN UPDATE taxonomy_revision SET revision = revision + 1 WHERE id = 1; END"""
+        for operation in ('insert', 'update', 'delete')
+    ]
+
+# create_all doesn't know about triggers, so they are added with their tables.
+# Without them (other databases than SQLite) the counter row is left out, and
+# changes are detected by comparing the taxonomy's content instead
+event.listen(TaxonomyRevision.__table__, 'after_create',
+             DDL("INSERT INTO taxonomy_revision (id, revision) VALUES (1, 0)").execute_if(dialect='sqlite'))
+for _table in TAXONOMY_TABLES:
+    for _statement in taxonomy_trigger_statements(_table):
+        event.listen(Base.metadata.tables[_table], 'after_create', DDL(_statement).execute_if(dialect='sqlite'))
+
+class CategoryStat(Base):
+    """
+    Running totals of the results of one category, maintained by analytics.py.
+    """
+    __tablename__ = 'analytics_category_stats'
+
+    category_id = Column(Integer, ForeignKey('comb_categories.id'), primary_key=True)
+    result_count = Column(Integer, nullable=False, default=0)  # Analyses that found the category
+    top_count = Column(Integer, nullable=False, default=0)  # Analyses where it had the highest confidence
+    confidence_sum = Column(Float, nullable=False, default=0.0)
+
+class ConfidenceBucket(Base):
+    """
+    Number of results of a category per 10-point confidence bucket.
+    """
+    __tablename__ = 'analytics_confidence_buckets'
+
+    category_id = Column(Integer, ForeignKey('comb_categories.id'), primary_key=True)
+    bucket = Column(Integer, primary_key=True)  # Lower bound: 0, 10, ..., 90 (100 falls into 90)
+    result_count = Column(Integer, nullable=False, default=0)
+
+class CategoryPair(Base):
+    """
+    Number of analyses whose two most confident categories were this pair.
+    """
+    __tablename__ = 'analytics_category_pairs'
+
+    first_category_id = Column(Integer, ForeignKey('comb_categories.id'), primary_key=True)
+    second_category_id = Column(Integer, ForeignKey('comb_categories.id'), primary_key=True)
+    analysis_count = Column(Integer, nullable=False, default=0)
+
+class CachedResult(Base):
+    """
+    Persistent tier of the analysis result cache.
+    Keyed by a hash of the normalized text, prompt version and model file.
+    """
+    __tablename__ = 'analysis_cache'
+    
+    cache_key = Column(String(64), primary_key=True)
+    result_json = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+class AnalysisJob(Base):
+    """
+    A bulk analysis job over a whole transcript, processed in the background.
+    """
+    __tablename__ = 'analysis_jobs'
     
-    # Create all tables
-    Base.metadata.create_all(engine)
+    id = Column(String(36), primary_key=True)
+    status = Column(String(20), nullable=False, default='queued')  # 'queued', 'running' or 'completed'
+    source_format = Column(String(10), nullable=False)  # 'text', 'csv' or 'jsonl'
+    total_items = Column(Integer, nullable=False, default=0)
+    completed_items = Column(Integer, nullable=False, default=0)
+    failed_items = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
     
-    # Create a session factory
-    Session = sessionmaker(bind=engine)
+    # Establish relationship with the job's utterances
+    items = relationship("AnalysisJobItem", back_populates="job")
+
+class AnalysisJobItem(Base):
+    """
+    A single utterance of a bulk analysis job and its result.
+    """
+    __tablename__ = 'analysis_job_items'
+    __table_args__ = (
+        Index('ix_job_items_job_position', 'job_id', 'position'),
+        Index('ix_job_items_status', 'status', 'id'),
+    )
     
-    return Session()
+    id = Column(Integer, primary_key=True)
+    job_id = Column(String(36), ForeignKey('analysis_jobs.id'), nullable=False)
+    position = Column(Integer, nullable=False)  # Order of the utterance in the transcript
+    speaker = Column(String(100), nullable=True)
+    text = Column(Text, nullable=False)
+    status = Column(String(10), nullable=False, default='pending')  # 'pending', 'running', 'done' or 'failed'
+    result_json = Column(Text, nullable=True)
+    session_id = Column(String(100), nullable=True)
+    
+    # Establish relationship with the job
+    job = relationship("AnalysisJob", back_populates="items")
+
+DEFAULT_DATABASE_URL = 'sqlite:///comb_analyzer.db'
+
+# One engine (and connection pool) per database, shared by all session factories
+_engines = {}
+_engines_lock = threading.Lock()
+
+def _configure_sqlite_connection(dbapi_connection, connection_record):
+    """Set up each new SQLite connection for concurrent use."""
+    cursor = dbapi_connection.cursor()
+    # Write-ahead logging: readers don't block the writer and the writer doesn't block readers
+    cursor.execute('PRAGMA journal_mode=WAL')
+    # With WAL, syncing at checkpoints only is still safe against corruption
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    # Wait for a competing writer instead of failing with "database is locked"
+    cursor.execute('PRAGMA busy_timeout=30000')
+    cursor.close()
+
+def get_engine(database_url=DEFAULT_DATABASE_URL):
+    """
+    Return the pooled engine for a database, creating it and its tables on first use.
+    """
+    with _engines_lock:
+        engine = _engines.get(database_url)
+        if engine is not None:
+            return engine
+        
+        url = make_url(database_url)
+        options = {}
+        if url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:'):
+            # Pooled connections are handed to whichever thread needs one
+            options = {
+                'connect_args': {'check_same_thread': False, 'timeout': 30},
+                'pool_size': 10,
+                'max_overflow': 20
+            }
+        engine = create_engine(database_url, **options)
+        if url.get_backend_name() == 'sqlite':
+            event.listen(engine, 'connect', _configure_sqlite_connection)
+        
+        # Bring databases created by older versions up to date first, since
+        # create_all only adds missing tables and never changes existing ones
+        from migrations import migrate
+        migrate(engine)
+        
+        # Create all tables
+        Base.metadata.create_all(engine)
+        
+        _engines[database_url] = engine
+        return engine
+
+def reset_engines_after_fork():
+    """
+    Discard the pooled connections a forked child inherited, without closing
+    them, since the parent process still uses them. New connections are
+    opened on demand.
+    """
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose(close=False)
+
+def create_session_factory(database_url=DEFAULT_DATABASE_URL):
+    """
+    Create the tables if needed and return a session factory for the database.
+    """
+    return sessionmaker(bind=get_engine(database_url))
+
+# Create the database
+def setup_database(database_url=DEFAULT_DATABASE_URL):
+    """
+    Return a thread-scoped session for the database.
+    
+    The returned object behaves like a Session but gives each thread its
+    own session, so it can be shared by request threads. Call close() when
+    a thread is done with it to return the connection to the pool.
+    """
+    # Create a SQLite database file in the current directory
+    return scoped_session(create_session_factory(database_url))
 
 if __name__ == "__main__":
     # Set up the database when this script is run directly
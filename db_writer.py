@@ -0,0 +1,141 @@
+# db_writer.py
+
+import atexit
+import queue
+import threading
+import time
+import metrics
+
+class BatchWriter:
+    """
+    Background thread that applies database writes in batches.
+
+    Request threads hand their writes over with submit() and return
+    immediately. The writer applies everything queued so far in one
+    transaction, so many analyses finishing together cost a single commit,
+    and writes never block the request path. If a batch fails, its writes
+    are retried one by one so a single bad write doesn't lose the others.
+    Pending writes are flushed when the process exits.
+    """
+    def __init__(self, session_factory, max_batch=200, max_delay=0.05):
+        """
+        Start the writer thread.
+
+        Args:
+            session_factory: Callable returning a new Session for the writer thread
+            max_batch: Maximum number of writes committed together
+            max_delay: Seconds to wait for more writes before committing a batch
+        """
+        self.session_factory = session_factory
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._start()
+        atexit.register(self.close)
+
+    def _start(self):
+        """Create the queue and start the writer thread."""
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, operation):
+        """
+        Queue a write.
+
+        Args:
+            operation: Callable taking the writer's Session, e.g.
+                lambda session: session.add_all(rows). It must not commit.
+        """
+        if self._closed:
+            raise RuntimeError("The database writer is closed")
+        self._queue.put(operation)
+
+    def add_all(self, objects):
+        """Queue new ORM objects to be inserted."""
+        objects = list(objects)
+        if objects:
+            self.submit(lambda session: session.add_all(objects))
+
+    def flush(self, timeout=None):
+        """
+        Wait until every write queued so far is committed.
+
+        Returns:
+            True if the queue was drained, False if the timeout expired
+        """
+        if self._closed:
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout=30):
+        """Flush the pending writes and stop the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def reset_after_fork(self):
+        """
+        Restart the writer in a forked child process.
+
+        The thread doesn't survive a fork; writes queued before the fork
+        are left to the parent.
+        """
+        self._start()
+
+    def _run(self):
+        """Writer thread: collect queued writes into batches and commit them."""
+        session = self.session_factory()
+        stopping = False
+        while not stopping:
+            batch = []
+            waiters = []
+            item = self._queue.get()
+            deadline = time.monotonic() + self.max_delay
+            while True:
+                if item is None:
+                    stopping = True
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    batch.append(item)
+                if stopping or len(batch) >= self.max_batch:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+
+            if batch:
+                self._commit(session, batch)
+            for waiter in waiters:
+                waiter.set()
+        session.close()
+
+    def _commit(self, session, batch):
+        """Apply a batch of writes in one transaction, falling back to one transaction per write."""
+        start_time = time.perf_counter()
+        try:
+            for operation in batch:
+                operation(session)
+            session.commit()
+            metrics.DB_COMMIT_TIME.observe(time.perf_counter() - start_time)
+            metrics.DB_BATCH_SIZE.observe(len(batch))
+            return
+        except Exception as e:
+            session.rollback()
+            if len(batch) == 1:
+                print(f"Database write failed: {str(e)}")
+                return
+
+        for operation in batch:
+            try:
+                operation(session)
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                print(f"Database write failed: {str(e)}")
@@ -0,0 +1,175 @@
+# documents.py
+#
+# Splitting of long transcripts into windows that fit the model context, and
+# merging of the per-window results into a document-level result.
+
+import re
+from jobs import SPEAKER_PATTERN
+
+# Sentence ends, where a turn too long for one window is split
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+class Window:
+    """A span of the document analyzed in one model run."""
+    def __init__(self, start, end, speakers):
+        self.start = start          # Character offsets into the document
+        self.end = end
+        self.speakers = speakers    # Speakers with a turn in the window, in order
+
+    def text(self, document):
+        return document[self.start:self.end]
+
+def split_turns(text):
+    """
+    Split a document into the units windows are built from.
+
+    When lines carry "Speaker: " labels, a unit is one speaker turn and
+    unlabelled lines continue the previous turn; otherwise every non-empty
+    line is a unit.
+
+    Returns:
+        A list of (speaker, start, end) tuples with character offsets into text
+    """
+    lines = []
+    position = 0
+    for line in text.splitlines(keepends=True):
+        start = position
+        position += len(line)
+        content = line.rstrip()
+        if content.strip():
+            match = SPEAKER_PATTERN.match(content.strip())
+            lines.append((match.group(1) if match else None, start + len(line) - len(line.lstrip()),
+                          start + len(content)))
+
+    if not any(speaker for speaker, _, _ in lines):
+        return lines
+
+    turns = []
+    for speaker, start, end in lines:
+        if speaker is None and turns:
+            turns[-1] = (turns[-1][0], turns[-1][1], end)
+        else:
+            turns.append((speaker, start, end))
+    return turns
+
+def _split_long_unit(text, unit, count_tokens, max_tokens):
+    """Split a unit that doesn't fit in a window at sentence ends, or anywhere if a sentence is too long."""
+    speaker, start, end = unit
+    pieces = []
+    piece_start = start
+    piece_end = start
+    sentence_start = start
+    for match in list(SENTENCE_END.finditer(text, start, end)) + [None]:
+        sentence_end = match.start() if match else end
+        if piece_end > piece_start and count_tokens(text[piece_start:sentence_end]) > max_tokens:
+            pieces.append((speaker, piece_start, piece_end))
+            piece_start = sentence_start
+        piece_end = sentence_end
+        if match:
+            sentence_start = match.end()
+    pieces.append((speaker, piece_start, piece_end))
+
+    # A single sentence can still be too long; cut it into equal parts
+    result = []
+    for speaker, piece_start, piece_end in pieces:
+        tokens = count_tokens(text[piece_start:piece_end])
+        parts = -(-tokens // max_tokens)
+        if parts <= 1:
+            result.append((speaker, piece_start, piece_end))
+            continue
+        size = -(-(piece_end - piece_start) // parts)
+        for part_start in range(piece_start, piece_end, size):
+            result.append((speaker, part_start, min(piece_end, part_start + size)))
+    return result
+
+def build_windows(text, count_tokens, max_tokens, overlap_turns=1):
+    """
+    Split a document into overlapping windows of whole turns.
+
+    Turns are packed into a window until the next one would exceed the
+    token budget; the next window starts overlap_turns turns before the end
+    of the previous one, so an exchange split between windows is still
+    seen together once.
+
+    Args:
+        text: The document
+        count_tokens: Function returning the number of model tokens of a string
+        max_tokens: Token budget of a window's text
+        overlap_turns: Turns repeated at the start of the next window
+
+    Returns:
+        A list of Window objects
+    """
+    units = []
+    for unit in split_turns(text):
+        if count_tokens(text[unit[1]:unit[2]]) > max_tokens:
+            units.extend(_split_long_unit(text, unit, count_tokens, max_tokens))
+        else:
+            units.append(unit)
+    if not units:
+        return []
+    # The newline joining turns costs about one token
+    sizes = [count_tokens(text[start:end]) + 1 for _, start, end in units]
+
+    windows = []
+    first = 0
+    while True:
+        last = first
+        used = sizes[first]
+        while last + 1 < len(units) and used + sizes[last + 1] <= max_tokens:
+            last += 1
+            used += sizes[last]
+        speakers = []
+        for speaker, _, _ in units[first:last + 1]:
+            if speaker and speaker not in speakers:
+                speakers.append(speaker)
+        windows.append(Window(units[first][1], units[last][2], speakers))
+        if last + 1 >= len(units):
+            return windows
+        first = max(first + 1, last + 1 - overlap_turns)
+
+def merge_window_results(windows, window_results):
+    """
+    Combine the results of the windows into a document-level result.
+
+    A category's document confidence is the highest it reached in any
+    window, with the explanation from that window; categories are ranked by
+    how many windows found them, then by that confidence.
+
+    Args:
+        windows: The analyzed windows
+        window_results: The code_text results of each window, in the same order
+
+    Returns:
+        A dictionary with the document "categories" (each with the number of
+        "windows" that found it) and the per-window "spans" with their
+        character offsets, speakers and categories. When some windows
+        failed, "failed_windows" counts them; when all did, "error" says so
+    """
+    found = {}
+    spans = []
+    for window, results in zip(windows, window_results):
+        span = {"start": window.start, "end": window.end, "speakers": window.speakers,
+                "categories": results.get("categories", [])}
+        if "error" in results:
+            span["error"] = results["error"]
+        spans.append(span)
+
+        for category in span["categories"]:
+            entry = found.setdefault(category["category"], {
+                "category": category["category"], "confidence": 0, "explanation": "", "windows": 0
+            })
+            entry["windows"] += 1
+            if category.get("confidence", 0) > entry["confidence"]:
+                entry["confidence"] = category.get("confidence", 0)
+                entry["explanation"] = category.get("explanation", "")
+
+    categories = sorted(found.values(), key=lambda entry: (entry["windows"], entry["confidence"]), reverse=True)
+    merged = {"categories": categories, "spans": spans}
+    failed = sum(1 for span in spans if "error" in span)
+    if spans and failed == len(spans):
+        # Nothing was analyzed, which must not pass for a document without categories
+        merged["error"] = f"All {failed} windows failed: {spans[0]['error']}"
+    elif failed:
+        merged["failed_windows"] = failed
+    return merged
@@ -0,0 +1,80 @@
+# fewshot.py
+
+import math
+from collections import Counter
+from prefilter import tokenize, normalize
+
+class FewShotIndex:
+    """
+    In-memory TF-IDF index over the indicators and coding examples.
+
+    Instead of a fixed block with the first indicators and example of every
+    category, the prompt can then carry the entries nearest to the text
+    being coded, up to a token budget. Each entry's prompt line is
+    token-counted once when the index is built, so selecting entries for a
+    request only costs the similarity scoring.
+    """
+    def __init__(self, categories, indicators, examples, count_tokens):
+        """
+        Build the index.
+
+        Args:
+            categories, indicators, examples: The taxonomy as loaded by LlamaModelHandler
+            count_tokens: Function returning the number of model tokens of a string
+        """
+        self.entries = []
+        for category_id, category in categories.items():
+            for indicator in indicators.get(category_id, {}).get('positive', []):
+                self.entries.append({'text': indicator,
+                                     'line': f"- {category['name']} indicator: {indicator}\n"})
+            for example in examples.get(category_id, []):
+                self.entries.append({'text': example['text'],
+                                     'line': f"- {category['name']} example: \"{example['text']}\"\n"})
+
+        tokenized = [tokenize(entry['text']) for entry in self.entries]
+        document_frequency = Counter()
+        for terms in tokenized:
+            document_frequency.update(set(terms))
+        total = len(tokenized)
+        self.idf = {term: math.log((1 + total) / (1 + count)) + 1 for term, count in document_frequency.items()}
+
+        # Inverted index: term -> [(entry index, weight)], so scoring only touches entries sharing a term
+        self.postings = {}
+        for index, (entry, terms) in enumerate(zip(self.entries, tokenized)):
+            entry['tokens'] = count_tokens(entry['line'])
+            for term, weight in self._vectorize(terms).items():
+                self.postings.setdefault(term, []).append((index, weight))
+
+    def _vectorize(self, terms):
+        """Unit-length TF-IDF vector of a list of terms; unknown terms are ignored."""
+        counts = Counter(term for term in terms if term in self.idf)
+        return normalize({term: count * self.idf[term] for term, count in counts.items()})
+
+    def select(self, text, token_budget, max_entries):
+        """
+        Pick the entries most similar to a text.
+
+        Args:
+            text: The text being coded
+            token_budget: Maximum number of prompt tokens of the selected lines
+            max_entries: Maximum number of entries
+
+        Returns:
+            The prompt lines of the selected entries, most similar first
+        """
+        scores = Counter()
+        for term, weight in self._vectorize(tokenize(text)).items():
+            for index, entry_weight in self.postings.get(term, ()):
+                scores[index] += weight * entry_weight
+
+        lines = []
+        remaining = token_budget
+        for index, _ in scores.most_common():
+            if len(lines) >= max_entries:
+                break
+            entry = self.entries[index]
+            # Skip entries that don't fit; a shorter, less similar one still might
+            if entry['tokens'] <= remaining:
+                lines.append(entry['line'])
+                remaining -= entry['tokens']
+        return lines
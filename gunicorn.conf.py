@@ -0,0 +1,46 @@
+# gunicorn.conf.py
+#
+# Run with: gunicorn -c gunicorn.conf.py app:app
+#
+# With COMB_PRELOAD=1 the app is imported and the model loaded and warmed up
+# once in the master process before the workers are forked. The weights are
+# mmap'd, so the forked workers share the same physical pages instead of each
+# loading a private copy, and every worker is ready as soon as it starts.
+# Preloading applies to the in-process model; leave it off together with
+# COMB_WORKERS or COMB_BATCH_SEQUENCES, whose processes and threads cannot be
+# carried across a fork.
+
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '127.0.0.1:5000')
+workers = int(os.environ.get('GUNICORN_WORKERS', '2'))
+threads = int(os.environ.get('GUNICORN_THREADS', '4'))
+
+# Analyses of long texts can take minutes on CPU
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '300'))
+
+preload_app = os.environ.get('COMB_PRELOAD', '0').lower() in ('1', 'true', 'yes')
+
+def on_starting(server):
+    """Runs once in the master before any worker is forked."""
+    import app
+
+    # Requeue job items interrupted by the previous run here, once, rather
+    # than in each worker where it would steal items from the others
+    app.JobManager(app.get_model_handler).requeue_interrupted()
+
+    if preload_app:
+        app.warm_up_model()
+
+def post_fork(server, worker):
+    """Runs in each worker right after it is forked from the master."""
+    import app
+
+    app.reset_after_fork()
+    app.start_background_services(requeue_jobs=False)
+
+def worker_exit(server, worker):
+    """Runs in each worker just before it exits."""
+    import app
+
+    app.shutdown_services()
@@ -0,0 +1,236 @@
+# history.py
+
+import base64
+import json
+from datetime import datetime
+from sqlalchemy import and_, func, or_
+from db_setup import (DEFAULT_DATABASE_URL, create_session_factory, AnalysisResult, AnalysisSpan, AnalysisText,
+                      COMBCategory)
+
+# Characters of the analyzed text included in list items
+PREVIEW_CHARS = 80
+# Largest page a client can ask for
+MAX_PAGE_SIZE = 100
+
+def encode_cursor(created_at, result_id):
+    """Opaque cursor pointing just after the result row (created_at, id)."""
+    position = json.dumps([created_at.isoformat(), result_id])
+    return base64.urlsafe_b64encode(position.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """
+    Read a cursor produced by encode_cursor.
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        created_at, result_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return datetime.fromisoformat(created_at), int(result_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+class AnalysisHistory:
+    """
+    Read access to past analyses stored in analysis_results.
+
+    An analysis is the group of result rows sharing a session_id; they are
+    written together, so they share created_at and sit next to each other
+    in (created_at, id) order. Pages are read with keyset pagination on that
+    order, which uses the created_at indexes and costs the same however far
+    back the page is, unlike OFFSET.
+    """
+    def __init__(self, database_url=DEFAULT_DATABASE_URL):
+        """
+        Initialize the history reader.
+
+        Args:
+            database_url: Database to read
+        """
+        self.Session = create_session_factory(database_url)
+
+    def resolve_category(self, category):
+        """
+        Find a category by id or name.
+
+        Returns:
+            The category id
+
+        Raises:
+            ValueError: If there is no such category
+        """
+        session = self.Session()
+        try:
+            query = session.query(COMBCategory.id)
+            if str(category).isdigit():
+                row = query.filter(COMBCategory.id == int(category)).one_or_none()
+            else:
+                row = query.filter(COMBCategory.name == category).one_or_none()
+            if row is None:
+                raise ValueError(f"Unknown category: {category}")
+            return row.id
+        finally:
+            session.close()
+
+    def categories(self):
+        """
+        The categories of the taxonomy, e.g. to filter the history by.
+
+        Returns:
+            A list of {"id", "name"} dictionaries in id order
+        """
+        session = self.Session()
+        try:
+            rows = session.query(COMBCategory.id, COMBCategory.name).order_by(COMBCategory.id)
+            return [{'id': category_id, 'name': name} for category_id, name in rows]
+        finally:
+            session.close()
+
+    def list_page(self, limit=20, cursor=None, category_id=None, min_confidence=None):
+        """
+        Return a page of analyses, newest first.
+
+        Items only carry a short preview of the text and the category
+        names with their confidence; the full text is fetched with get().
+
+        Args:
+            limit: Number of analyses on the page (at most MAX_PAGE_SIZE)
+            cursor: next_cursor of the previous page, or None for the first page
+            category_id: Only analyses that found this category
+            min_confidence: Only analyses with a category (the filtered one, if
+                given) at or above this confidence
+
+        Returns:
+            A dictionary with the page `items` and the `next_cursor`
+            (None on the last page)
+        """
+        limit = max(1, min(MAX_PAGE_SIZE, limit))
+        position = decode_cursor(cursor) if cursor else None
+        session = self.Session()
+        try:
+            session_ids, next_position = self._page_sessions(session, limit, position, category_id, min_confidence)
+            items = self._load_items(session, session_ids)
+        finally:
+            session.close()
+
+        return {
+            'items': items,
+            'next_cursor': encode_cursor(*next_position) if next_position else None
+        }
+
+    def _page_sessions(self, session, limit, position, category_id, min_confidence):
+        """
+        Find the session ids of a page.
+
+        Walks the matching result rows in (created_at, id) descending order,
+        in chunks, until it has seen limit + 1 analyses; the extra one only
+        tells whether there is a next page.
+
+        Returns:
+            The session ids in order, and the position to continue from (or None)
+        """
+        query = session.query(AnalysisResult.id, AnalysisResult.session_id, AnalysisResult.created_at)
+        if category_id is not None:
+            query = query.filter(AnalysisResult.category_id == category_id)
+        if min_confidence is not None:
+            query = query.filter(AnalysisResult.confidence >= min_confidence)
+        query = query.order_by(AnalysisResult.created_at.desc(), AnalysisResult.id.desc())
+
+        session_ids = []
+        # Position of the last row of the last analysis on the page
+        last_row = None
+        chunk_size = limit * 4
+        while True:
+            chunk = query
+            if position is not None:
+                created_at, result_id = position
+                # The redundant <= bound lets SQLite seek into the created_at index
+                chunk = chunk.filter(AnalysisResult.created_at <= created_at, or_(
+                    AnalysisResult.created_at < created_at,
+                    and_(AnalysisResult.created_at == created_at, AnalysisResult.id < result_id)
+                ))
+            rows = chunk.limit(chunk_size).all()
+            for row in rows:
+                if not session_ids or row.session_id != session_ids[-1]:
+                    if len(session_ids) == limit:
+                        # Another analysis follows the page
+                        return session_ids, last_row
+                    session_ids.append(row.session_id)
+                last_row = (row.created_at, row.id)
+            if len(rows) < chunk_size:
+                return session_ids, None
+            position = last_row
+
+    def _load_items(self, session, session_ids):
+        """Build the list items of the given analyses, in the given order."""
+        if not session_ids:
+            return []
+        rows = session.query(
+            AnalysisResult.session_id,
+            AnalysisResult.created_at,
+            AnalysisResult.confidence,
+            COMBCategory.name,
+            func.substr(AnalysisText.text, 1, PREVIEW_CHARS).label('preview'),
+            func.length(AnalysisText.text).label('text_chars')
+        ).join(COMBCategory, COMBCategory.id == AnalysisResult.category_id
+        ).join(AnalysisText, AnalysisText.id == AnalysisResult.text_id
+        ).filter(AnalysisResult.session_id.in_(session_ids)).all()
+
+        items = {}
+        for row in rows:
+            item = items.get(row.session_id)
+            if item is None:
+                item = items[row.session_id] = {
+                    'session_id': row.session_id,
+                    'created_at': row.created_at.isoformat(),
+                    'preview': row.preview,
+                    'text_chars': row.text_chars,
+                    'categories': []
+                }
+            item['categories'].append({'category': row.name, 'confidence': row.confidence})
+
+        for item in items.values():
+            item['categories'].sort(key=lambda category: category['confidence'], reverse=True)
+        return [items[session_id] for session_id in session_ids if session_id in items]
+
+    def get(self, session_id):
+        """
+        Return one analysis with its full text.
+
+        Returns:
+            A dictionary with the text, the time, the categories and the
+            taxonomy version they were coded with (plus the per-window spans
+            of a long document), or None if there is no such analysis
+        """
+        session = self.Session()
+        try:
+            rows = session.query(AnalysisResult, COMBCategory.name).join(
+                COMBCategory, COMBCategory.id == AnalysisResult.category_id
+            ).filter(AnalysisResult.session_id == session_id).all()
+            if not rows:
+                return None
+
+            first = rows[0][0]
+            categories = [{'category': name, 'confidence': result.confidence} for result, name in rows]
+            categories.sort(key=lambda category: category['confidence'], reverse=True)
+            item = {
+                'session_id': session_id,
+                'created_at': first.created_at.isoformat(),
+                'text': first.text_quote,
+                'categories': categories,
+                'taxonomy_version': first.taxonomy_version
+            }
+
+            span_rows = session.query(AnalysisSpan, COMBCategory.name).join(
+                COMBCategory, COMBCategory.id == AnalysisSpan.category_id
+            ).filter(AnalysisSpan.session_id == session_id).order_by(AnalysisSpan.start_char, AnalysisSpan.id).all()
+            if span_rows:
+                spans = {}
+                for span, name in span_rows:
+                    spans.setdefault((span.start_char, span.end_char), []).append(
+                        {'category': name, 'confidence': span.confidence})
+                item['spans'] = [{'start': start, 'end': end, 'categories': span_categories}
+                                 for (start, end), span_categories in spans.items()]
+            return item
+        finally:
+            session.close()
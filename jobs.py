@@ -0,0 +1,284 @@
+# jobs.py
+
+import csv
+import io
+import json
+import re
+import threading
+import time
+import uuid
+from datetime import datetime
+from sqlalchemy import update
+from db_setup import create_session_factory, AnalysisJob, AnalysisJobItem
+from worker_pool import PoolFullError
+
+# "Interviewer: text" style speaker labels at the start of a line
+SPEAKER_PATTERN = re.compile(r"^([A-Z][\w .'-]{0,40}):\s+(.*)$")
+
+def split_transcript(content, source_format):
+    """
+    Split a transcript into utterances.
+
+    Plain text is split into one utterance per line, with an optional
+    "Speaker: " label. CSV needs a "text" column and JSONL objects need a
+    "text" key; both may carry a "speaker". JSONL lines may also be plain
+    JSON strings.
+
+    Args:
+        content: The transcript as a string
+        source_format: 'text', 'csv' or 'jsonl'
+
+    Returns:
+        A list of (speaker, text) tuples
+
+    Raises:
+        ValueError: If the transcript cannot be parsed
+    """
+    utterances = []
+
+    if source_format == 'csv':
+        reader = csv.DictReader(io.StringIO(content))
+        if not reader.fieldnames or 'text' not in reader.fieldnames:
+            raise ValueError("CSV transcripts need a 'text' column")
+        for row in reader:
+            utterances.append((row.get('speaker') or None, row['text']))
+    elif source_format == 'jsonl':
+        for line_number, line in enumerate(content.splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                raise ValueError(f"Invalid JSON on line {line_number}")
+            if isinstance(record, str):
+                utterances.append((None, record))
+            elif isinstance(record, dict) and 'text' in record:
+                utterances.append((record.get('speaker'), record['text']))
+            else:
+                raise ValueError(f"Line {line_number} has no 'text' field")
+    elif source_format == 'text':
+        for line in content.splitlines():
+            match = SPEAKER_PATTERN.match(line.strip())
+            if match:
+                utterances.append((match.group(1), match.group(2)))
+            else:
+                utterances.append((None, line))
+    else:
+        raise ValueError(f"Unsupported transcript format: {source_format}")
+
+    return [(speaker, text.strip()) for speaker, text in utterances if text and text.strip()]
+
+class JobManager:
+    """
+    Persists bulk analysis jobs and processes their items in background threads.
+
+    Items are claimed one at a time with a conditional update, so a
+    completed item is never processed twice. Items left running by a
+    previous process are put back in the queue on start-up, which makes
+    jobs resume after a restart.
+    """
+    def __init__(self, get_handler, num_workers=1, poll_interval=2.0):
+        """
+        Initialize the job manager.
+
+        Args:
+            get_handler: Callable returning the object whose code_text analyzes each item
+            num_workers: Number of background threads processing items
+            poll_interval: Seconds to wait between checks when the queue is empty
+        """
+        self.get_handler = get_handler
+        self.num_workers = num_workers
+        self.poll_interval = poll_interval
+        self.Session = create_session_factory()
+        self._wakeup = threading.Event()
+        self._threads = []
+
+    def requeue_interrupted(self):
+        """Put items left running by a stopped process back in the queue."""
+        session = self.Session()
+        try:
+            session.execute(
+                update(AnalysisJobItem)
+                .where(AnalysisJobItem.status == 'running')
+                .values(status='pending')
+            )
+            session.commit()
+        finally:
+            session.close()
+
+    def start(self, requeue=True):
+        """
+        Start the worker threads.
+
+        Args:
+            requeue: Requeue interrupted items first. Leave this off when other
+                processes may be working on the same database.
+        """
+        if requeue:
+            self.requeue_interrupted()
+
+        for _ in range(self.num_workers):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def create_job(self, content, source_format):
+        """
+        Split a transcript and persist it as a new job.
+
+        Args:
+            content: The transcript as a string
+            source_format: 'text', 'csv' or 'jsonl'
+
+        Returns:
+            The new job's ID and number of items
+
+        Raises:
+            ValueError: If the transcript is invalid or empty
+        """
+        utterances = split_transcript(content, source_format)
+        if not utterances:
+            raise ValueError("The transcript contains no utterances")
+
+        job_id = str(uuid.uuid4())
+        session = self.Session()
+        try:
+            session.add(AnalysisJob(id=job_id, source_format=source_format,
+                                    total_items=len(utterances)))
+            session.add_all([
+                AnalysisJobItem(job_id=job_id, position=position, speaker=speaker, text=text)
+                for position, (speaker, text) in enumerate(utterances)
+            ])
+            session.commit()
+        finally:
+            session.close()
+
+        self._wakeup.set()
+        return job_id, len(utterances)
+
+    def get_job(self, job_id, page=1, per_page=50):
+        """
+        Report a job's progress and one page of its items.
+
+        Args:
+            job_id: The job ID
+            page: 1-based page number
+            per_page: Items per page
+
+        Returns:
+            A JSON-serializable dictionary, or None if the job does not exist
+        """
+        session = self.Session()
+        try:
+            job = session.get(AnalysisJob, job_id)
+            if job is None:
+                return None
+
+            items = session.query(AnalysisJobItem).filter(
+                AnalysisJobItem.job_id == job_id
+            ).order_by(AnalysisJobItem.position).offset((page - 1) * per_page).limit(per_page).all()
+
+            processed = job.completed_items + job.failed_items
+            return {
+                'job_id': job.id,
+                'status': job.status,
+                'format': job.source_format,
+                'total_items': job.total_items,
+                'completed_items': job.completed_items,
+                'failed_items': job.failed_items,
+                'progress': round(processed / job.total_items, 4) if job.total_items else 1.0,
+                'created_at': job.created_at.isoformat(),
+                'updated_at': job.updated_at.isoformat(),
+                'page': page,
+                'per_page': per_page,
+                'items': [{
+                    'position': item.position,
+                    'speaker': item.speaker,
+                    'text': item.text,
+                    'status': item.status,
+                    'session_id': item.session_id,
+                    'result': json.loads(item.result_json) if item.result_json else None
+                } for item in items]
+            }
+        finally:
+            session.close()
+
+    def _work(self):
+        """Worker thread: claim and process pending items until the process exits."""
+        session = self.Session()
+        while True:
+            try:
+                item = self._claim_item(session)
+                if item is None:
+                    self._wakeup.wait(self.poll_interval)
+                    self._wakeup.clear()
+                    continue
+                self._process_item(session, item)
+            except Exception as e:
+                print(f"Job worker error: {str(e)}")
+                session.rollback()
+                time.sleep(self.poll_interval)
+
+    def _claim_item(self, session):
+        """
+        Atomically mark the oldest pending item as running.
+
+        Returns:
+            The claimed item, or None if there is nothing to do
+        """
+        while True:
+            item_id = session.query(AnalysisJobItem.id).filter(
+                AnalysisJobItem.status == 'pending'
+            ).order_by(AnalysisJobItem.id).limit(1).scalar()
+            if item_id is None:
+                session.commit()
+                return None
+
+            # Only one worker can move the item out of 'pending'
+            claimed = session.execute(
+                update(AnalysisJobItem)
+                .where(AnalysisJobItem.id == item_id, AnalysisJobItem.status == 'pending')
+                .values(status='running')
+            ).rowcount
+            session.commit()
+            if claimed:
+                item = session.get(AnalysisJobItem, item_id)
+                job = session.get(AnalysisJob, item.job_id)
+                if job.status == 'queued':
+                    job.status = 'running'
+                    job.updated_at = datetime.utcnow()
+                    session.commit()
+                return item
+
+    def _process_item(self, session, item):
+        """Analyze an item and record its result together with the job's progress."""
+        while True:
+            try:
+                results = self.get_handler().code_text(item.text)
+                break
+            except PoolFullError as e:
+                # Leave room for interactive requests and try again later
+                time.sleep(e.retry_after)
+            except Exception as e:
+                results = {'error': f'Error analyzing text: {str(e)}'}
+                break
+
+        failed = 'error' in results
+        item.status = 'failed' if failed else 'done'
+        item.result_json = json.dumps(results)
+        item.session_id = results.get('session_id')
+
+        # Increment the counters in SQL so concurrent workers don't lose updates
+        counter = AnalysisJob.failed_items if failed else AnalysisJob.completed_items
+        session.execute(
+            update(AnalysisJob)
+            .where(AnalysisJob.id == item.job_id)
+            .values({counter: counter + 1, AnalysisJob.updated_at: datetime.utcnow()})
+        )
+        session.execute(
+            update(AnalysisJob)
+            .where(AnalysisJob.id == item.job_id,
+                   AnalysisJob.completed_items + AnalysisJob.failed_items >= AnalysisJob.total_items)
+            .values(status='completed')
+        )
+        session.commit()
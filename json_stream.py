@@ -0,0 +1,105 @@
+# json_stream.py
+
+import json
+
+class JSONObjectScanner:
+    """
+    Incrementally scans generated text for complete top-level JSON objects.
+
+    Text is fed in chunks as the model produces it. Braces inside JSON
+    strings are ignored, so an object is reported as soon as its closing
+    brace arrives and generation can be stopped right away.
+    """
+    def __init__(self):
+        self._buffer = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, chunk):
+        """
+        Feed the next chunk of generated text.
+
+        Args:
+            chunk: Newly generated text
+
+        Returns:
+            A list of complete top-level object strings closed in this chunk
+        """
+        objects = []
+        for char in chunk:
+            if self._depth == 0:
+                # Skip any text between objects
+                if char == '{':
+                    self._buffer = [char]
+                    self._depth = 1
+                continue
+
+            self._buffer.append(char)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == '{':
+                self._depth += 1
+            elif char == '}':
+                self._depth -= 1
+                if self._depth == 0:
+                    objects.append(''.join(self._buffer))
+                    self._buffer = []
+        return objects
+
+def parse_categories_object(json_str):
+    """
+    Parse a JSON object string and check it has the expected structure.
+
+    Args:
+        json_str: A complete JSON object string
+
+    Returns:
+        The parsed dictionary, or None if it is invalid or has no "categories" list
+    """
+    try:
+        results = json.loads(json_str)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(results, dict) or not isinstance(results.get("categories"), list):
+        return None
+    return results
+
+def parse_compact_object(json_str, names_by_code):
+    """
+    Parse a compact response, {"c": [["CODE", confidence, "reason"], ...]},
+    into the full {"categories": [...]} structure.
+
+    Args:
+        json_str: A complete JSON object string
+        names_by_code: Dictionary of category code to category name
+
+    Returns:
+        The results dictionary with category names, explanations (empty when
+        the reason was left out) and confidences, or None if the object is
+        invalid or uses an unknown code
+    """
+    try:
+        compact = json.loads(json_str)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(compact, dict) or not isinstance(compact.get("c"), list):
+        return None
+
+    categories = []
+    for item in compact["c"]:
+        if not isinstance(item, list) or len(item) < 2 or item[0] not in names_by_code:
+            return None
+        categories.append({
+            "category": names_by_code[item[0]],
+            "explanation": str(item[2]) if len(item) > 2 else "",
+            "confidence": item[1]
+        })
+    return {"categories": categories}
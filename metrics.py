@@ -0,0 +1,326 @@
+# metrics.py
+#
+# A small in-process metrics registry exposed in the Prometheus text format
+# (https://prometheus.io/docs/instrumenting/exposition_formats/), so the
+# /metrics endpoint can be scraped without running any extra service.
+
+import math
+import threading
+
+# Latency buckets in seconds, from a cache hit to a long analysis on CPU
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160)
+# Decode speed buckets in tokens per second
+RATE_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 200, 500)
+
+def _format_value(value):
+    """Format a sample value the way Prometheus expects."""
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and math.isnan(value):
+        return "NaN"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+def _format_labels(labels):
+    """Format a label set as {name="value",...}."""
+    if not labels:
+        return ""
+    escaped = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+class _Metric:
+    """Base class of all metric types: a family of children, one per label combination."""
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+        if not self.labelnames:
+            # Unlabelled metrics are reported from the start, even before their first update
+            self.labels()
+        if registry is None:
+            registry = REGISTRY
+        registry.register(self)
+
+    def labels(self, **labels):
+        """Return the child metric for the given label values."""
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            child = self._children.get(key)
+            if child is None:
+                child = self._children[key] = self._new_child()
+            return child
+
+    def _default_child(self):
+        """The child of an unlabelled metric."""
+        if self.labelnames:
+            raise ValueError(f"{self.name} needs labels {self.labelnames}")
+        return self.labels()
+
+    def collect(self):
+        """
+        Render the metric family.
+
+        Returns:
+            A list of lines in the Prometheus text format
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        with self._lock:
+            children = list(self._children.items())
+        for key, child in children:
+            labels = list(zip(self.labelnames, key))
+            lines.extend(child.samples(self.name, labels))
+        return lines
+
+class _CounterChild:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        if amount < 0:
+            raise ValueError("Counters can only increase")
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        return [f"{name}{_format_labels(labels)} {_format_value(self.value)}"]
+
+class Counter(_Metric):
+    """A value that only goes up, such as a number of tokens."""
+    metric_type = "counter"
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        if not name.endswith("_total"):
+            name += "_total"
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default_child().inc(amount)
+
+class _GaugeChild:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+        self.function = None
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        """Compute the value with a callback at collection time."""
+        self.function = function
+
+    def samples(self, name, labels):
+        value = self.value
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception:
+                value = math.nan
+        return [f"{name}{_format_labels(labels)} {_format_value(value)}"]
+
+class Gauge(_Metric):
+    """A value that can go up and down, such as a queue depth."""
+    metric_type = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._default_child().set(value)
+
+    def inc(self, amount=1):
+        self._default_child().inc(amount)
+
+    def dec(self, amount=1):
+        self._default_child().dec(amount)
+
+    def set_function(self, function):
+        self._default_child().set_function(function)
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f"{name}_bucket{_format_labels(labels + [('le', _format_value(float(bound)))])} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return lines
+
+class Histogram(_Metric):
+    """Observations counted in cumulative buckets, such as request latencies."""
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+        # The +Inf bucket is always present
+        self.buckets = tuple(sorted(float(bound) for bound in buckets if bound != math.inf)) + (math.inf,)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default_child().observe(value)
+
+class Registry:
+    """Collection of metrics rendered together."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+
+    def render(self):
+        """
+        Render every metric in the Prometheus text exposition format.
+
+        Returns:
+            The metrics page as a string
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+# Content type of the text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Metrics of the analysis path
+REQUEST_LATENCY = Histogram(
+    "comb_request_duration_seconds", "End-to-end latency of analysis requests.", ["endpoint"])
+ANALYSIS_LATENCY = Histogram(
+    "comb_analysis_duration_seconds", "Time spent coding one text, by result cache outcome.", ["cache"])
+PROMPT_EVAL_TIME = Histogram(
+    "comb_prompt_eval_seconds", "Time to evaluate the prompt up to the first generated token.")
+DECODE_TIME = Histogram(
+    "comb_decode_seconds", "Time spent generating tokens after the first one.")
+DECODE_RATE = Histogram(
+    "comb_decode_tokens_per_second", "Generation speed of each analysis.", buckets=RATE_BUCKETS)
+LOCK_WAIT_TIME = Histogram(
+    "comb_model_wait_seconds", "Time spent waiting for the model to become free.")
+STORE_TIME = Histogram(
+    "comb_store_results_seconds", "Time to hand an analysis' results over to the database writer.")
+DB_COMMIT_TIME = Histogram(
+    "comb_db_commit_seconds", "Time the background database writer takes to apply and commit a batch.")
+DB_BATCH_SIZE = Histogram(
+    "comb_db_batch_size", "Writes committed together by the background database writer.",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200))
+PROMPT_TOKENS = Counter(
+    "comb_prompt_tokens", "Prompt tokens of analyzed texts, by whether they came from the prefix cache.",
+    ["source"])
+GENERATED_TOKENS = Counter(
+    "comb_generated_tokens", "Tokens generated by the model.")
+SPECULATIVE_TOKENS = Counter(
+    "comb_speculative_tokens", "Tokens proposed by the speculative drafter, by whether the model accepted them.",
+    ["outcome"])
+ANALYSES = Counter(
+    "comb_analyses", "Analyses by outcome and result cache status.", ["status", "cache"])
+ANALYSIS_TIERS = Counter(
+    "comb_analysis_tier", "Analyses by the tier that answered them (cache, prefilter or llm).", ["tier"])
+COALESCED_ANALYSES = Counter(
+    "comb_coalesced_analyses",
+    "Analyses shared by concurrent identical requests: followers that waited for another request's "
+    "analysis, and leaders whose analysis was shared.", ["role"])
+EXTRACTION_FAILURES = Counter(
+    "comb_json_extraction_failures", "Model responses without a usable JSON result, by reason.", ["reason"])
+QUEUE_DEPTH = Gauge(
+    "comb_queue_depth", "Requests waiting for the model.")
+MODEL_LOAD_TIME = Gauge(
+    "comb_model_load_seconds", "Time it took to load the model.")
+MODEL_READY = Gauge(
+    "comb_model_ready", "1 once the model is loaded and warmed up.")
+
+def record_analysis(trace, results):
+    """
+    Record the metrics of one analysis from its trace.
+
+    Args:
+        trace: Trace dictionary filled in by LlamaModelHandler.stream_code_text
+        results: The analysis results
+    """
+    if not trace:
+        return
+    phases = trace.get("phases", {})
+    cache = results.get("cache", "none")
+    status = "error" if "error" in results else "ok"
+    ANALYSES.labels(status=status, cache=cache).inc()
+    ANALYSIS_LATENCY.labels(cache=cache).observe(sum(phases.values()))
+    if "tier" in results:
+        ANALYSIS_TIERS.labels(tier=results["tier"]).inc()
+
+    if trace.get("extraction_failure"):
+        EXTRACTION_FAILURES.labels(reason=trace["extraction_failure"]).inc()
+
+    if "prompt_eval" not in phases:
+        # Served from the result cache, the model wasn't involved
+        return
+    PROMPT_EVAL_TIME.observe(phases["prompt_eval"])
+    DECODE_TIME.observe(phases["decode"])
+    if "lock_wait" in phases:
+        LOCK_WAIT_TIME.observe(phases["lock_wait"])
+    if "store" in phases:
+        STORE_TIME.observe(phases["store"])
+
+    cached = trace.get("cached_prompt_tokens", 0)
+    PROMPT_TOKENS.labels(source="cached").inc(cached)
+    PROMPT_TOKENS.labels(source="evaluated").inc(max(0, trace.get("prompt_tokens", 0) - cached))
+    generated = trace.get("generated_tokens", 0)
+    GENERATED_TOKENS.inc(generated)
+    if generated > 1 and phases["decode"] > 0:
+        # The first token is produced by the prompt evaluation
+        DECODE_RATE.observe((generated - 1) / phases["decode"])
+
+    if trace.get("draft_tokens"):
+        SPECULATIVE_TOKENS.labels(outcome="accepted").inc(trace["accepted_tokens"])
+        SPECULATIVE_TOKENS.labels(outcome="rejected").inc(trace["draft_tokens"] - trace["accepted_tokens"])
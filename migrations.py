@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+"""
+Schema migrations for databases created by earlier versions of the app.
+
+The schema version of a SQLite database is kept in its user_version pragma.
+Pending migrations are applied automatically when the app first opens the
+database (see db_setup.get_engine), after a backup copy of the file has been
+made. They can also be run ahead of a deployment:
+
+    python migrations.py [path/to/comb_analyzer.db]
+"""
+import hashlib
+import os
+import shutil
+import sys
+from datetime import datetime
+from sqlalchemy import create_engine
+
+def _table_columns(connection, table):
+    """Column names of a table (empty if the table doesn't exist)."""
+    return [row[1] for row in connection.exec_driver_sql(f"PRAGMA table_info({table})")]
+
+def _normalize_analysis_texts(connection):
+    """
+    Store each distinct text once in analysis_texts, make analysis_results
+    reference it, and add created_at and the query indexes.
+
+    The original analysis times were never recorded, so existing rows get
+    the time of the migration.
+    """
+    if 'text_quote' not in _table_columns(connection, 'analysis_results'):
+        # A new database; create_all builds the current layout
+        return
+
+    now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')
+    connection.connection.dbapi_connection.create_function(
+        'sha256_hex', 1, lambda text: hashlib.sha256(text.encode('utf-8')).hexdigest(), deterministic=True
+    )
+
+    statements = [
+        ("""CREATE TABLE IF NOT EXISTS analysis_texts (
+                id INTEGER NOT NULL PRIMARY KEY,
+                text_hash VARCHAR(64) NOT NULL,
+                text TEXT NOT NULL,
+                created_at DATETIME NOT NULL)""", ()),
+        ("CREATE UNIQUE INDEX IF NOT EXISTS ix_analysis_texts_hash ON analysis_texts (text_hash)", ()),
+        ("""INSERT OR IGNORE INTO analysis_texts (text_hash, text, created_at)
+            SELECT sha256_hex(text_quote), text_quote, ? FROM analysis_results ORDER BY id""", (now,)),
+        ("""CREATE TABLE analysis_results_new (
+                id INTEGER NOT NULL PRIMARY KEY,
+                text_id INTEGER NOT NULL REFERENCES analysis_texts (id),
+                category_id INTEGER NOT NULL REFERENCES comb_categories (id),
+                confidence FLOAT NOT NULL,
+                session_id VARCHAR(100) NOT NULL,
+                created_at DATETIME NOT NULL)""", ()),
+        ("""INSERT INTO analysis_results_new (id, text_id, category_id, confidence, session_id, created_at)
+            SELECT r.id, t.id, r.category_id, r.confidence, r.session_id, ?
+            FROM analysis_results r JOIN analysis_texts t ON t.text_hash = sha256_hex(r.text_quote)""", (now,)),
+        ("DROP TABLE analysis_results", ()),
+        ("ALTER TABLE analysis_results_new RENAME TO analysis_results", ()),
+        ("CREATE INDEX ix_analysis_results_session ON analysis_results (session_id)", ()),
+        ("CREATE INDEX ix_analysis_results_category_time ON analysis_results (category_id, created_at)", ()),
+        ("CREATE INDEX ix_analysis_results_time ON analysis_results (created_at)", ()),
+        ("CREATE INDEX ix_analysis_results_text ON analysis_results (text_id)", ()),
+    ]
+    for statement, parameters in statements:
+        connection.exec_driver_sql(statement, parameters)
+
+def _build_analytics_tables(connection):
+    """Create the analytics summary tables and fill them from the existing results."""
+    if not _table_columns(connection, 'analysis_results'):
+        # A new database; create_all builds the tables
+        return
+
+    from db_setup import CategoryStat, ConfidenceBucket, CategoryPair
+    import analytics
+    for model in (CategoryStat, ConfidenceBucket, CategoryPair):
+        model.__table__.create(connection, checkfirst=True)
+    analytics.rebuild(connection)
+
+def _deduplicate_taxonomy(connection):
+    """
+    Merge duplicated categories, indicators and examples (e.g. from running
+    populate_comb_data.py twice) and make their natural keys unique.
+
+    Rows referring to a duplicate category are moved to the first category
+    of that name, and the analytics summaries are recomputed if any were.
+    """
+    if not _table_columns(connection, 'comb_categories'):
+        # A new database; create_all builds the tables with the unique indexes
+        return
+
+    connection.exec_driver_sql("""CREATE TEMP TABLE category_map AS
+        SELECT id AS old_id, (SELECT min(id) FROM comb_categories first WHERE first.name = c.name) AS new_id
+        FROM comb_categories c""")
+    connection.exec_driver_sql("DELETE FROM category_map WHERE old_id = new_id")
+    merged = connection.exec_driver_sql("SELECT count(*) FROM category_map").scalar()
+
+    if merged:
+        for table in ('indicators', 'coding_examples', 'analysis_results', 'analysis_spans'):
+            if _table_columns(connection, table):
+                connection.exec_driver_sql(f"""UPDATE {table}
+                    SET category_id = (SELECT new_id FROM category_map WHERE old_id = category_id)
+                    WHERE category_id IN (SELECT old_id FROM category_map)""")
+        connection.exec_driver_sql("DELETE FROM comb_categories WHERE id IN (SELECT old_id FROM category_map)")
+        print(f"Merged {merged} duplicated categories")
+    connection.exec_driver_sql("DROP TABLE category_map")
+
+    statements = [
+        """DELETE FROM indicators WHERE id NOT IN
+            (SELECT min(id) FROM indicators GROUP BY category_id, indicator_type, text)""",
+        """DELETE FROM coding_examples WHERE id NOT IN
+            (SELECT min(id) FROM coding_examples GROUP BY category_id, text)""",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_comb_categories_name ON comb_categories (name)",
+        """CREATE UNIQUE INDEX IF NOT EXISTS ix_indicators_natural_key
+            ON indicators (category_id, indicator_type, text)""",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_coding_examples_natural_key ON coding_examples (category_id, text)",
+    ]
+    for statement in statements:
+        connection.exec_driver_sql(statement)
+
+    if merged and _table_columns(connection, 'analytics_category_stats'):
+        import analytics
+        analytics.rebuild(connection)
+
+def _add_taxonomy_versioning(connection):
+    """
+    Record the taxonomy version of each analysis result and count changes
+    to the taxonomy tables in taxonomy_revision, so running servers can
+    reload the taxonomy when it changes (see taxonomy.py).
+
+    Existing results keep an empty version: the taxonomy they used is unknown.
+    """
+    if not _table_columns(connection, 'comb_categories'):
+        # A new database; create_all builds the tables and triggers
+        return
+
+    from db_setup import TaxonomyRevision, TAXONOMY_TABLES, taxonomy_trigger_statements
+    if _table_columns(connection, 'analysis_results') and \
+            'taxonomy_version' not in _table_columns(connection, 'analysis_results'):
+        connection.exec_driver_sql("ALTER TABLE analysis_results ADD COLUMN taxonomy_version VARCHAR(16)")
+    # Creating the table also inserts its row
+    TaxonomyRevision.__table__.create(connection, checkfirst=True)
+    for table in TAXONOMY_TABLES:
+        if _table_columns(connection, table):
+            for statement in taxonomy_trigger_statements(table):
+                connection.exec_driver_sql(statement)
+
+# (version, description, migration) in the order they are applied
+MIGRATIONS = [
+    (1, "normalize analysis texts and index analysis results", _normalize_analysis_texts),
+    (2, "build the analytics summary tables", _build_analytics_tables),
+    (3, "merge duplicated taxonomy entries and make their names unique", _deduplicate_taxonomy),
+    (4, "version the taxonomy and the results analyzed with it", _add_taxonomy_versioning),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def _backup(connection, database_path, version):
+    """Copy the database file before migrating it."""
+    # Fold the write-ahead log into the main file so the copy is complete
+    connection.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+    backup_path = f"{database_path}.v{version}.bak"
+    shutil.copyfile(database_path, backup_path)
+    print(f"Backed up {database_path} to {backup_path}")
+
+def migrate(engine, backup=True):
+    """
+    Apply the pending migrations to a SQLite database.
+
+    Args:
+        engine: Engine of the database
+        backup: Copy the database file before changing it
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+
+    with engine.begin() as connection:
+        version = connection.exec_driver_sql("PRAGMA user_version").scalar()
+        pending = [migration for migration in MIGRATIONS if migration[0] > version]
+        if not pending:
+            return
+
+        database_path = engine.url.database
+        has_tables = connection.exec_driver_sql(
+            "SELECT count(*) FROM sqlite_master WHERE type = 'table'"
+        ).scalar() > 0
+        if backup and has_tables and database_path not in (None, '', ':memory:'):
+            _backup(connection, database_path, version)
+
+        for number, description, migration in pending:
+            if has_tables:
+                print(f"Migrating database to schema version {number}: {description}")
+            migration(connection)
+            connection.exec_driver_sql(f"PRAGMA user_version = {number}")
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else 'comb_analyzer.db'
+    if not os.path.exists(path):
+        sys.exit(f"{path} does not exist")
+    migrate(create_engine(f'sqlite:///{path}'))
+    print(f"{path} is at schema version {LATEST_VERSION}")
@@ -1,126 +1,467 @@
 # model_handler.py
 
 import os
+import copy
 import json
 from datetime import datetime
+import threading
+import time
 import uuid
-from llama_cpp import Llama
-from sqlalchemy.orm import Session
-from db_setup import setup_database, COMBCategory, Indicator, CodingExample, AnalysisResult
+from concurrent.futures import ThreadPoolExecutor
+import llama_cpp
+from llama_cpp import Llama, LlamaGrammar
+from sqlalchemy.orm import Session, sessionmaker
+from db_setup import setup_database, AnalysisText, AnalysisResult, AnalysisSpan
+from result_cache import ResultCache
+from db_writer import BatchWriter
+from json_stream import JSONObjectScanner, parse_categories_object, parse_compact_object
+from comb_grammar import build_coding_grammar, build_compact_grammar
+from batch_engine import BatchedInferenceEngine
+from prefilter import TfidfPrefilter
+from fewshot import FewShotIndex
+from documents import build_windows, merge_window_results
+from speculative import SpeculativeDecoder
+from taxonomy import TaxonomySnapshot, TaxonomyWatcher, load_taxonomy, read_revision
+from single_flight import SingleFlight, coalesce_stream
+import metrics
+import analytics
+
+# Prompt tokens reserved around a document window: its quotes, "Text to
+# analyze:" and the pre-screen suggestion
+DOCUMENT_PROMPT_MARGIN = 64
 
 class LlamaModelHandler:
     """
     Handles interactions with the Llama model for COM-B framework coding.
     """
-    def __init__(self, model_path, db_session=None):
+    def __init__(self, model_path, db_session=None, result_cache=None,
+                 constrained_decoding=True, max_explanation_chars=160, n_threads=6,
+                 n_ctx=4096, batch_sequences=0, n_threads_batch=None, n_batch=512,
+                 n_gpu_layers=4, use_mmap=True, use_mlock=False, max_tokens=1024, model=None,
+                 record_metrics=True, result_writer=None, prefilter_threshold=0, prefilter_shortlist=0,
+                 fewshot_budget=0, fewshot_max_entries=8, compact_responses=False,
+                 compact_explanation_chars=60, speculative=None, draft_model_path=None, speculative_tokens=8,
+                 taxonomy_poll_interval=30, coalesce_requests=True):
         """
         Initialize the Llama model handler.
         
         Args:
             model_path: Path to the GGUF model file
-            db_session: SQLAlchemy database session
+            db_session: SQLAlchemy database session, preferably a thread-scoped one
+                as returned by setup_database() since requests use it concurrently
+            result_cache: Optional ResultCache (one backed by db_session is created by default)
+            constrained_decoding: Constrain generation to the response JSON format with a grammar
+            max_explanation_chars: Maximum explanation length allowed by the grammar
+            n_threads: Number of CPU threads the model may use
+            n_ctx: Context window size, shared by all sequences when batching
+            batch_sequences: Decode up to this many concurrent requests together
+                in one context (0 disables continuous batching)
+            n_threads_batch: Number of CPU threads for prompt evaluation (defaults to n_threads)
+            n_batch: Number of prompt tokens evaluated per batch
+            n_gpu_layers: Number of layers offloaded to the GPU
+            use_mmap: Map the model file instead of reading it into memory
+            use_mlock: Lock the model in RAM
+            max_tokens: Maximum number of tokens generated per analysis
+            model: An already loaded Llama-compatible model to use instead of
+                loading model_path (e.g. the benchmark stub in stub_llama.py)
+            record_metrics: Record each analysis in the metrics registry (metrics.py)
+            result_writer: Optional db_writer.BatchWriter for the result rows (one
+                writing to db_session's database is started by default)
+            prefilter_threshold: Answer without the model when the TF-IDF pre-classifier
+                (prefilter.py) is at least this confident, in percent (0 disables it)
+            prefilter_shortlist: Suggest this many of the pre-classifier's best
+                categories to the model in the prompt (0 disables it)
+            fewshot_budget: Instead of the fixed indicators and examples, put the
+                ones most similar to the text into the prompt, up to this many
+                tokens (0 keeps the fixed block)
+            fewshot_max_entries: Maximum number of indicators and examples selected
+            compact_responses: Have the model answer with short category codes
+                ({"c": [["MR", 85, "reason"]]}) instead of the full JSON format;
+                results are returned in the usual format either way
+            compact_explanation_chars: Maximum length of the reasons in compact
+                responses (0 leaves them out)
+            speculative: Speculative decoding mode (speculative.py): 'prompt_lookup'
+                drafts tokens by n-gram lookup in the prompt, 'draft' with a
+                small model; None decodes one token per forward pass. Decoding
+                is greedy in either mode. Not available with batch_sequences
+            draft_model_path: GGUF file of the draft model for speculative='draft';
+                it must share the main model's vocabulary
+            speculative_tokens: Tokens drafted per verification step
+            taxonomy_poll_interval: Check the database for taxonomy changes this
+                often, in seconds, and reload the taxonomy when it changed (0
+                only reloads through reload_taxonomy())
+            coalesce_requests: Let concurrent analyses of the same normalized
+                text share one run (see stream_code_text)
+            
+        The inference parameters can be loaded with config.load_inference_config().
         """
         self.model_path = model_path
+        self.max_tokens = max_tokens
+        self.record_metrics = record_metrics
+        self.constrained_decoding = constrained_decoding
+        self.max_explanation_chars = max_explanation_chars
+        self.prefilter_threshold = prefilter_threshold
+        self.prefilter_shortlist = prefilter_shortlist
+        self.fewshot_budget = fewshot_budget
+        self.fewshot_max_entries = fewshot_max_entries
+        self.compact_responses = compact_responses
+        self.compact_explanation_chars = compact_explanation_chars
+        
+        # Analyses in progress, joined by identical requests arriving meanwhile
+        self.coalesce_requests = coalesce_requests
+        self._in_flight = SingleFlight()
+        
+        # Identify the model file by name and size for the result cache key
+        model_size = os.path.getsize(model_path) if os.path.exists(model_path) else 0
+        self.model_id = f"{os.path.basename(model_path)}:{model_size}"
         
         # Set up the database session
         if db_session is None:
             self.db_session = setup_database()
         else:
             self.db_session = db_session
+        
+        # Results are written by a background thread that commits them in
+        # batches, so the request path never waits for a commit
+        if result_writer is None:
+            result_writer = BatchWriter(sessionmaker(bind=self.db_session.get_bind()))
+        self.result_writer = result_writer
+        
+        # Cache of previous results, consulted before running the model
+        if result_cache is None:
+            self.result_cache = ResultCache(self.db_session, writer=self.result_writer)
+        else:
+            self.result_cache = result_cache
             
         # Load the Llama model
         # The n_ctx parameter controls the context window size
         # The n_threads parameter controls CPU parallelization
-        print("Loading Llama model... This may take a moment.")
-        self.model = Llama(
-            model_path=model_path,
-            n_ctx=4096,       # Context window size (adjust based on your needs)
-            n_threads=6,      # Number of CPU threads to use
-            n_gpu_layers=4  
-        )
-        print("Llama model loaded successfully!")
-        
-        # Load COM-B categories and related data
-        self.categories = self._load_categories()
-        self.indicators = self._load_indicators()
-        self.examples = self._load_examples()
-    
-    def _load_categories(self):
-        """Load all COM-B categories from the database."""
-        categories = {}
-        for category in self.db_session.query(COMBCategory).all():
-            categories[category.id] = {
-                'id': category.id,
-                'name': category.name,
-                'description': category.description
-            }
-        return categories
-    
-    def _load_indicators(self):
-        """Load all indicators grouped by category."""
-        indicators = {}
-        for category_id in self.categories.keys():
-            indicators[category_id] = {
-                'positive': [],
-                'negative': []
-            }
+        if model is not None:
+            self.model = model
+        else:
+            print("Loading Llama model... This may take a moment.")
+            self.model = Llama(
+                model_path=model_path,
+                n_ctx=n_ctx,      # Context window size (adjust based on your needs)
+                n_threads=n_threads,  # Number of CPU threads to use
+                n_threads_batch=n_threads_batch,
+                n_batch=n_batch,
+                n_gpu_layers=n_gpu_layers,
+                use_mmap=use_mmap,
+                use_mlock=use_mlock
+            )
+            print("Llama model loaded successfully!")
+        
+        # With continuous batching, concurrent requests are decoded together as
+        # separate sequences of this context instead of one after another
+        self._engine = None
+        if batch_sequences > 0:
+            if speculative:
+                raise ValueError("Speculative decoding is not available with continuous batching")
+            self._engine = BatchedInferenceEngine(self.model, max_sequences=batch_sequences,
+                                                  temperature=0.1, top_p=0.9)
+        
+        # With speculative decoding, drafted tokens are verified several at a
+        # time in one forward pass of the model
+        self._speculative = None
+        if speculative == 'prompt_lookup':
+            self._speculative = SpeculativeDecoder(self.model, draft_tokens=speculative_tokens)
+        elif speculative == 'draft':
+            if not draft_model_path:
+                raise ValueError("speculative='draft' needs a draft_model_path")
+            print("Loading draft model...")
+            draft_model = Llama(
+                model_path=draft_model_path,
+                n_ctx=n_ctx,
+                n_threads=n_threads,
+                n_threads_batch=n_threads_batch,
+                n_batch=n_batch,
+                n_gpu_layers=n_gpu_layers,
+                use_mmap=use_mmap,
+                verbose=False
+            )
+            self._speculative = SpeculativeDecoder(self.model, draft_model=draft_model,
+                                                   draft_tokens=speculative_tokens)
+        elif speculative:
+            raise ValueError(f"Unknown speculative decoding mode: {speculative}")
+        
+        # The model keeps a single KV cache, so generation has to be serialized
+        self._model_lock = threading.Lock()
+        # Number of requests waiting for the model lock
+        self._waiting = 0
+        self._waiting_lock = threading.Lock()
+        
+        # Evaluate the static part of the prompt once and keep the llama state
+        # so each request only has to evaluate the tokens of the user text
+        self._prefix_text = None
+        self._prefix_length = 0
+        self._prefix_state = None
+        
+        # The COM-B taxonomy and everything derived from it, replaced as a
+        # whole when it is reloaded; each analysis uses the snapshot that was
+        # current when it started
+        self._reload_lock = threading.Lock()
+        self.taxonomy = self._load_snapshot()
+        self._prepare_prefix_cache(self.taxonomy)
+        
+        # Pick up taxonomy edits (e.g. by taxonomy_import.py) without a restart
+        self.taxonomy_watcher = None
+        if taxonomy_poll_interval > 0:
+            self.taxonomy_watcher = TaxonomyWatcher(taxonomy_poll_interval,
+                                                     lambda: self.reload_taxonomy(force=False))
+    
+    def reload_taxonomy(self, force=True):
+        """
+        Reload categories, indicators and examples from the database and
+        publish them as a new snapshot, without reloading the model.
+        
+        The new prompt prefix is evaluated before the snapshot is published.
+        Analyses already running finish with the snapshot they started with.
+        
+        Args:
+            force: Reload even if the taxonomy revision counter hasn't changed
+                (the content is compared either way)
             
-        for indicator in self.db_session.query(Indicator).all():
-            indicators[indicator.category_id][indicator.indicator_type].append(indicator.text)
+        Returns:
+            A dictionary with the taxonomy "version" now in use, the
+            "previous" one and whether the taxonomy "changed"
             
-        return indicators
-    
-    def _load_examples(self):
-        """Load all coding examples grouped by category."""
-        examples = {}
-        for category_id in self.categories.keys():
-            examples[category_id] = []
+        Raises:
+            ValueError: If the taxonomy in the database has no categories;
+                the current snapshot stays in use
+        """
+        with self._reload_lock:
+            current = self.taxonomy
+            try:
+                if not force and current.revision is not None and \
+                        read_revision(self.db_session) == current.revision:
+                    # One single-row query while nothing changed
+                    return {"version": current.version, "previous": current.version, "changed": False}
+                taxonomy = TaxonomySnapshot(*load_taxonomy(self.db_session))
+            finally:
+                self.db_session.close()
             
-        for example in self.db_session.query(CodingExample).all():
-            examples[example.category_id].append({
-                'text': example.text,
-                'explanation': example.explanation
-            })
+            if taxonomy.version == current.version:
+                # Same content (e.g. an edit that was undone): keep what was
+                # derived from it and only take note of the new revision
+                taxonomy.prompt_prefix = current.prompt_prefix
+                taxonomy.prefix_tokens = current.prefix_tokens
+                taxonomy.grammar = current.grammar
+                taxonomy.prefilter = current.prefilter
+                taxonomy.fewshot_index = current.fewshot_index
+                self.taxonomy = taxonomy
+                return {"version": current.version, "previous": current.version, "changed": False}
             
-        return examples
+            self._derive_snapshot(taxonomy)
+            if taxonomy.prompt_prefix != current.prompt_prefix:
+                # Evaluate the new prefix before publishing the snapshot, so no
+                # request has to wait for it afterwards
+                with self._model_lock:
+                    self._prepare_prefix_cache(taxonomy)
+                    self.taxonomy = taxonomy
+            else:
+                self.taxonomy = taxonomy
+        
+        print(f"Reloaded the taxonomy: version {current.version} -> {taxonomy.version}")
+        return {"version": taxonomy.version, "previous": current.version, "changed": True}
     
-    def _create_coding_prompt(self, text):
+    def _load_snapshot(self):
+        """
+        Read the taxonomy from the database into a snapshot ready to be published.
+        """
+        try:
+            taxonomy = TaxonomySnapshot(*load_taxonomy(self.db_session))
+        finally:
+            self.db_session.close()
+        self._derive_snapshot(taxonomy)
+        return taxonomy
+    
+    def _derive_snapshot(self, taxonomy):
+        """
+        Build the prompt prefix, response grammar, pre-classifier and few-shot
+        index of a new taxonomy snapshot.
+        
+        Raises:
+            ValueError: If the taxonomy has no categories; a reload then keeps
+                the current snapshot
+        """
+        if not taxonomy.categories:
+            raise ValueError("The taxonomy has no categories; run populate_comb_data.py "
+                             "or import some with taxonomy_import.py")
+        taxonomy.prompt_prefix = self._create_prompt_prefix(taxonomy)
+        taxonomy.prefix_tokens = self.model.tokenize(taxonomy.prompt_prefix.encode("utf-8"),
+                                                     add_bos=True, special=True)
+        # The response grammar lists the category names (or codes)
+        if self.constrained_decoding and self.compact_responses:
+            grammar = build_compact_grammar(taxonomy.codes, max_explanation_chars=self.compact_explanation_chars)
+            taxonomy.grammar = LlamaGrammar.from_string(grammar, verbose=False)
+        elif self.constrained_decoding:
+            grammar = build_coding_grammar(
+                [category['name'] for category in taxonomy.categories.values()],
+                max_explanation_chars=self.max_explanation_chars
+            )
+            taxonomy.grammar = LlamaGrammar.from_string(grammar, verbose=False)
+        # First-tier classifier that answers clear-cut texts without the model
+        taxonomy.prefilter = TfidfPrefilter.from_taxonomy(taxonomy.categories, taxonomy.indicators,
+                                                          taxonomy.examples)
+        # Index of the indicators and examples for per-request few-shot
+        # selection, token-counted with the model's tokenizer
+        taxonomy.fewshot_index = FewShotIndex(
+            taxonomy.categories, taxonomy.indicators, taxonomy.examples,
+            count_tokens=lambda line: len(self.model.tokenize(line.encode("utf-8"), add_bos=False, special=False))
+        )
+    
+    def _prepare_prefix_cache(self, taxonomy):
+        """
+        Evaluate the static prompt prefix of a taxonomy snapshot and snapshot
+        the resulting llama state.
+        
+        The prefix only depends on the categories, indicators and examples, so
+        the state stays valid until the taxonomy is reloaded. Must be called
+        with the model lock held.
+        """
+        prefix_text = taxonomy.prompt_prefix
+        prefix_tokens = taxonomy.prefix_tokens
+        
+        if self._engine is not None:
+            # The engine keeps the prefix in its own sequence and shares its cells
+            self._engine.set_prefix(prefix_tokens)
+            self._prefix_state = None
+        else:
+            self.model.reset()
+            self.model.eval(prefix_tokens)
+            self._prefix_state = self.model.save_state()
+        self._prefix_text = prefix_text
+        self._prefix_length = len(prefix_tokens)
+        print(f"Cached prompt prefix ({len(prefix_tokens)} tokens)")
+    
+    def _restore_prefix_cache(self, taxonomy):
+        """
+        Restore the llama state to the end of the static prompt prefix.
+        
+        The state is rebuilt first if the prefix doesn't match the current
+        taxonomy snapshot. Must be called with the model lock held.
+        """
+        if self._prefix_state is None:
+            self._prepare_prefix_cache(taxonomy)
+        elif taxonomy.prompt_prefix == self._prefix_text or taxonomy is not self.taxonomy:
+            # A request that started before a reload doesn't bring its old
+            # prefix back; its prompt is evaluated from where the tokens of
+            # the two prefixes part
+            self.model.load_state(self._prefix_state)
+        else:
+            self._prepare_prefix_cache(taxonomy)
+    
+    def set_threads(self, n_threads, n_threads_batch=None):
+        """
+        Change the number of CPU threads without reloading the model.
+        
+        Args:
+            n_threads: Threads used for decoding
+            n_threads_batch: Threads used for prompt evaluation (defaults to n_threads)
+        """
+        llama_cpp.llama_set_n_threads(self.model.ctx, n_threads, n_threads_batch or n_threads)
+    
+    def warm_up(self):
+        """
+        Run a short dummy completion so the first real request doesn't pay
+        one-off start-up costs such as paging in the weights.
+        """
+        start_time = time.time()
+        completion = self._stream_completion(self._create_coding_prompt("I would like to exercise more often."))
+        try:
+            # A few tokens are enough to touch every layer
+            for _ in zip(range(8), completion):
+                pass
+        finally:
+            completion.close()
+        print(f"Model warmed up in {time.time() - start_time:.2f} seconds")
+    
+    def _parse_response(self, json_str, taxonomy):
+        """
+        Parse a JSON object from the model in the configured response format.
+        
+        Returns:
+            The results with full category names, or None if the object is invalid
+        """
+        if self.compact_responses:
+            return parse_compact_object(json_str, taxonomy.codes)
+        return parse_categories_object(json_str)
+    
+    @property
+    def prompt_version(self):
+        """Short hash of the current taxonomy and prompt prefix."""
+        return self.taxonomy.prompt_version
+    
+    def _create_coding_prompt(self, text, candidates=None, taxonomy=None):
         """
         Create a simplified prompt for the Llama model to code the text.
         
         Args:
             text: The transcript text to be coded
+            candidates: Optional category names suggested by the pre-classifier;
+                they follow the text so the cached prompt prefix still applies
+            taxonomy: Taxonomy snapshot of the analysis (defaults to the current one)
             
         Returns:
             A formatted prompt string
         """
+        taxonomy = taxonomy or self.taxonomy
+        prompt = taxonomy.prompt_prefix
+        if self.fewshot_budget > 0:
+            # The indicators and examples nearest to this text, after the cached prefix
+            prompt += "".join(taxonomy.fewshot_index.select(text, self.fewshot_budget, self.fewshot_max_entries))
+            prompt += "\nText to analyze:\n"
+        prompt += f"\"{text}\"\n"
+        if candidates:
+            prompt += f"\nA keyword pre-screen suggests these categories may apply: {', '.join(candidates)}\n"
+        return prompt
+    
+    def _create_prompt_prefix(self, taxonomy):
+        """
+        Create the static part of the coding prompt that precedes the user text.
+        
+        Built once per taxonomy snapshot (see _load_snapshot).
+        
+        Args:
+            taxonomy: The TaxonomySnapshot to describe
+            
+        Returns:
+            The prompt prefix string, identical for every request
+        """
+        categories = taxonomy.categories
         # Start building the prompt - simplified for faster processing
         prompt = "You are an expert qualitative researcher coding interview transcripts using the COM-B framework. "
         prompt += "The COM-B framework consists of 6 categories:\n\n"
         
         # Add category descriptions
-        for cat_id, category in self.categories.items():
+        for cat_id, category in categories.items():
             prompt += f"{category['name']}: {category['description']}\n"
         
-        # Add only the most important indicators for each category
-        prompt += "\nKey indicators for each category:\n\n"
-        for cat_id, category in self.categories.items():
-            prompt += f"{self.categories[cat_id]['name']}:\n"
-            # Only include the first 3 positive indicators for brevity
-            positive_indicators = self.indicators[cat_id]['positive'][:3]
-            for indicator in positive_indicators:
-                prompt += f"- {indicator}\n"
-            prompt += "\n"
-        
-        # Add only 1 example per category for brevity
-        prompt += "Example for each category:\n\n"
-        for cat_id, category in self.categories.items():
-            if self.examples[cat_id]:
-                example = self.examples[cat_id][0]  # Just take the first example
-                prompt += f"{self.categories[cat_id]['name']} example: \"{example['text']}\"\n\n"
+        # With few-shot selection the indicators and examples are chosen per text instead
+        if self.fewshot_budget <= 0:
+            # Add only the most important indicators for each category
+            prompt += "\nKey indicators for each category:\n\n"
+            for cat_id, category in categories.items():
+                prompt += f"{categories[cat_id]['name']}:\n"
+                # Only include the first 3 positive indicators for brevity
+                positive_indicators = taxonomy.indicators[cat_id]['positive'][:3]
+                for indicator in positive_indicators:
+                    prompt += f"- {indicator}\n"
+                prompt += "\n"
+            
+            # Add only 1 example per category for brevity
+            prompt += "Example for each category:\n\n"
+            for cat_id, category in categories.items():
+                if taxonomy.examples[cat_id]:
+                    example = taxonomy.examples[cat_id][0]  # Just take the first example
+                    prompt += f"{categories[cat_id]['name']} example: \"{example['text']}\"\n\n"
         
         # Add the analysis instructions - simplified
-        prompt += """
+        if self.compact_responses:
+            prompt += self._create_compact_instructions(taxonomy)
+        else:
+            prompt += """
 Analyze the following text and identify the TOP TWO COM-B categories it fits into. For each identified category:
 1. Explain briefly why it fits that category
 2. Provide a confidence level (0-100%)
@@ -136,144 +477,708 @@ Analyze the following text and identify the TOP TWO COM-B categories it fits int
         // Additional categories if applicable
     ]
 }
-
-Text to analyze:
 """
-        prompt += f"\"{text}\"\n"
+        
+        if self.fewshot_budget > 0:
+            # The selected indicators and examples and the text follow per request
+            prompt += "\nIndicators and examples similar to the text:\n"
+        else:
+            prompt += "\nText to analyze:\n"
         
         return prompt
     
-    def code_text(self, text):
+    def _create_compact_instructions(self, taxonomy):
+        """
+        Create the analysis instructions of the compact response format.
+        
+        Returns:
+            The instructions, asking for category codes and integer
+            confidences instead of full names and a nested JSON structure
+        """
+        instructions = "\nCategory codes:\n"
+        for code, name in taxonomy.codes.items():
+            instructions += f"{code} = {name}\n"
+        instructions += """
+Analyze the following text and identify the TOP TWO COM-B categories it fits into.
+Only include categories where your confidence (0-100) is ABOVE 60%.
+Answer with JSON only, in this compact format:
+"""
+        if self.compact_explanation_chars > 0:
+            instructions += '{"c": [["CODE", CONFIDENCE, "REASON"]]}\n'
+            instructions += f"where REASON says in at most {self.compact_explanation_chars} characters why the text fits.\n"
+        else:
+            instructions += '{"c": [["CODE", CONFIDENCE]]}\n'
+        return instructions
+    
+    def code_text(self, text, use_cache=True, trace=None, store=True):
         """
         Use the Llama model to code a piece of text according to the COM-B framework.
         
+        Results are served from the result cache when the same normalized text
+        was already coded with the current prompt and model. Calls for a text
+        that is being coded right now share that analysis (see stream_code_text).
+        
         Args:
             text: The transcript text to be coded
+            use_cache: Set to False to bypass the result cache
+            trace: Optional dictionary filled with phase timings and token counts
+            store: Set to False to not write the results to the database
             
         Returns:
             A dictionary containing the coding results
         """
+        results = None
+        for event, payload in self.stream_code_text(text, use_cache=use_cache, trace=trace, store=store):
+            if event == "result":
+                results = payload
+        return results
+    
+    def _join_results(self, text, leader_text, shared, trace, store, taxonomy, wait):
+        """
+        Results of an identical analysis another request ran, for a request that waited for it.
+        
+        Args:
+            text: The text of this request
+            leader_text: The text the analysis was run on, equal to text once normalized
+            shared: The analysis results, not to be modified
+            trace: The caller's trace dictionary, if any
+            store: Whether to write the results to the database
+            taxonomy: Taxonomy snapshot of the analysis
+            wait: Seconds spent waiting for the analysis
+            
+        Returns:
+            A copy of the results with its own session ID
+        """
+        trace = self._new_trace(trace)
+        trace["phases"]["coalesce_wait"] = wait
+        results = copy.deepcopy(shared)
+        if "error" not in results:
+            session_id = str(uuid.uuid4())
+            if store:
+                # Span offsets only apply to the very text they were computed on
+                spans = results.get("spans") if text == leader_text else None
+                self._store_results(text, results, session_id, taxonomy, spans=spans)
+            results["session_id"] = session_id
+            results["tier"] = "coalesced"
+        results["cache"] = "coalesced"
+        if self.record_metrics:
+            metrics.COALESCED_ANALYSES.labels(role="follower").inc()
+            metrics.record_analysis(trace, results)
+        return results
+    
+    def _count_shared(self, followers):
+        """Count a leader whose results were shared with followers."""
+        if self.record_metrics:
+            metrics.COALESCED_ANALYSES.labels(role="leader").inc()
+    
+    def stream_code_text(self, text, use_cache=True, trace=None, store=True, taxonomy=None):
+        """
+        Code a piece of text, yielding the generated text as it is produced.
+        
+        Generation stops as soon as the model closes a JSON object with the
+        expected structure, so no time is spent decoding trailing prose.
+        The results carry the version of the taxonomy they were coded with.
+        Texts that don't fit in the context are coded with code_document
+        instead, yielding only its result.
+        
+        A call for a text that is being coded right now, with the same
+        taxonomy, prompt and cache setting, waits for that analysis instead
+        of starting its own and yields only its result: a copy under its own
+        session ID, with tier and cache set to "coalesced". If the caller of
+        the running analysis stops reading, the analysis still completes for
+        the calls waiting on it.
+        
+        Args:
+            text: The transcript text to be coded
+            use_cache: Set to False to bypass the result cache
+            trace: Optional dictionary filled with the time spent in each phase
+                ("phases", in seconds), the prompt and generated token counts
+                and the raw generated text
+            store: Set to False to not write the results to the database
+            taxonomy: Taxonomy snapshot to code with (defaults to the current one)
+            
+        Yields:
+            ("token", chunk) tuples for generated text, followed by a single
+            ("result", results) tuple with the same dictionary code_text returns
+        """
+        # The whole analysis uses the same taxonomy, even if it is reloaded meanwhile
+        if taxonomy is None:
+            taxonomy = self.taxonomy
+        if not self.coalesce_requests:
+            yield from self._stream_code_text(text, use_cache, trace, store, taxonomy)
+            return
+        
+        # The cache key covers the normalized text, the taxonomy version, the prompt and the model
+        key = (self.result_cache.make_key(text, taxonomy.prompt_version, self.model_id), use_cache)
+        wait_start = time.perf_counter()
+        events = coalesce_stream(self._in_flight, key,
+                                 lambda: self._stream_code_text(text, use_cache, trace, store, taxonomy),
+                                 context=text, on_shared=self._count_shared)
+        try:
+            for event, payload in events:
+                if event == "joined":
+                    leader_text, shared = payload
+                    yield "result", self._join_results(text, leader_text, shared, trace, store, taxonomy,
+                                                       time.perf_counter() - wait_start)
+                else:
+                    yield event, payload
+        finally:
+            # Lets a leader finish the analysis for its followers when the caller stops reading
+            events.close()
+    
+    def _stream_code_text(self, text, use_cache, trace, store, taxonomy):
+        """Code a text on its own, without joining an identical analysis (see stream_code_text)."""
+        # Texts too long for a single prompt are analyzed in windows
+        if store and not self.fits_context(text):
+            yield "result", self.code_document(text, use_cache=use_cache, trace=trace)
+            return
+        
+        trace = self._new_trace(trace)
+        
         # Create a unique session ID for this analysis
         session_id = str(uuid.uuid4())
         
-        # Create the prompt
-        prompt = self._create_coding_prompt(text)
-        
-        # Generate a response from the model with optimized parameters
-        response = self.model.create_completion(
-            prompt,
-            max_tokens=1024,  # Reduced max tokens for faster response
-            temperature=0.1,  # Low temperature for more deterministic outputs
-            top_p=0.9,
-            stream=False,
-            stop=["</s>", "Human:", "User:"]  # Stop tokens to prevent the model from continuing
+        phase_start = time.perf_counter()
+        try:
+            cache_key, results = self._lookup_cache(text, session_id, use_cache, store, taxonomy)
+        finally:
+            # Return the connection to the pool, the rest of the analysis doesn't read the database
+            self.db_session.close()
+        trace["phases"]["cache_lookup"] = time.perf_counter() - phase_start
+        if results is not None:
+            if self.record_metrics:
+                metrics.record_analysis(trace, results)
+            yield "result", results
+            return
+        
+        # Clear-cut texts are answered by the pre-classifier in well under a millisecond
+        candidates = None
+        if self.prefilter_threshold > 0 or self.prefilter_shortlist > 0:
+            phase_start = time.perf_counter()
+            results, candidates = self._prefilter_text(text, session_id, store, taxonomy)
+            trace["phases"]["prefilter"] = time.perf_counter() - phase_start
+            if results is not None:
+                # Pre-classifier answers aren't cached: they cost less than a
+                # lookup, and must not outlive a change of the threshold
+                results["cache"] = "bypass" if cache_key is None else "skipped"
+                if self.record_metrics:
+                    metrics.record_analysis(trace, results)
+                yield "result", results
+                return
+        
+        for event, payload in self._generate_results(text, session_id, trace, taxonomy, candidates, store):
+            if event == "result":
+                results = payload
+            else:
+                yield event, payload
+        
+        if cache_key is None:
+            results["cache"] = "bypass"
+        else:
+            if "error" not in results:
+                self.result_cache.put(cache_key, {"categories": results["categories"]})
+            results["cache"] = "miss"
+        results["tier"] = "llm"
+        if self.record_metrics:
+            metrics.record_analysis(trace, results)
+        yield "result", results
+    
+    def document_window_tokens(self):
+        """
+        Token budget for the text of one window of a long document.
+        
+        What is left of the context after the cached prompt prefix, the
+        selected indicators and examples, the quotes and suggestions around
+        the text and the response. With continuous batching the budget is the
+        same, since the engine runs a request that doesn't fit next to others
+        on its own.
+        """
+        return (self.model.n_ctx() - self._prefix_length - self.max_tokens
+                - self.fewshot_budget - DOCUMENT_PROMPT_MARGIN)
+    
+    def fits_context(self, text):
+        """Whether a text fits in a single prompt, or has to be analyzed with code_document."""
+        budget = self.document_window_tokens()
+        # Tokens are at least one byte long, so short texts need no tokenizing
+        encoded = text.encode("utf-8")
+        if len(encoded) <= budget:
+            return True
+        return len(self.model.tokenize(encoded, add_bos=False, special=False)) <= budget
+    
+    def code_document(self, text, use_cache=True, trace=None, window_tokens=None, store=True):
+        """
+        Code a long transcript in overlapping windows and merge the results.
+        
+        The transcript is split into windows of whole speaker turns that fit
+        the context (see documents.py). Windows are analyzed concurrently, so
+        with continuous batching they are decoded together; otherwise they
+        take turns on the model. The document-level categories and the
+        categories of every window are stored under one session ID.
+        
+        Args:
+            text: The transcript
+            use_cache: Set to False to bypass the result cache for the windows
+            trace: Optional dictionary filled with the number of windows and
+                the summed phase timings and token counts of their analyses
+            window_tokens: Token budget per window (defaults to document_window_tokens())
+            store: Set to False to not write the results to the database
+            
+        Returns:
+            A dictionary with the document "categories", the per-window
+            "spans" with their character offsets, the session ID and the
+            taxonomy version. "failed_windows" counts the windows whose
+            analysis failed; if all of them did, the result has an "error"
+            instead of a session ID and isn't stored
+        """
+        if trace is None:
+            trace = {}
+        trace.clear()
+        start_time = time.perf_counter()
+        taxonomy = self.taxonomy
+        
+        budget = window_tokens or self.document_window_tokens()
+        if budget <= 0:
+            return {"error": "The context is too small for the prompt; increase n_ctx"}
+        windows = build_windows(
+            text,
+            lambda part: len(self.model.tokenize(part.encode("utf-8"), add_bos=False, special=False)),
+            budget
         )
+        if not windows:
+            return {"error": "No text to analyze"}
         
-        # Extract the generated text
-        generated_text = response["choices"][0]["text"].strip()
+        def analyze(window):
+            window_trace = {}
+            # Windows are stored together with the document below
+            results = self.code_text(window.text(text), use_cache=use_cache, trace=window_trace, store=False)
+            return results, window_trace
         
-        # Try to extract JSON from the response
-        try:
-            # More robust JSON extraction
-            # First, look for the last complete JSON object in the response
-            # This handles cases where the model might generate multiple JSON objects
-            # or include explanatory text before/after the JSON
+        parallelism = self._engine.max_sequences if self._engine is not None else 1
+        with ThreadPoolExecutor(max_workers=min(parallelism, len(windows))) as executor:
+            outcomes = list(executor.map(analyze, windows))
+        
+        results = merge_window_results(windows, [window_results for window_results, _ in outcomes])
+        if "error" not in results:
+            session_id = str(uuid.uuid4())
+            if store:
+                self._store_results(text, results, session_id, taxonomy, spans=results["spans"])
+            results["session_id"] = session_id
+        results["taxonomy_version"] = taxonomy.version
+        
+        # Windows overlap in time, so the phases add up to more than the elapsed time
+        phases = {}
+        for _, window_trace in outcomes:
+            for phase, seconds in window_trace.get("phases", {}).items():
+                phases[phase] = phases.get(phase, 0.0) + seconds
+        trace["phases"] = phases
+        trace["windows"] = len(windows)
+        for key in ("prompt_chars", "prompt_tokens", "cached_prompt_tokens", "generated_tokens",
+                    "draft_tokens", "accepted_tokens", "verify_steps"):
+            trace[key] = sum(window_trace.get(key, 0) for _, window_trace in outcomes)
+        trace["elapsed"] = time.perf_counter() - start_time
+        return results
+    
+    @staticmethod
+    def _new_trace(trace):
+        """Reset a caller's trace dictionary (or create a private one) for a new analysis."""
+        if trace is None:
+            trace = {}
+        trace.clear()
+        trace.update({"phases": {}, "prompt_chars": 0, "prompt_tokens": 0, "cached_prompt_tokens": 0,
+                      "generated_tokens": 0, "generated_text": None, "extraction_failure": None})
+        return trace
+    
+    def queue_depth(self):
+        """Number of requests waiting for the model."""
+        if self._engine is not None:
+            return self._engine.queue_depth()
+        return self._waiting
+    
+    def _lookup_cache(self, text, session_id, use_cache, store, taxonomy):
+        """
+        Look up the text in the result cache.
+        
+        Args:
+            text: The transcript text to be coded
+            session_id: Identifier to store a cached result under
+            use_cache: Whether the cache should be consulted at all
+            store: Whether to write a cached result to the database
+            taxonomy: Taxonomy snapshot of the analysis
             
-            # Find all opening braces
-            open_brace_indices = [i for i, char in enumerate(generated_text) if char == '{']
+        Returns:
+            A (cache_key, results) tuple; cache_key is None when the cache is
+            bypassed and results is None on a miss
+        """
+        if not use_cache:
+            return None, None
+        
+        cache_key = self.result_cache.make_key(text, taxonomy.prompt_version, self.model_id)
+        tier, cached = self.result_cache.get(cache_key)
+        if cached is None:
+            return cache_key, None
+        
+        results = {"categories": [dict(cat) for cat in cached["categories"]]}
+        if store:
+            self._store_results(text, results, session_id, taxonomy)
+        results["session_id"] = session_id
+        results["taxonomy_version"] = taxonomy.version
+        results["cache"] = "hit"
+        results["cache_tier"] = tier
+        results["tier"] = "cache"
+        return cache_key, results
+    
+    def _prefilter_text(self, text, session_id, store, taxonomy):
+        """
+        Score the text with the pre-classifier.
+        
+        Args:
+            text: The transcript text to be coded
+            session_id: Identifier to store the results under
+            store: Whether to write the results to the database
+            taxonomy: Taxonomy snapshot of the analysis
             
-            # If no JSON structure found
-            if not open_brace_indices:
-                return {"error": "Could not extract valid JSON from model response", "raw_response": generated_text}
+        Returns:
+            A (results, candidates) tuple: the stored results when the
+            pre-classifier is confident enough (otherwise None), and the
+            category names to suggest to the model (None if not enabled)
+        """
+        scores = taxonomy.prefilter.score(text)
+        if not scores:
+            return None, None
+        
+        category_id, confidence, similarity = scores[0]
+        if self.prefilter_threshold > 0 and similarity > 0 and confidence >= max(self.prefilter_threshold, 60):
+            terms = taxonomy.prefilter.matching_terms(text, category_id)
+            results = {"categories": [{
+                "category": taxonomy.categories[category_id]['name'],
+                "explanation": f"Matches the indicators and examples of this category ({', '.join(terms)}).",
+                "confidence": round(confidence)
+            }]}
+            if store:
+                self._store_results(text, results, session_id, taxonomy)
+            results["session_id"] = session_id
+            results["taxonomy_version"] = taxonomy.version
+            results["tier"] = "prefilter"
+            return results, None
+        
+        candidates = None
+        if self.prefilter_shortlist > 0:
+            candidates = taxonomy.prefilter.shortlist(text, self.prefilter_shortlist) or None
+        return None, candidates
+    
+    def _stream_completion(self, prompt, trace=None, taxonomy=None):
+        """
+        Stream the model's completion of the prompt.
+        
+        Without batching, the model lock is held until the generator is
+        exhausted or closed.
+        
+        Args:
+            prompt: The full coding prompt
+            trace: Optional trace dictionary (see stream_code_text) to record
+                the lock wait and the prompt token counts in
+            taxonomy: Taxonomy snapshot the prompt was built from (defaults
+                to the current one)
             
-            # Try each potential JSON object, starting from the last one
-            for start_index in reversed(open_brace_indices):
-                # Track nested braces to find the matching closing brace
-                brace_count = 0
-                end_index = -1
-                
-                for i in range(start_index, len(generated_text)):
-                    if generated_text[i] == '{':
-                        brace_count += 1
-                    elif generated_text[i] == '}':
-                        brace_count -= 1
-                        
-                    if brace_count == 0:
-                        end_index = i + 1
-                        break
-                
-                if end_index > 0:
-                    # We found a complete JSON object
-                    json_str = generated_text[start_index:end_index]
-                    try:
-                        results = json.loads(json_str)
-                        # Check if this JSON has the expected structure
-                        if "categories" in results:
-                            # Filter out categories with confidence <= 60%
-                            if "categories" in results:
-                                results["categories"] = [
-                                    cat for cat in results["categories"] 
-                                    if cat.get("confidence", 0) > 60
-                                ]
-                            
-                            # Store results in the database
-                            self._store_results(text, results, session_id)
-                            
-                            # Add the session ID to the results
-                            results["session_id"] = session_id
-                            
-                            return results
-                    except json.JSONDecodeError:
-                        # This JSON object was invalid, try the next one
-                        continue
+        Yields:
+            Chunks of generated text
+        """
+        taxonomy = taxonomy or self.taxonomy
+        if self._engine is not None:
+            # Only the current snapshot moves the shared prefix. A request that
+            # started before a reload doesn't bring its old prefix back; the
+            # engine evaluates it in the request's own sequence instead, which
+            # also covers a reload between this check and the submission
+            if taxonomy is self.taxonomy and taxonomy.prompt_prefix != self._prefix_text:
+                with self._model_lock:
+                    if taxonomy is self.taxonomy and taxonomy.prompt_prefix != self._prefix_text:
+                        self._prepare_prefix_cache(taxonomy)
+            # Only the text after the shared prefix is evaluated per request
+            suffix = prompt[len(taxonomy.prompt_prefix):]
+            suffix_tokens = self.model.tokenize(suffix.encode("utf-8"), add_bos=False, special=True)
+            if trace is not None:
+                prefix_length = len(taxonomy.prefix_tokens)
+                shared = taxonomy.prompt_prefix == self._prefix_text
+                trace["cached_prompt_tokens"] = prefix_length if shared else 0
+                trace["prompt_tokens"] = prefix_length + len(suffix_tokens)
+            yield from self._engine.generate(
+                suffix_tokens,
+                max_tokens=self.max_tokens,
+                grammar=taxonomy.grammar,
+                stop=["</s>", "Human:", "User:"],
+                prefix=taxonomy.prefix_tokens
+            )
+            return
+        
+        wait_start = time.perf_counter()
+        with self._waiting_lock:
+            self._waiting += 1
+        with self._model_lock:
+            with self._waiting_lock:
+                self._waiting -= 1
+            prompt_tokens = None
+            if trace is not None or self._speculative is not None:
+                # Tokenizing the prompt takes well under a millisecond next to evaluating it
+                prompt_tokens = self.model.tokenize(prompt.encode("utf-8"), add_bos=True, special=True)
+            if trace is not None:
+                trace["phases"]["lock_wait"] = time.perf_counter() - wait_start
+                trace["cached_prompt_tokens"] = self._prefix_length
+                trace["prompt_tokens"] = len(prompt_tokens)
+            # Start from the cached prefix state; create_completion matches the
+            # prompt against the loaded tokens and only evaluates the remainder
+            self._restore_prefix_cache(taxonomy)
+            if self._speculative is not None:
+                yield from self._speculative.generate(
+                    prompt,
+                    prompt_tokens,
+                    max_tokens=self.max_tokens,
+                    grammar=taxonomy.grammar,
+                    stop=["</s>", "Human:", "User:"],
+                    stats=trace
+                )
+                return
+            for chunk in self.model.create_completion(
+                prompt,
+                max_tokens=self.max_tokens,
+                temperature=0.1,  # Low temperature for more deterministic outputs
+                top_p=0.9,
+                stream=True,
+                stop=["</s>", "Human:", "User:"],  # Stop tokens to prevent the model from continuing
+                grammar=taxonomy.grammar  # Only allow well-formed responses (None when unconstrained)
+            ):
+                yield chunk["choices"][0]["text"]
+    
+    def _generate_results(self, text, session_id, trace, taxonomy, candidates=None, store=True):
+        """
+        Run the model on the text and parse its JSON response.
+        
+        Args:
+            text: The transcript text to be coded
+            session_id: Identifier to store the results under
+            trace: Trace dictionary to record phase timings and token counts in
+            taxonomy: Taxonomy snapshot of the analysis
+            candidates: Optional category names suggested by the pre-classifier
+            store: Whether to write the results to the database
             
-            # If we get here, we couldn't find a valid JSON object with the expected structure
-            return {"error": "Could not extract valid JSON with expected structure from model response", 
-                    "raw_response": generated_text}
+        Yields:
+            ("token", chunk) tuples for generated text, followed by a single
+            ("result", results) tuple with the coding results or an error
+        """
+        phases = trace["phases"]
+        
+        # Create the prompt
+        phase_start = time.perf_counter()
+        prompt = self._create_coding_prompt(text, candidates, taxonomy)
+        phases["prompt_build"] = time.perf_counter() - phase_start
+        trace["prompt_chars"] = len(prompt)
+        
+        # Stream the generation and stop as soon as a complete object arrives
+        scanner = JSONObjectScanner()
+        generated_chunks = []
+        results = None
+        parse_time = 0.0
+        first_chunk_time = None
+        generation_start = time.perf_counter()
+        completion = self._stream_completion(prompt, trace, taxonomy)
+        try:
+            for chunk in completion:
+                if first_chunk_time is None:
+                    # Everything up to the first token is prompt evaluation
+                    first_chunk_time = time.perf_counter()
+                generated_chunks.append(chunk)
+                yield "token", chunk
+                parse_start = time.perf_counter()
+                for json_str in scanner.feed(chunk):
+                    results = self._parse_response(json_str, taxonomy)
+                    if results is not None:
+                        break
+                parse_time += time.perf_counter() - parse_start
+                if results is not None:
+                    break
+        finally:
+            # Closing the generator stops decoding and releases the model lock
+            completion.close()
+        
+        generation_end = time.perf_counter()
+        if first_chunk_time is None:
+            first_chunk_time = generation_end
+        phases["prompt_eval"] = first_chunk_time - generation_start - phases.get("lock_wait", 0.0)
+        phases["decode"] = generation_end - first_chunk_time - parse_time
+        phases["parse"] = parse_time
+        trace["generated_tokens"] = len(generated_chunks)
+        
+        # Extract the generated text
+        generated_text = "".join(generated_chunks).strip()
+        trace["generated_text"] = generated_text
+        
+        if results is None:
+            # Try to extract JSON from the response
+            parse_start = time.perf_counter()
+            try:
+                results = self._extract_results(generated_text, taxonomy)
+            except Exception as e:
+                # If JSON parsing fails, return an error
+                trace["extraction_failure"] = "parse_error"
+                yield "result", {
+                    "error": f"Error processing model response: {str(e)}",
+                    "raw_response": generated_text
+                }
+                return
+            finally:
+                phases["parse"] += time.perf_counter() - parse_start
+        
+        if results is None:
+            # We couldn't find a valid JSON object with the expected structure
+            trace["extraction_failure"] = self._extraction_failure_reason(generated_text, len(generated_chunks))
+            yield "result", {"error": "Could not extract valid JSON with expected structure from model response", 
+                             "raw_response": generated_text}
+            return
+        
+        # Filter out categories with confidence <= 60%
+        results["categories"] = [
+            cat for cat in results["categories"] 
+            if cat.get("confidence", 0) > 60
+        ]
+        
+        # Store results in the database
+        if store:
+            phase_start = time.perf_counter()
+            self._store_results(text, results, session_id, taxonomy)
+            phases["store"] = time.perf_counter() - phase_start
+        
+        # Add the session ID and taxonomy version to the results
+        results["session_id"] = session_id
+        results["taxonomy_version"] = taxonomy.version
+        
+        yield "result", results
+    
+    def _extraction_failure_reason(self, generated_text, generated_tokens):
+        """Classify why no result could be extracted from a response, for the metrics."""
+        if generated_tokens >= self.max_tokens:
+            return "truncated"
+        if not generated_text:
+            return "empty_response"
+        if JSONObjectScanner().feed(generated_text):
+            return "invalid_structure"
+        return "no_json_object"
+    
+    def _extract_results(self, generated_text, taxonomy):
+        """
+        Find the last valid JSON object with the expected structure in a complete response.
+        
+        This handles cases where the model might generate multiple JSON objects
+        or include explanatory text before/after the JSON. Only needed when
+        decoding is unconstrained or the generation was cut off.
+        
+        Args:
+            generated_text: The full text generated by the model
+            taxonomy: Taxonomy snapshot of the analysis
             
-        except Exception as e:
-            # If JSON parsing fails, return an error
-            return {
-                "error": f"Error processing model response: {str(e)}",
-                "raw_response": generated_text
-            }
+        Returns:
+            The parsed results dictionary, or None if no valid object was found
+        """
+        results = None
+        for json_str in JSONObjectScanner().feed(generated_text):
+            parsed = self._parse_response(json_str, taxonomy)
+            if parsed is not None:
+                results = parsed
+        return results
     
-    def _store_results(self, text, results, session_id):
+    def _store_results(self, text, results, session_id, taxonomy, spans=None):
         """
-        Store coding results in the database.
+        Store coding results in the database, through the background writer.
         
         Args:
             text: The original text that was coded
             results: The coding results
             session_id: A unique identifier for this analysis session
+            taxonomy: Taxonomy snapshot the results were coded with
+            spans: Optional per-window results of a long document (see
+                code_document), stored with their character offsets
         """
-        # Check if results contain the expected structure
-        if "categories" not in results:
-            return
+        write = build_result_write(text, results, session_id, taxonomy, spans)
+        if write is not None:
+            # The writer commits them together with other analyses' results
+            self.result_writer.submit(write)
+    
+    def close(self):
+        """Write out the pending results and stop the background writer and the taxonomy polling."""
+        if self.taxonomy_watcher is not None:
+            self.taxonomy_watcher.stop()
+        self.result_writer.close()
+
+def build_result_write(text, results, session_id, taxonomy, spans=None):
+    """
+    Build the database write storing the results of an analysis.
+    
+    Args:
+        text: The original text that was coded
+        results: The coding results
+        session_id: A unique identifier for this analysis session
+        taxonomy: Taxonomy snapshot the results were coded with
+        spans: Optional per-window results of a long document (see
+            code_document), stored with their character offsets
         
-        # Get category IDs by name for easier lookup
-        category_id_by_name = {category['name']: cat_id for cat_id, category in self.categories.items()}
+    Returns:
+        A function adding the rows within a session's transaction, for
+        db_writer.BatchWriter or a caller's own transaction, or None if
+        there is nothing to store
+    """
+    # Check if results contain the expected structure
+    if "categories" not in results:
+        return None
+    
+    # Category IDs by name, built once per taxonomy snapshot
+    category_id_by_name = taxonomy.category_ids
+    
+    # Store each category result
+    created_at = datetime.utcnow()
+    rows = []
+    for result in results["categories"]:
+        category_name = result.get("category")
+        confidence = result.get("confidence", 0)
         
-        # Store each category result
-        for result in results["categories"]:
-            category_name = result.get("category")
-            confidence = result.get("confidence", 0)
-            
-            # Skip if category name is not found
-            if category_name not in category_id_by_name:
-                continue
-            
-            # Create and add the analysis result
-            analysis_result = AnalysisResult(
-                text_quote=text,
-                category_id=category_id_by_name[category_name],
-                confidence=confidence,
-                session_id=session_id
-            )
-            self.db_session.add(analysis_result)
+        # Skip if category name is not found
+        if category_name not in category_id_by_name:
+            continue
         
-        # Commit the changes to the database
-        self.db_session.commit()
+        # Create and add the analysis result
+        analysis_result = AnalysisResult(
+            category_id=category_id_by_name[category_name],
+            confidence=confidence,
+            session_id=session_id,
+            created_at=created_at,
+            taxonomy_version=taxonomy.version
+        )
+        rows.append(analysis_result)
+    
+    if not rows:
+        return None
+    
+    span_rows = []
+    for span in spans or []:
+        for result in span["categories"]:
+            if result.get("category") in category_id_by_name:
+                span_rows.append(AnalysisSpan(
+                    session_id=session_id,
+                    start_char=span["start"],
+                    end_char=span["end"],
+                    category_id=category_id_by_name[result["category"]],
+                    confidence=result.get("confidence", 0),
+                    created_at=created_at
+                ))
+    
+    def write(session):
+        # The text is stored once and shared by all results that analyzed it
+        text_row = AnalysisText.get_or_create(session, text)
+        for row in rows:
+            row.text_id = text_row.id
+        session.add_all(rows)
+        session.add_all(span_rows)
+        # Keep the analytics summaries in step, in the same transaction
+        analytics.record_analysis(session, [(row.category_id, row.confidence) for row in rows])
+    
+    return write
 
 def test_model():
     # Path to your Llama model file
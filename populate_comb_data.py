@@ -1,6 +1,7 @@
 # populate_comb_data.py
 
-from db_setup import setup_database, COMBCategory, Indicator, CodingExample
+from db_setup import setup_database, COMBCategory
+from taxonomy_import import import_taxonomy
 
 def populate_comb_categories(session):
     """
@@ -33,10 +34,11 @@ def populate_comb_categories(session):
         }
     ]
     
-    # Add all categories to the database
-    for category_data in categories:
-        category = COMBCategory(**category_data)
-        session.add(category)
+    # Add the categories that are missing or changed; running the script again is harmless
+    import_taxonomy(session, [
+        {'category': category_data['name'], 'description': category_data['description']}
+        for category_data in categories
+    ], default_kind='category')
     
     # Commit the changes
     session.commit()
@@ -148,18 +150,13 @@ def populate_indicators(session, categories):
         }
     }
     
-    # Add all indicators to the database
-    for category_name, indicator_types in indicators_data.items():
-        category = categories[category_name]
-        
-        for indicator_type, texts in indicator_types.items():
-            for text in texts:
-                indicator = Indicator(
-                    category_id=category.id,
-                    text=text,
-                    indicator_type=indicator_type
-                )
-                session.add(indicator)
+    # Add the indicators that are missing
+    import_taxonomy(session, [
+        {'category': category_name, 'type': indicator_type, 'text': text}
+        for category_name, indicator_types in indicators_data.items()
+        for indicator_type, texts in indicator_types.items()
+        for text in texts
+    ], default_kind='indicator')
     
     # Commit the changes
     session.commit()
@@ -231,17 +228,12 @@ def populate_coding_examples(session, categories):
         ]
     }
     
-    # Add all examples to the database
-    for category_name, examples in examples_data.items():
-        category = categories[category_name]
-        
-        for example in examples:
-            coding_example = CodingExample(
-                category_id=category.id,
-                text=example['text'],
-                explanation=example['explanation']
-            )
-            session.add(coding_example)
+    # Add the examples that are missing or whose explanation changed
+    import_taxonomy(session, [
+        {'category': category_name, 'text': example['text'], 'explanation': example['explanation']}
+        for category_name, examples in examples_data.items()
+        for example in examples
+    ], default_kind='example')
     
     # Commit the changes
     session.commit()
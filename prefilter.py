@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+"""
+Fast first-tier classifier that answers clear-cut texts without the model.
+
+Each category is represented by the centroid of the TF-IDF vectors of its
+positive indicators, its coding examples and its description. A text is
+scored by its cosine similarity to every centroid, turned into a
+probability-like confidence with a softmax, which takes tens of
+microseconds for a typical utterance. When the top category's confidence
+clears the handler's threshold the analysis is answered right away;
+otherwise the best-scoring categories can be suggested to the model.
+
+How trustworthy a confidence level is depends on the taxonomy, so pick the
+threshold from the calibration report, which classifies every stored
+example with a classifier built without it:
+
+    python prefilter.py calibrate [path/to/comb_analyzer.db]
+"""
+import math
+import os
+import re
+import sys
+from collections import Counter
+
+# Frequent words that say nothing about the category
+STOP_WORDS = frozenset("""
+a about after all also am an and any are as at be because been being but by can could did do does
+doing for from had has have having he her him his how i if in into is it its just me more most my
+no nor not of on once only or other our out over own same she so some such than that the their them
+then there these they this those through to too under until up very was we were what when where
+which while who whom why will with would you your
+""".split())
+
+# Softmax temperature applied to the cosine similarities
+DEFAULT_TEMPERATURE = 0.05
+
+_WORD_RE = re.compile(r"[a-z][a-z']+")
+
+def tokenize(text):
+    """Lower-cased words without stop words, plus adjacent word pairs."""
+    words = [word.strip("'") for word in _WORD_RE.findall(text.lower())]
+    words = [word for word in words if word and word not in STOP_WORDS]
+    return words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+
+def normalize(vector):
+    """Scale a sparse vector to unit length."""
+    norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+    if norm == 0:
+        return {}
+    return {term: weight / norm for term, weight in vector.items()}
+
+def training_documents(categories, indicators, examples):
+    """
+    Labelled snippets the classifier is built from.
+
+    Args:
+        categories, indicators, examples: The taxonomy as loaded by LlamaModelHandler
+
+    Returns:
+        A list of (category_id, text) tuples
+    """
+    documents = []
+    for category_id, category in categories.items():
+        documents.append((category_id, category['description']))
+        for indicator in indicators.get(category_id, {}).get('positive', []):
+            documents.append((category_id, indicator))
+        for example in examples.get(category_id, []):
+            documents.append((category_id, example['text']))
+    return documents
+
+class TfidfPrefilter:
+    """
+    Nearest-centroid TF-IDF classifier over the COM-B taxonomy.
+    """
+    def __init__(self, categories, documents, temperature=DEFAULT_TEMPERATURE):
+        """
+        Build the category centroids.
+
+        Args:
+            categories: Dictionary of category id to category (with a 'name')
+            documents: (category_id, text) training snippets, see training_documents()
+            temperature: Softmax temperature; lower values give more extreme confidences
+        """
+        self.category_names = {category_id: category['name'] for category_id, category in categories.items()}
+        self.temperature = temperature
+
+        tokenized = [(category_id, tokenize(text)) for category_id, text in documents]
+        document_frequency = Counter()
+        for _, terms in tokenized:
+            document_frequency.update(set(terms))
+        total = len(tokenized)
+        # Smoothed IDF, as in scikit-learn
+        self.idf = {term: math.log((1 + total) / (1 + count)) + 1 for term, count in document_frequency.items()}
+
+        sums = {category_id: Counter() for category_id in self.category_names}
+        for category_id, terms in tokenized:
+            if category_id in sums:
+                sums[category_id].update(self._vectorize(terms))
+        self.centroids = {category_id: normalize(vector) for category_id, vector in sums.items()}
+
+    @classmethod
+    def from_taxonomy(cls, categories, indicators, examples, **kwargs):
+        """Build the classifier from the taxonomy as loaded by LlamaModelHandler."""
+        return cls(categories, training_documents(categories, indicators, examples), **kwargs)
+
+    def _vectorize(self, terms):
+        """Unit-length TF-IDF vector of a list of terms; unknown terms are ignored."""
+        counts = Counter(term for term in terms if term in self.idf)
+        return normalize({term: count * self.idf[term] for term, count in counts.items()})
+
+    def score(self, text):
+        """
+        Score a text against every category.
+
+        Returns:
+            A list of (category_id, confidence, similarity) tuples, most
+            confident first. Confidences are in percent and add up to 100;
+            they are all equal when the text shares no term with the taxonomy.
+        """
+        vector = self._vectorize(tokenize(text))
+        similarities = {
+            category_id: sum(weight * centroid.get(term, 0.0) for term, weight in vector.items())
+            for category_id, centroid in self.centroids.items()
+        }
+        if not similarities:
+            return []
+        top = max(similarities.values())
+        exponentials = {category_id: math.exp((similarity - top) / self.temperature)
+                        for category_id, similarity in similarities.items()}
+        total = sum(exponentials.values())
+        scores = [(category_id, 100.0 * exponentials[category_id] / total, similarities[category_id])
+                  for category_id in similarities]
+        scores.sort(key=lambda score: score[1], reverse=True)
+        return scores
+
+    def matching_terms(self, text, category_id, limit=3):
+        """The terms of the text that contribute most to a category's score."""
+        vector = self._vectorize(tokenize(text))
+        centroid = self.centroids.get(category_id, {})
+        contributions = sorted(((weight * centroid.get(term, 0.0), term) for term, weight in vector.items()),
+                               reverse=True)
+        return [term for contribution, term in contributions[:limit] if contribution > 0]
+
+    def shortlist(self, text, size):
+        """Names of the size best-scoring categories that share a term with the text."""
+        return [self.category_names[category_id]
+                for category_id, confidence, similarity in self.score(text)[:size] if similarity > 0]
+
+def calibration_report(categories, indicators, examples, thresholds=(50, 60, 70, 80, 90, 95),
+                       temperature=DEFAULT_TEMPERATURE):
+    """
+    Measure how well the confidences predict correctness on the stored taxonomy.
+
+    Each snippet is classified by a classifier built from all the other
+    snippets (leave-one-out), so the numbers estimate accuracy on unseen text.
+
+    Returns:
+        A dictionary with the overall accuracy, the accuracy per confidence
+        bucket and, for each threshold, the share of snippets it would
+        answer (coverage) and how many of those would be right
+    """
+    documents = training_documents(categories, indicators, examples)
+    predictions = []
+    for index, (category_id, text) in enumerate(documents):
+        classifier = TfidfPrefilter(categories, documents[:index] + documents[index + 1:], temperature=temperature)
+        predicted, confidence, _ = classifier.score(text)[0]
+        predictions.append((confidence, predicted == category_id))
+
+    buckets = []
+    for low in range(0, 100, 10):
+        in_bucket = [correct for confidence, correct in predictions
+                     if low <= confidence < low + 10 or (low == 90 and confidence == 100)]
+        buckets.append({
+            'confidence': f"{low}-{low + 10}",
+            'snippets': len(in_bucket),
+            'accuracy': round(sum(in_bucket) / len(in_bucket), 3) if in_bucket else None
+        })
+
+    threshold_rows = []
+    for threshold in thresholds:
+        answered = [correct for confidence, correct in predictions if confidence >= threshold]
+        threshold_rows.append({
+            'threshold': threshold,
+            'coverage': round(len(answered) / len(predictions), 3) if predictions else 0.0,
+            'accuracy': round(sum(answered) / len(answered), 3) if answered else None
+        })
+
+    return {
+        'snippets': len(predictions),
+        'accuracy': round(sum(correct for _, correct in predictions) / len(predictions), 3) if predictions else None,
+        'buckets': buckets,
+        'thresholds': threshold_rows
+    }
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != 'calibrate':
+        sys.exit("Usage: python prefilter.py calibrate [path/to/comb_analyzer.db]")
+    path = sys.argv[2] if len(sys.argv) > 2 else 'comb_analyzer.db'
+    if not os.path.exists(path):
+        sys.exit(f"{path} does not exist")
+
+    from db_setup import create_session_factory, COMBCategory, Indicator, CodingExample
+    session = create_session_factory(f'sqlite:///{path}')()
+    categories = {c.id: {'id': c.id, 'name': c.name, 'description': c.description}
+                  for c in session.query(COMBCategory).all()}
+    indicators = {category_id: {'positive': [], 'negative': []} for category_id in categories}
+    for indicator in session.query(Indicator).all():
+        indicators[indicator.category_id][indicator.indicator_type].append(indicator.text)
+    examples = {category_id: [] for category_id in categories}
+    for example in session.query(CodingExample).all():
+        examples[example.category_id].append({'text': example.text, 'explanation': example.explanation})
+    session.close()
+
+    report = calibration_report(categories, indicators, examples)
+    print(f"Leave-one-out accuracy on {report['snippets']} indicators, examples and descriptions: "
+          f"{report['accuracy']}")
+    print("\nConfidence  Snippets  Accuracy")
+    for bucket in report['buckets']:
+        accuracy = '-' if bucket['accuracy'] is None else f"{bucket['accuracy']:.3f}"
+        print(f"{bucket['confidence']:>10}  {bucket['snippets']:>8}  {accuracy:>8}")
+    print("\nThreshold  Coverage  Accuracy")
+    for row in report['thresholds']:
+        accuracy = '-' if row['accuracy'] is None else f"{row['accuracy']:.3f}"
+        print(f"{row['threshold']:>9}  {row['coverage']:>8.3f}  {accuracy:>8}")
+    print("\nSet COMB_PREFILTER_THRESHOLD to the lowest threshold whose accuracy you are comfortable with.")
@@ -0,0 +1,157 @@
+# profiling.py
+
+import cProfile
+import json
+import os
+import random
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+def summarize_trace(trace):
+    """
+    Turn an analysis trace into the breakdown added to profiled responses.
+
+    Args:
+        trace: Trace dictionary filled in by LlamaModelHandler.stream_code_text
+
+    Returns:
+        A JSON-serializable dictionary with the phase timings in milliseconds
+        and the token counts
+    """
+    phases = trace.get("phases", {})
+    return {
+        "phases_ms": {phase: round(seconds * 1000, 2) for phase, seconds in phases.items()},
+        "total_ms": round(sum(phases.values()) * 1000, 2),
+        "prompt_chars": trace.get("prompt_chars", 0),
+        "prompt_tokens": trace.get("prompt_tokens", 0),
+        "cached_prompt_tokens": trace.get("cached_prompt_tokens", 0),
+        "generated_tokens": trace.get("generated_tokens", 0)
+    }
+
+class RequestProfiler:
+    """
+    Opt-in profiling of analysis requests.
+
+    Adds a per-phase breakdown to responses when asked to, appends requests
+    slower than a threshold to a JSON-lines slow-request log, and runs
+    cProfile on a random fraction of requests. The settings can be changed
+    at runtime through update(), so profiling can be turned on without a restart.
+    """
+    def __init__(self, include_in_response=False, slow_threshold=30.0, slow_log_path="slow_requests.log",
+                 sample_rate=0.0, profile_dir="profiles"):
+        """
+        Initialize the profiler.
+
+        Args:
+            include_in_response: Add the phase breakdown to every response
+                (otherwise only to requests with profile=1)
+            slow_threshold: Requests taking longer than this many seconds are
+                written to the slow-request log (0 disables the log)
+            slow_log_path: Path of the slow-request log
+            sample_rate: Fraction of requests to run under cProfile (0 to 1)
+            profile_dir: Directory the cProfile statistics are written to
+        """
+        self.slow_log_path = slow_log_path
+        self.profile_dir = profile_dir
+        self._settings_lock = threading.Lock()
+        self._log_lock = threading.Lock()
+        # cProfile can only profile one thread at a time
+        self._cprofile_lock = threading.Lock()
+        self._settings = {}
+        self.update(include_in_response=include_in_response, slow_threshold=slow_threshold,
+                    sample_rate=sample_rate)
+
+    def settings(self):
+        """Current settings as a dictionary."""
+        with self._settings_lock:
+            return dict(self._settings, slow_log_path=self.slow_log_path, profile_dir=self.profile_dir)
+
+    def update(self, include_in_response=None, slow_threshold=None, sample_rate=None):
+        """
+        Change the settings. Arguments left as None keep their current value.
+
+        Raises:
+            ValueError: If a value is out of range
+        """
+        if slow_threshold is not None and slow_threshold < 0:
+            raise ValueError("slow_threshold must not be negative")
+        if sample_rate is not None and not 0.0 <= sample_rate <= 1.0:
+            raise ValueError("sample_rate must be between 0 and 1")
+        with self._settings_lock:
+            if include_in_response is not None:
+                self._settings['include_in_response'] = bool(include_in_response)
+            if slow_threshold is not None:
+                self._settings['slow_threshold'] = float(slow_threshold)
+            if sample_rate is not None:
+                self._settings['sample_rate'] = float(sample_rate)
+
+    def wants_profile(self, requested):
+        """Whether to add the phase breakdown to a response."""
+        with self._settings_lock:
+            return requested or self._settings['include_in_response']
+
+    @contextmanager
+    def sample(self, endpoint):
+        """
+        Run the enclosed code under cProfile for a random fraction of requests.
+
+        Yields:
+            The path the statistics will be written to, or None if this
+            request isn't sampled
+        """
+        with self._settings_lock:
+            sample_rate = self._settings['sample_rate']
+        if sample_rate <= 0 or random.random() >= sample_rate or not self._cprofile_lock.acquire(blocking=False):
+            yield None
+            return
+
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            path = os.path.join(self.profile_dir,
+                                f"{endpoint}-{datetime.utcnow():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}.prof")
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield path
+            finally:
+                profiler.disable()
+                profiler.dump_stats(path)
+                print(f"Request profile written to {path}")
+        finally:
+            self._cprofile_lock.release()
+
+    def record(self, endpoint, latency, text, trace, results, profile_path=None):
+        """
+        Write the request to the slow-request log if it exceeded the threshold.
+
+        Args:
+            endpoint: Name of the endpoint that served the request
+            latency: End-to-end latency in seconds
+            text: The analyzed text
+            trace: The analysis trace
+            results: The analysis results
+            profile_path: Where the request's cProfile statistics were written, if sampled
+        """
+        with self._settings_lock:
+            slow_threshold = self._settings['slow_threshold']
+        if slow_threshold <= 0 or latency < slow_threshold:
+            return
+
+        record = {
+            "timestamp": datetime.utcnow().isoformat(),
+            "endpoint": endpoint,
+            "latency": round(latency, 3),
+            "text_chars": len(text),
+            "cache": results.get("cache"),
+            "error": results.get("error"),
+            "profile": summarize_trace(trace or {}),
+            "cprofile": profile_path,
+            "raw_generation": (trace or {}).get("generated_text")
+        }
+        line = json.dumps(record)
+        with self._log_lock:
+            with open(self.slow_log_path, "a") as f:
+                f.write(line + "\n")
+        print(f"Slow request ({latency:.2f} seconds) written to {self.slow_log_path}")
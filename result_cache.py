@@ -0,0 +1,157 @@
+# result_cache.py
+
+import hashlib
+import json
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from db_setup import CachedResult
+
+def normalize_text(text):
+    """
+    Normalize text before hashing so trivially different submissions
+    (extra whitespace, unicode variants) share a cache entry.
+    """
+    text = unicodedata.normalize('NFKC', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+class ResultCache:
+    """
+    Two-tier cache of analysis results.
+
+    The first tier is a bounded in-process LRU, the second is the
+    `analysis_cache` table so entries survive restarts. Both tiers
+    expire entries after `ttl_seconds`. With a BatchWriter, database writes
+    happen in the background and put() only touches memory.
+    """
+    def __init__(self, db_session, max_entries=1024, max_db_entries=100000,
+                 ttl_seconds=7 * 24 * 3600, evict_every=100, writer=None):
+        """
+        Initialize the result cache.
+
+        Args:
+            db_session: SQLAlchemy database session
+            max_entries: Maximum number of entries kept in memory
+            max_db_entries: Maximum number of rows kept in the database
+            ttl_seconds: Age after which an entry is no longer served
+            evict_every: Run database eviction after this many inserts
+            writer: Optional db_writer.BatchWriter for the database writes
+        """
+        self.db_session = db_session
+        self.writer = writer
+        self.max_entries = max_entries
+        self.max_db_entries = max_db_entries
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.evict_every = evict_every
+
+        self._memory = OrderedDict()  # key -> (created_at, result)
+        self._lock = threading.Lock()
+        self._puts_since_eviction = 0
+
+    @staticmethod
+    def make_key(text, prompt_version, model_id):
+        """
+        Build the content-addressed cache key.
+
+        Args:
+            text: The text being analyzed
+            prompt_version: Version of the taxonomy/prompt used for the analysis
+            model_id: Identifier of the model file
+
+        Returns:
+            A hex SHA-256 digest
+        """
+        payload = '\x00'.join([normalize_text(text), prompt_version, model_id])
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        Look up a cached result.
+
+        Args:
+            key: Cache key from make_key()
+
+        Returns:
+            A (tier, result) tuple where tier is 'memory' or 'database',
+            or (None, None) on a miss
+        """
+        now = datetime.utcnow()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created_at, result = entry
+                if now - created_at <= self.ttl:
+                    self._memory.move_to_end(key)
+                    return 'memory', result
+                del self._memory[key]
+
+            row = self.db_session.get(CachedResult, key)
+            if row is None:
+                return None, None
+            if now - row.created_at > self.ttl:
+                self._write(lambda session: session.query(CachedResult).filter(
+                    CachedResult.cache_key == key
+                ).delete(synchronize_session=False))
+                return None, None
+
+            # Promote the entry to the in-memory tier
+            result = json.loads(row.result_json)
+            self._remember(key, row.created_at, result)
+            return 'database', result
+
+    def put(self, key, result):
+        """
+        Store a result in both tiers.
+
+        Args:
+            key: Cache key from make_key()
+            result: JSON-serializable result dictionary
+        """
+        now = datetime.utcnow()
+        result_json = json.dumps(result)
+        with self._lock:
+            self._remember(key, now, result)
+            self._puts_since_eviction += 1
+            evict = self._puts_since_eviction >= self.evict_every
+            if evict:
+                self._puts_since_eviction = 0
+
+        self._write(lambda session: session.merge(CachedResult(
+            cache_key=key,
+            result_json=result_json,
+            created_at=now
+        )))
+        if evict:
+            self._write(lambda session: self._evict_database(session, now))
+
+    def _write(self, operation):
+        """Apply a write through the batch writer, or commit it right away without one."""
+        if self.writer is not None:
+            self.writer.submit(operation)
+        else:
+            operation(self.db_session)
+            self.db_session.commit()
+
+    def _remember(self, key, created_at, result):
+        """Insert into the in-memory LRU, dropping the least recently used entries."""
+        self._memory[key] = (created_at, result)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_database(self, session, now):
+        """Delete expired rows and trim the table to max_db_entries. Doesn't commit."""
+        session.query(CachedResult).filter(
+            CachedResult.created_at < now - self.ttl
+        ).delete(synchronize_session=False)
+
+        excess = session.query(CachedResult).count() - self.max_db_entries
+        if excess > 0:
+            oldest = session.query(CachedResult.cache_key).order_by(
+                CachedResult.created_at
+            ).limit(excess).subquery()
+            session.query(CachedResult).filter(
+                CachedResult.cache_key.in_(oldest.select())
+            ).delete(synchronize_session=False)
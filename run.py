@@ -6,7 +6,7 @@ import os
 import webbrowser
 import threading
 import time
-from app import app
+from app import app, start_background_services
 
 def open_browser():
     """Open the browser after a short delay to ensure the server is running."""
@@ -20,8 +20,12 @@ if __name__ == "__main__":
     # Set larger max content length for JSON responses (to handle history)
     app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 MB
     
-    # Start a thread to open the browser
-    threading.Thread(target=open_browser).start()
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        # Warm up the model and resume unfinished jobs in the reloader's serving process
+        start_background_services()
+    else:
+        # Start a thread to open the browser (once, not on every reload)
+        threading.Thread(target=open_browser).start()
     
     # Run the Flask app
     print("Starting COM-B Framework Analyzer web application...")
@@ -0,0 +1,169 @@
+# single_flight.py
+#
+# Coalescing of identical computations that run at the same time.
+
+import copy
+import threading
+
+class _Flight:
+    """One running computation and the callers waiting for it."""
+    def __init__(self, context):
+        self.context = context
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+        self.finished = False
+
+class SingleFlight:
+    """
+    Lets callers asking for the same key at the same time share one computation.
+
+    The first caller of a key (the leader) begins a flight and computes the
+    result; callers arriving while it runs (followers) wait for it and get
+    the same result, or the same exception. Nothing is kept once the flight
+    completes, so a later caller starts a new one; remembering results is
+    the result cache's job.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def begin(self, key, context=None):
+        """
+        Join the flight of a key, or begin one.
+
+        Args:
+            key: Hashable identifying the computation
+            context: Value handed to the followers with the result (e.g. the
+                leader's input), if this caller becomes the leader
+
+        Returns:
+            A (flight, leader) tuple; the leader must end the flight with
+            complete() or cancel()
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight(context)
+                return flight, True
+            flight.followers += 1
+            return flight, False
+
+    def wait(self, flight):
+        """
+        Wait for the leader of a flight to complete it.
+
+        Returns:
+            A (context, result) tuple; the result is shared by every
+            caller of the flight and must not be modified
+
+        Raises:
+            Whatever the leader completed the flight with
+        """
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.context, flight.result
+
+    def complete(self, key, flight, result=None, error=None):
+        """
+        End a flight with its result or exception and wake the followers.
+
+        Returns:
+            The number of followers that waited for the flight
+        """
+        # No follower can join once the flight is removed, so the count is final
+        with self._lock:
+            if flight.finished:
+                return flight.followers
+            flight.finished = True
+            del self._flights[key]
+        flight.result = result
+        flight.error = error
+        flight.done.set()
+        return flight.followers
+
+    def cancel(self, key, flight):
+        """
+        End a flight nobody waits for.
+
+        Returns:
+            True if the flight is over, False if followers joined it, in
+            which case the leader must still complete it
+        """
+        with self._lock:
+            if flight.finished:
+                return True
+            if flight.followers:
+                return False
+            flight.finished = True
+            del self._flights[key]
+        flight.done.set()
+        return True
+
+    def in_flight(self):
+        """Number of computations currently running."""
+        with self._lock:
+            return len(self._flights)
+
+def coalesce_stream(flights, key, start, context=None, on_shared=None):
+    """
+    Share one event stream among identical requests running at the same time.
+
+    The leader runs start() and gets all of its events. Followers get a
+    single ("joined", (context, results)) event once the leader's stream
+    produced its ("result", results) event; those results are shared and
+    must be copied before they are changed. If the leader's caller stops
+    listening while followers wait, the rest of the stream is run for
+    them without being relayed. Exceptions of the stream are raised in
+    every request.
+
+    Args:
+        flights: The SingleFlight the requests meet in
+        key: Hashable identifying identical requests
+        start: Callable returning a generator of (event, payload) tuples
+            that ends with ("result", results)
+        context: Handed to the followers with the results
+        on_shared: Called with the number of followers when the leader's
+            results were shared
+
+    Yields:
+        (event, payload) tuples; the leader's final results are its own
+        copy when followers shared them
+    """
+    flight, leader = flights.begin(key, context)
+    if not leader:
+        yield "joined", flights.wait(flight)
+        return
+
+    try:
+        events = start()
+        for event, payload in events:
+            if event != "result":
+                yield event, payload
+                continue
+            followers = flights.complete(key, flight, result=payload)
+            if followers:
+                if on_shared is not None:
+                    on_shared(followers)
+                payload = copy.deepcopy(payload)
+            yield event, payload
+            return
+        flights.complete(key, flight, error=RuntimeError("The analysis ended without a result"))
+    except GeneratorExit:
+        if flights.cancel(key, flight):
+            events.close()
+            return
+        # Followers are waiting: finish the analysis for them
+        try:
+            for event, payload in events:
+                if event == "result":
+                    flights.complete(key, flight, result=payload)
+                    return
+            flights.complete(key, flight, error=RuntimeError("The analysis ended without a result"))
+        except Exception as e:
+            flights.complete(key, flight, error=e)
+    except BaseException as e:
+        flights.complete(key, flight, error=e)
+        raise
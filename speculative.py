@@ -0,0 +1,331 @@
+# speculative.py
+#
+# Speculative decoding for the serialized (non-batched) generation path.
+#
+# Much of a coding response is predictable: the JSON keys, the category names
+# and stock phrases that already occur in the prompt. A cheap drafter proposes
+# the next few tokens, the model evaluates all of them in a single forward
+# pass, and the longest prefix matching what the model itself would have
+# chosen is kept, plus the model's own token after it. Each forward pass thus
+# yields one or more tokens instead of exactly one. Verification is greedy,
+# so the output is exactly the model's greedy decoding whatever the drafter
+# proposes.
+
+import codecs
+import ctypes
+import numpy as np
+import llama_cpp
+
+# Longest n-gram of the recent tokens looked up in the prompt
+DEFAULT_MAX_NGRAM = 3
+
+class LlamaContext:
+    """
+    Low-level decoding on a Llama context, with logits for chosen positions.
+
+    Keeps track of how many tokens the context's sequence 0 holds, so
+    positions can be rolled back when drafted tokens are rejected.
+    """
+    def __init__(self, llama):
+        self.llama = llama
+        self.ctx = llama.ctx
+        self.n_batch = llama.n_batch
+        self.n_vocab = llama.n_vocab()
+        self.n_past = 0
+        self._batch = llama_cpp.llama_batch_init(self.n_batch, 0, 1)
+
+        # Candidate array reused for grammar-constrained greedy sampling
+        self._candidates_data = np.zeros(self.n_vocab, dtype=np.dtype(
+            [('id', np.intc), ('logit', np.single), ('p', np.single)], align=True
+        ))
+        self._token_ids = np.arange(self.n_vocab, dtype=np.intc)
+        self._candidates = llama_cpp.llama_token_data_array(
+            data=self._candidates_data.ctypes.data_as(llama_cpp.llama_token_data_p),
+            size=self.n_vocab,
+            sorted=False
+        )
+
+    def truncate(self, length):
+        """Drop every token from position length on."""
+        llama_cpp.llama_kv_cache_seq_rm(self.ctx, 0, length, -1)
+        self.n_past = min(self.n_past, length)
+
+    def decode(self, tokens, all_logits):
+        """
+        Evaluate tokens after the ones already in the context.
+
+        Args:
+            tokens: Tokens to evaluate; with all_logits at most n_batch of them
+            all_logits: Compute logits for every token instead of only the last
+
+        Returns:
+            The batch index of the first token with logits
+        """
+        for start in range(0, len(tokens), self.n_batch):
+            chunk = tokens[start:start + self.n_batch]
+            last_chunk = start + self.n_batch >= len(tokens)
+            self._batch.n_tokens = len(chunk)
+            for offset, token in enumerate(chunk):
+                self._batch.token[offset] = token
+                self._batch.pos[offset] = self.n_past + offset
+                self._batch.n_seq_id[offset] = 1
+                self._batch.seq_id[offset][0] = 0
+                self._batch.logits[offset] = last_chunk and (all_logits or offset == len(chunk) - 1)
+            if llama_cpp.llama_decode(self.ctx, self._batch) != 0:
+                raise RuntimeError("Failed to decode batch (context full)")
+            self.n_past += len(chunk)
+        return 0 if all_logits else len(chunk) - 1
+
+    def greedy(self, index, grammar=None):
+        """The most likely token at a batch index, among those the grammar allows."""
+        logits = np.ctypeslib.as_array(llama_cpp.llama_get_logits_ith(self.ctx, index), shape=(self.n_vocab,))
+        if grammar is None:
+            return int(np.argmax(logits))
+        self._candidates_data['id'] = self._token_ids
+        self._candidates_data['logit'] = logits
+        self._candidates_data['p'] = 0
+        self._candidates.size = self.n_vocab
+        self._candidates.sorted = False
+        candidates = ctypes.byref(self._candidates)
+        llama_cpp.llama_sample_grammar(self.ctx, candidates, grammar)
+        return llama_cpp.llama_sample_token_greedy(self.ctx, candidates)
+
+class LlamaVerifier:
+    """
+    The main model's side of speculative decoding: evaluates the prompt and
+    the drafted tokens and picks the model's own tokens.
+    """
+    def __init__(self, llama):
+        self.llama = llama
+        self.context = LlamaContext(llama)
+        self.token_eos = llama.token_eos()
+        self._grammar = None
+
+    def evaluate_prompt(self, prompt, tokens, grammar=None):
+        """
+        Evaluate the prompt, reusing the tokens already in the context.
+
+        The handler restores the cached prompt prefix first, so usually only
+        the text being coded is evaluated.
+
+        Returns:
+            The batch index of the logits following the prompt
+        """
+        loaded = self.llama.input_ids[:self.llama.n_tokens].tolist()
+        common = 0
+        for loaded_token, token in zip(loaded, tokens):
+            if loaded_token != token:
+                break
+            common += 1
+        # At least one token is evaluated so that there are logits to start from
+        common = min(common, len(tokens) - 1)
+        self.context.n_past = self.llama.n_tokens
+        self.context.truncate(common)
+
+        if grammar is not None:
+            # Each generation advances its own copy of the grammar state
+            self._grammar = llama_cpp.llama_grammar_copy(grammar.grammar)
+        return self.context.decode(tokens[common:], all_logits=False)
+
+    def decode(self, tokens):
+        """Evaluate drafted tokens; their logits are at batch indexes 0 to len(tokens) - 1."""
+        self.context.decode(tokens, all_logits=True)
+
+    def greedy(self, index):
+        return self.context.greedy(index, self._grammar)
+
+    def accept(self, token):
+        """Advance the grammar past a token the model chose."""
+        if self._grammar is not None and token != self.token_eos:
+            llama_cpp.llama_grammar_accept_token(self.context.ctx, self._grammar, token)
+
+    def truncate(self, length):
+        self.context.truncate(length)
+
+    def detokenize(self, token):
+        return self.llama.detokenize([token])
+
+    def finish(self, tokens):
+        """Free the grammar copy and tell the Llama object which tokens its context now holds."""
+        if self._grammar is not None:
+            llama_cpp.llama_grammar_free(self._grammar)
+            self._grammar = None
+        self.context.truncate(len(tokens))
+        self.llama.input_ids[:len(tokens)] = tokens
+        self.llama.n_tokens = len(tokens)
+
+class PromptLookupDrafter:
+    """
+    Drafts by n-gram lookup: finds the latest earlier occurrence of the last
+    few tokens in the prompt and the generated text, and proposes the tokens
+    that followed it. Costs no model evaluation at all.
+
+    Used for a single generation: the tokens passed to propose() only grow,
+    so the n-gram index is extended rather than rebuilt on every call.
+    """
+    def __init__(self, max_ngram=DEFAULT_MAX_NGRAM):
+        self.max_ngram = max_ngram
+        self._index = {}  # n-gram -> position of the token that followed its latest occurrence
+        self._indexed = 0
+
+    def propose(self, tokens, count):
+        """Propose up to count tokens following tokens."""
+        # Index every n-gram that has a continuation, i.e. ends before the last token
+        for end in range(max(self._indexed, 1), len(tokens)):
+            for n in range(1, min(self.max_ngram, end) + 1):
+                self._index[tuple(tokens[end - n:end])] = end
+        self._indexed = len(tokens)
+
+        # Prefer the longest matching n-gram
+        for n in range(min(self.max_ngram, len(tokens)), 0, -1):
+            continuation = self._index.get(tuple(tokens[-n:]))
+            if continuation is not None:
+                return tokens[continuation:continuation + count]
+        return []
+
+class DraftModelDrafter:
+    """
+    Drafts with a small model sharing the main model's vocabulary (for
+    example a 1B model of the same family), decoding greedily without the
+    grammar. Its context is kept between calls and rolled back to the
+    tokens the main model accepted.
+    """
+    def __init__(self, llama):
+        self.context = LlamaContext(llama)
+        self._tokens = []
+
+    def propose(self, tokens, count):
+        """Propose count tokens following tokens."""
+        common = 0
+        for loaded, token in zip(self._tokens, tokens):
+            if loaded != token:
+                break
+            common += 1
+        common = min(common, len(tokens) - 1)
+        self.context.truncate(common)
+        self._tokens = list(tokens)
+
+        draft = []
+        index = self.context.decode(tokens[common:], all_logits=False)
+        while True:
+            token = self.context.greedy(index)
+            draft.append(token)
+            if len(draft) >= count:
+                return draft
+            index = self.context.decode([token], all_logits=False)
+            self._tokens.append(token)
+
+class SpeculativeDecoder:
+    """
+    Generates with the main model, verifying drafted tokens in batches.
+    """
+    def __init__(self, model, draft_model=None, draft_tokens=8, max_ngram=DEFAULT_MAX_NGRAM):
+        """
+        Args:
+            model: The main Llama model, or a stub providing speculative_verifier()
+            draft_model: Optional small Llama model to draft with; without
+                one, drafts come from n-gram lookup in the prompt
+            draft_tokens: Tokens drafted per verification step
+            max_ngram: Longest n-gram used by prompt lookup
+        """
+        self.model = model
+        if hasattr(model, 'speculative_verifier'):
+            self.verifier = model.speculative_verifier()
+        else:
+            self.verifier = LlamaVerifier(model)
+            # Every drafted token and the one before it need a slot in the batch
+            draft_tokens = min(draft_tokens, model.n_batch - 1)
+        self.draft_tokens = draft_tokens
+        self.max_ngram = max_ngram
+        self.draft_model = None
+        if draft_model is not None:
+            if draft_model.n_vocab() != model.n_vocab():
+                raise ValueError("The draft model must use the same vocabulary as the main model")
+            self.draft_model = DraftModelDrafter(draft_model)
+
+    def generate(self, prompt, tokens, max_tokens, grammar=None, stop=(), stats=None):
+        """
+        Generate a completion of the prompt.
+
+        Must be called with the model lock held.
+
+        Args:
+            prompt: The prompt text
+            tokens: The prompt tokens, including the BOS token
+            max_tokens: Maximum number of tokens to generate
+            grammar: Optional LlamaGrammar constraining the output
+            stop: Strings that end the generation when produced
+            stats: Optional dictionary to add the drafted and accepted token
+                counts and the number of verification steps to
+
+        Yields:
+            Chunks of generated text
+        """
+        verifier = self.verifier
+        drafter = self.draft_model or PromptLookupDrafter(self.max_ngram)
+        history = list(tokens)
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        text = ''
+        emitted = 0
+        holdback = max((len(string) - 1 for string in stop), default=0)
+        drafted = accepted = steps = 0
+
+        def take(token):
+            """Append one of the model's tokens. Returns the text that can be emitted, or None when done."""
+            nonlocal text, emitted
+            if token == verifier.token_eos:
+                return None
+            verifier.accept(token)
+            history.append(token)
+            text += decoder.decode(verifier.detokenize(token))
+            stop_index = min((index for index in (text.find(string) for string in stop) if index >= 0),
+                             default=-1)
+            if stop_index >= 0:
+                text = text[:stop_index]
+                return None
+            if len(history) - len(tokens) >= max_tokens:
+                return None
+            # Hold back text that could be the start of a stop string
+            end = max(emitted, len(text) - holdback)
+            chunk, emitted = text[emitted:end], end
+            return chunk
+
+        try:
+            token = verifier.greedy(verifier.evaluate_prompt(prompt, tokens, grammar))
+            while True:
+                chunk = take(token)
+                if chunk is None:
+                    break
+                if chunk:
+                    yield chunk
+
+                draft = drafter.propose(history, min(self.draft_tokens, max_tokens - (len(history) - len(tokens))))
+                # The last token and the draft in one forward pass
+                verifier.decode([history[-1]] + draft)
+                steps += 1
+                drafted += len(draft)
+                token = verifier.greedy(0)
+                finished = False
+                for index, drafted_token in enumerate(draft):
+                    if token != drafted_token:
+                        break
+                    accepted += 1
+                    chunk = take(token)
+                    if chunk is None:
+                        finished = True
+                        break
+                    if chunk:
+                        yield chunk
+                    token = verifier.greedy(index + 1)
+                if finished:
+                    break
+                # Drop the rejected part of the draft from the context
+                verifier.truncate(len(history))
+            if emitted < len(text):
+                yield text[emitted:]
+        finally:
+            verifier.finish(history)
+            if stats is not None:
+                stats["draft_tokens"] = stats.get("draft_tokens", 0) + drafted
+                stats["accepted_tokens"] = stats.get("accepted_tokens", 0) + accepted
+                stats["verify_steps"] = stats.get("verify_steps", 0) + steps
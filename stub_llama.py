@@ -0,0 +1,227 @@
+# stub_llama.py
+
+import hashlib
+import json
+import re
+import time
+
+# Categories the stub picks from when none are given
+DEFAULT_CATEGORIES = [
+    'Capability - Physical',
+    'Capability - Psychological',
+    'Opportunity - Physical',
+    'Opportunity - Social',
+    'Motivation - Automatic',
+    'Motivation - Reflective'
+]
+
+# Characters per token, close to what the Llama tokenizer averages on English text
+CHARS_PER_TOKEN = 4
+
+# Token ids the stub never produces for text
+BOS_TOKEN = 1
+EOS_TOKEN = 2
+
+class StubLlamaState:
+    """Saved stub state: just the tokens in the (imaginary) KV cache."""
+    def __init__(self, tokens):
+        self.tokens = list(tokens)
+
+class StubLlama:
+    """
+    Deterministic stand-in for llama_cpp.Llama used by the benchmarks.
+
+    It implements the parts of the Llama API that LlamaModelHandler uses
+    without continuous batching (tokenize, reset, eval, save_state,
+    load_state and streaming create_completion), plus a verifier for
+    speculative decoding (speculative.py). Instead of running a model
+    it sleeps for a configurable time per evaluated prompt token and per
+    generated token, and answers with a JSON response derived from a hash
+    of the prompt, so runs are reproducible and only the Python code around
+    the model is really measured. Like Llama, it only evaluates the part of
+    the prompt that doesn't match the tokens already loaded.
+    """
+    def __init__(self, model_path=None, prompt_token_delay=0.0005, token_delay=0.02,
+                 categories=None, explanation_words=12, trailing_tokens=0, n_ctx=4096, **kwargs):
+        """
+        Initialize the stub.
+
+        Args:
+            model_path: Ignored, accepted for compatibility with Llama
+            prompt_token_delay: Seconds spent per evaluated prompt token
+            token_delay: Seconds spent per generated token
+            categories: Category names to answer with (defaults to the COM-B categories)
+            explanation_words: Length of the generated explanations
+            trailing_tokens: Tokens of prose generated after the JSON object, as
+                an unconstrained model would
+            n_ctx: Context size reported by n_ctx()
+        """
+        self.model_path = model_path
+        self.prompt_token_delay = prompt_token_delay
+        self.token_delay = token_delay
+        self.categories = list(categories or DEFAULT_CATEGORIES)
+        self.explanation_words = explanation_words
+        self.trailing_tokens = trailing_tokens
+        self._n_ctx = n_ctx
+        self.ctx = None
+        self._tokens = []
+
+    def n_ctx(self):
+        return self._n_ctx
+
+    def tokenize(self, text, add_bos=True, special=False):
+        """Split UTF-8 bytes into fixed-size pieces, one "token" per piece."""
+        tokens = [BOS_TOKEN] if add_bos else []
+        for i in range(0, len(text), CHARS_PER_TOKEN):
+            tokens.append(int.from_bytes(text[i:i + CHARS_PER_TOKEN], "little"))
+        return tokens
+
+    def detokenize(self, tokens):
+        return b"".join(token.to_bytes(CHARS_PER_TOKEN, "little").rstrip(b"\0") for token in tokens)
+
+    def token_eos(self):
+        return EOS_TOKEN
+
+    def reset(self):
+        self._tokens = []
+
+    def speculative_verifier(self):
+        """Verifier for SpeculativeDecoder that checks drafts against the stub's response."""
+        return StubSpeculativeVerifier(self)
+
+    def eval(self, tokens):
+        time.sleep(len(tokens) * self.prompt_token_delay)
+        self._tokens.extend(tokens)
+
+    def save_state(self):
+        return StubLlamaState(self._tokens)
+
+    def load_state(self, state):
+        self._tokens = list(state.tokens)
+
+    def _response(self, prompt):
+        """
+        Build the deterministic JSON response for a prompt.
+
+        The categories only depend on the text being analyzed (what follows
+        the last "Text to analyze:"), so the full and compact response
+        formats agree. The compact format is used when the prompt lists
+        category codes.
+        """
+        text = prompt.rsplit("Text to analyze:", 1)[-1]
+        digest = hashlib.sha256(text.encode("utf-8")).digest()
+        primary = self.categories[digest[0] % len(self.categories)]
+        secondary = self.categories[digest[1] % len(self.categories)]
+        words = " ".join(["evidence"] * self.explanation_words)
+        categories = [{"category": primary, "explanation": f"The text shows {words}.",
+                       "confidence": 61 + digest[2] % 39}]
+        if secondary != primary:
+            categories.append({"category": secondary, "explanation": f"Possibly {words}.",
+                               "confidence": 30 + digest[3] % 60})
+
+        if "Category codes:" in prompt:
+            codes = {name: code for code, name in re.findall(r"^(\w+) = (.+)$", prompt, re.MULTILINE)}
+            with_reasons = '"REASON"]]}' in prompt
+            items = []
+            for category in categories:
+                item = [codes.get(category["category"], "?"), category["confidence"]]
+                if with_reasons:
+                    item.append(category["explanation"][:60])
+                items.append(item)
+            response = json.dumps({"c": items}, separators=(",", ":"))
+        else:
+            response = json.dumps({"categories": categories})
+        if self.trailing_tokens:
+            response += "\n" + "More prose. " * (self.trailing_tokens * CHARS_PER_TOKEN // 12)
+        return response
+
+    def create_completion(self, prompt, max_tokens=16, stream=False, **kwargs):
+        """
+        Complete the prompt with the deterministic response.
+
+        Sampling parameters, stop strings and grammars are accepted and ignored.
+        """
+        tokens = self.tokenize(prompt.encode("utf-8"), add_bos=True)
+
+        # Only the tokens after the longest common prefix need evaluating
+        common = 0
+        for loaded, token in zip(self._tokens, tokens):
+            if loaded != token:
+                break
+            common += 1
+        self._tokens = self._tokens[:common]
+        self.eval(tokens[common:])
+
+        response = self._response(prompt)
+        pieces = [response[i:i + CHARS_PER_TOKEN]
+                  for i in range(0, len(response), CHARS_PER_TOKEN)][:max_tokens]
+
+        def generate():
+            for piece in pieces:
+                time.sleep(self.token_delay)
+                self._tokens.append(0)
+                yield {"choices": [{"text": piece, "index": 0, "logprobs": None, "finish_reason": None}]}
+
+        if stream:
+            return generate()
+        text = "".join(chunk["choices"][0]["text"] for chunk in generate())
+        return {
+            "choices": [{"text": text, "index": 0, "logprobs": None, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": len(tokens), "completion_tokens": len(pieces),
+                      "total_tokens": len(tokens) + len(pieces)}
+        }
+
+class StubSpeculativeVerifier:
+    """
+    Stub counterpart of speculative.LlamaVerifier.
+
+    The model's "greedy" token at each position is the next token of the
+    stub's response, so drafts are accepted exactly as far as they match
+    it. A verification step costs one generated token's delay plus the
+    prompt token delay for every extra drafted token, like a batched
+    forward pass.
+    """
+    def __init__(self, stub):
+        self.stub = stub
+        self.token_eos = EOS_TOKEN
+        self._response = []
+        self._prompt_length = 0
+        self._logit_positions = []
+
+    def evaluate_prompt(self, prompt, tokens, grammar=None):
+        common = 0
+        for loaded, token in zip(self.stub._tokens, tokens):
+            if loaded != token:
+                break
+            common += 1
+        common = min(common, len(tokens) - 1)
+        self.stub._tokens = self.stub._tokens[:common]
+        self.stub.eval(tokens[common:])
+
+        self._response = self.stub.tokenize(self.stub._response(prompt).encode("utf-8"), add_bos=False)
+        self._prompt_length = len(tokens)
+        # Logits at each batch index predict this position of the response
+        self._logit_positions = [0]
+        return 0
+
+    def decode(self, tokens):
+        time.sleep(self.stub.token_delay + (len(tokens) - 1) * self.stub.prompt_token_delay)
+        generated = len(self.stub._tokens) - self._prompt_length
+        self.stub._tokens.extend(tokens)
+        self._logit_positions = list(range(generated + 1, generated + 1 + len(tokens)))
+
+    def greedy(self, index):
+        position = self._logit_positions[index]
+        return self._response[position] if position < len(self._response) else EOS_TOKEN
+
+    def accept(self, token):
+        pass
+
+    def truncate(self, length):
+        self.stub._tokens = self.stub._tokens[:length]
+
+    def detokenize(self, token):
+        return self.stub.detokenize([token])
+
+    def finish(self, tokens):
+        self.stub._tokens = list(tokens)
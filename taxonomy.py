@@ -0,0 +1,140 @@
+# taxonomy.py
+#
+# Versioned snapshots of the COM-B taxonomy (categories, indicators and
+# coding examples) and cheap detection of changes to it in the database.
+
+import hashlib
+import json
+import threading
+from sqlalchemy import select
+from db_setup import COMBCategory, Indicator, CodingExample, TaxonomyRevision
+from comb_grammar import category_codes
+
+def read_revision(session):
+    """
+    The taxonomy revision counter, bumped by database triggers on every
+    insert, update or delete of a category, indicator or example.
+
+    Returns:
+        The revision, or None if the database has no counter
+    """
+    return session.execute(select(TaxonomyRevision.revision).where(TaxonomyRevision.id == 1)).scalar()
+
+def load_taxonomy(session):
+    """
+    Read the whole taxonomy in one transaction.
+
+    Returns:
+        A (categories, indicators, examples, revision) tuple: categories by
+        id, the positive and negative indicator texts of each category, the
+        examples of each category and the revision they were read at
+    """
+    revision = read_revision(session)
+
+    categories = {}
+    for category_id, name, description in session.execute(
+            select(COMBCategory.id, COMBCategory.name, COMBCategory.description).order_by(COMBCategory.id)):
+        categories[category_id] = {'id': category_id, 'name': name, 'description': description}
+
+    indicators = {category_id: {'positive': [], 'negative': []} for category_id in categories}
+    for category_id, indicator_type, text in session.execute(
+            select(Indicator.category_id, Indicator.indicator_type, Indicator.text).order_by(Indicator.id)):
+        indicators[category_id][indicator_type].append(text)
+
+    examples = {category_id: [] for category_id in categories}
+    for category_id, text, explanation in session.execute(
+            select(CodingExample.category_id, CodingExample.text, CodingExample.explanation)
+            .order_by(CodingExample.id)):
+        examples[category_id].append({'text': text, 'explanation': explanation})
+
+    return categories, indicators, examples, revision
+
+def taxonomy_version(categories, indicators, examples):
+    """
+    Short hash of the taxonomy's content.
+
+    Identical taxonomies get the same version in every process and after
+    restarts, unlike the revision counter, which counts every change.
+    """
+    payload = json.dumps([
+        [category_id, category['name'], category['description'], indicators[category_id], examples[category_id]]
+        for category_id, category in categories.items()
+    ], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:12]
+
+class TaxonomySnapshot:
+    """
+    The taxonomy as used by an analysis, with everything derived from it.
+
+    An analysis takes the handler's current snapshot once and uses it
+    throughout, so a reload in the middle of an analysis can't mix two
+    taxonomies. The handler fills in the prompt prefix, grammar,
+    pre-classifier and few-shot index before publishing a snapshot; after
+    that it is never changed, a reload publishes a new one.
+    """
+    def __init__(self, categories, indicators, examples, revision=None):
+        """
+        Args:
+            categories, indicators, examples: As returned by load_taxonomy()
+            revision: Revision counter the taxonomy was read at
+        """
+        self.categories = categories
+        self.indicators = indicators
+        self.examples = examples
+        self.revision = revision
+        self.version = taxonomy_version(categories, indicators, examples)
+
+        # Category IDs by name, for storing results
+        self.category_ids = {category['name']: category_id for category_id, category in categories.items()}
+        # Short codes of the categories used by compact responses, mapped to their names
+        self.codes = category_codes([category['name'] for category in categories.values()])
+
+        # Set by the handler (see LlamaModelHandler._derive_snapshot)
+        self.prompt_prefix = None   # Static part of the coding prompt
+        self.prefix_tokens = None   # The prompt prefix tokenized, BOS included
+        self.grammar = None         # LlamaGrammar of the response format (None when unconstrained)
+        self.prefilter = None       # prefilter.TfidfPrefilter
+        self.fewshot_index = None   # fewshot.FewShotIndex
+
+    @property
+    def prompt_version(self):
+        """
+        Short hash of the taxonomy version and the prompt prefix, used in the
+        result cache key. Changes with any taxonomy edit, including those
+        that only affect the per-request few-shot selection, and with the
+        prompt settings.
+        """
+        payload = f"{self.version}\x00{self.prompt_prefix}"
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+class TaxonomyWatcher:
+    """
+    Background thread calling a function every few seconds, used to
+    poll the taxonomy revision and reload the taxonomy when it changed.
+    """
+    def __init__(self, interval, check):
+        """
+        Args:
+            interval: Seconds between calls
+            check: Function to call; exceptions are printed and the thread carries on
+        """
+        self.interval = interval
+        self._check = check
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self._check()
+            except Exception as e:
+                print(f"Taxonomy check failed: {e}")
+
+    def reset_after_fork(self):
+        """Start a new thread in a forked child process, where the parent's thread doesn't exist."""
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
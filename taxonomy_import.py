@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+"""
+Bulk, idempotent import of COM-B categories, indicators and coding examples.
+
+Rows are read from CSV or JSONL files one at a time and upserted by their
+natural key, so importing the same file twice changes nothing:
+
+    category   name                                   (description is updated)
+    indicator  category, type (positive/negative), text
+    example    category, text                         (explanation is updated)
+
+Each row names its kind in a "kind" column or field, or all rows of a file
+take the kind given with --kind. A category must exist or be defined
+earlier in the file before its indicators and examples. Inserts and
+updates are sent to the database in batches and the whole import is one
+transaction, so a file with an invalid row changes nothing.
+
+    python taxonomy_import.py examples.csv [more files] [--kind example] [--database comb_analyzer.db] [--dry-run]
+
+Running servers pick the changes up within taxonomy_poll_interval seconds
+(see config.py), or right away after POST /admin/taxonomy/reload.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from sqlalchemy import and_, bindparam, insert, select, update
+from db_setup import COMBCategory, Indicator, CodingExample
+
+# Rows sent to the database per INSERT or UPDATE batch
+BATCH_SIZE = 1000
+
+KINDS = ('category', 'indicator', 'example')
+INDICATOR_TYPES = ('positive', 'negative')
+
+def read_rows(path, source_format=None):
+    """
+    Stream the records of a CSV or JSONL file.
+
+    Args:
+        path: The file; the format defaults to its extension
+        source_format: 'csv' or 'jsonl'
+
+    Yields:
+        (line_number, record) tuples, record being a dictionary
+
+    Raises:
+        ValueError: If the file cannot be parsed
+    """
+    if source_format is None:
+        extension = os.path.splitext(path)[1].lower()
+        source_format = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}.get(extension)
+    if source_format == 'csv':
+        # utf-8-sig drops the byte order mark spreadsheet programs put in front of CSV exports
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            reader = csv.DictReader(f)
+            for record in reader:
+                yield reader.line_num, record
+    elif source_format == 'jsonl':
+        with open(path, encoding='utf-8') as f:
+            for line_number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    raise ValueError(f"Invalid JSON on line {line_number}")
+                if not isinstance(record, dict):
+                    raise ValueError(f"Line {line_number} is not a JSON object")
+                yield line_number, record
+    else:
+        raise ValueError(f"Unsupported taxonomy file format: {source_format or path}")
+
+def _field(record, *names):
+    """The stripped value of the first of the named fields present in a record ('' if none is)."""
+    for name in names:
+        value = record.get(name)
+        if value is not None:
+            return str(value).strip()
+    return ''
+
+class TaxonomyImporter:
+    """
+    Classifies rows against the taxonomy already stored and writes the
+    differences in batches.
+
+    The natural keys of all stored categories, indicators and examples are
+    loaded up front (a few thousand rows take milliseconds), so deciding
+    whether a row is new, changed or unchanged needs no query per row.
+    """
+    def __init__(self, session):
+        """
+        Args:
+            session: Session whose transaction the import runs in; the
+                caller commits or rolls back
+        """
+        self.connection = session.connection()
+        self.categories = {
+            name: {'id': category_id, 'description': description}
+            for category_id, name, description in self.connection.execute(
+                select(COMBCategory.id, COMBCategory.name, COMBCategory.description))
+        }
+        self.indicators = set(self.connection.execute(
+            select(Indicator.category_id, Indicator.indicator_type, Indicator.text)))
+        self.examples = {
+            (category_id, text): explanation
+            for category_id, text, explanation in self.connection.execute(
+                select(CodingExample.category_id, CodingExample.text, CodingExample.explanation))
+        }
+        self.counts = {kind: {'inserted': 0, 'updated': 0, 'unchanged': 0} for kind in KINDS}
+        self._new_indicators = []
+        self._new_examples = []
+        self._changed_examples = []
+
+    def add(self, record, line_number=None, default_kind=None):
+        """
+        Upsert one row.
+
+        Raises:
+            ValueError: If the row is invalid
+        """
+        where = f" on line {line_number}" if line_number is not None else ""
+        kind = _field(record, 'kind').lower() or default_kind
+        if kind not in KINDS:
+            raise ValueError(f"Row{where} needs a kind ({', '.join(KINDS)})")
+        name = _field(record, 'category')
+        if not name:
+            raise ValueError(f"Row{where} has no category")
+
+        if kind == 'category':
+            self._add_category(name, _field(record, 'description'), where)
+            return
+
+        category = self.categories.get(name)
+        if category is None:
+            raise ValueError(f"Unknown category '{name}'{where}; define it first")
+        text = _field(record, 'text')
+        if not text:
+            raise ValueError(f"Row{where} has no text")
+
+        if kind == 'indicator':
+            indicator_type = _field(record, 'type', 'indicator_type').lower()
+            if indicator_type not in INDICATOR_TYPES:
+                raise ValueError(f"Indicator{where} needs a type (positive or negative)")
+            key = (category['id'], indicator_type, text)
+            if key in self.indicators:
+                self.counts['indicator']['unchanged'] += 1
+                return
+            self.indicators.add(key)
+            self._new_indicators.append({'category_id': key[0], 'indicator_type': indicator_type, 'text': text})
+            self.counts['indicator']['inserted'] += 1
+        else:
+            explanation = _field(record, 'explanation') or None
+            key = (category['id'], text)
+            if key not in self.examples:
+                self._new_examples.append({'category_id': key[0], 'text': text, 'explanation': explanation})
+                self.counts['example']['inserted'] += 1
+            elif self.examples[key] != explanation:
+                self._changed_examples.append({'key_category_id': key[0], 'key_text': text,
+                                               'explanation': explanation})
+                self.counts['example']['updated'] += 1
+            else:
+                self.counts['example']['unchanged'] += 1
+                return
+            self.examples[key] = explanation
+
+        if max(len(self._new_indicators), len(self._new_examples), len(self._changed_examples)) >= BATCH_SIZE:
+            self.flush()
+
+    def _add_category(self, name, description, where):
+        """Insert or update a category right away, since later rows need its id."""
+        if not description:
+            raise ValueError(f"Category{where} has no description")
+        category = self.categories.get(name)
+        if category is None:
+            result = self.connection.execute(insert(COMBCategory).values(name=name, description=description))
+            self.categories[name] = {'id': result.inserted_primary_key[0], 'description': description}
+            self.counts['category']['inserted'] += 1
+        elif category['description'] != description:
+            self.connection.execute(
+                update(COMBCategory).where(COMBCategory.id == category['id']).values(description=description))
+            category['description'] = description
+            self.counts['category']['updated'] += 1
+        else:
+            self.counts['category']['unchanged'] += 1
+
+    def flush(self):
+        """Write the pending inserts and updates, each as one executemany batch."""
+        if self._new_indicators:
+            self.connection.execute(insert(Indicator), self._new_indicators)
+            self._new_indicators = []
+        if self._new_examples:
+            self.connection.execute(insert(CodingExample), self._new_examples)
+            self._new_examples = []
+        if self._changed_examples:
+            # Examples are matched by their natural key, so rows inserted by
+            # this import can be updated without knowing their ids
+            self.connection.execute(
+                update(CodingExample)
+                .where(and_(CodingExample.category_id == bindparam('key_category_id'),
+                            CodingExample.text == bindparam('key_text')))
+                .values(explanation=bindparam('explanation')),
+                self._changed_examples
+            )
+            self._changed_examples = []
+
+def import_taxonomy(session, records, default_kind=None):
+    """
+    Upsert taxonomy rows within the session's transaction, without committing.
+
+    Args:
+        session: A Session
+        records: Iterable of row dictionaries, or of (line_number, row) tuples
+            as yielded by read_rows()
+        default_kind: Kind of the rows that don't name one
+
+    Returns:
+        The number of rows inserted, updated and unchanged per kind
+
+    Raises:
+        ValueError: If a row is invalid
+    """
+    importer = TaxonomyImporter(session)
+    for record in records:
+        line_number = None
+        if isinstance(record, tuple):
+            line_number, record = record
+        importer.add(record, line_number, default_kind)
+    importer.flush()
+    return importer.counts
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import COM-B categories, indicators and examples.")
+    parser.add_argument('files', nargs='+', help="CSV or JSONL files, imported in order")
+    parser.add_argument('--format', choices=['csv', 'jsonl'], help="File format (defaults to the extension)")
+    parser.add_argument('--kind', choices=KINDS, help="Kind of the rows without a 'kind' column")
+    parser.add_argument('--database', default='comb_analyzer.db', help="SQLite database to import into")
+    parser.add_argument('--dry-run', action='store_true', help="Report the changes without saving them")
+    args = parser.parse_args()
+
+    from db_setup import create_session_factory
+    session = create_session_factory(f'sqlite:///{args.database}')()
+    start_time = time.perf_counter()
+    try:
+        counts = None
+        for path in args.files:
+            file_counts = import_taxonomy(session, read_rows(path, args.format), args.kind)
+            if counts is None:
+                counts = file_counts
+            else:
+                for kind in KINDS:
+                    for outcome, count in file_counts[kind].items():
+                        counts[kind][outcome] += count
+        if args.dry_run:
+            session.rollback()
+        else:
+            session.commit()
+    except (ValueError, OSError, UnicodeDecodeError) as e:
+        session.rollback()
+        sys.exit(f"Import failed, nothing was changed: {e}")
+    finally:
+        session.close()
+
+    elapsed = time.perf_counter() - start_time
+    print(f"{'Kind':<11}{'Inserted':>10}{'Updated':>10}{'Unchanged':>11}")
+    for kind in KINDS:
+        row = counts[kind]
+        print(f"{kind:<11}{row['inserted']:>10}{row['updated']:>10}{row['unchanged']:>11}")
+    rows = sum(sum(row.values()) for row in counts.values())
+    print(f"{rows} rows in {elapsed:.2f} seconds" + (" (dry run, nothing saved)" if args.dry_run else ""))
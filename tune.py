@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""
+Find the fastest stable llama inference settings for this machine.
+
+Sweeps the decode and prompt-evaluation thread counts and n_batch over a
+fixed sample of coding examples from the database, then writes the fastest
+configuration whose timings are stable to comb_config.json (or $COMB_CONFIG).
+
+Usage: python tune.py [--samples 8] [--repeats 3] [--dry-run]
+"""
+import argparse
+import multiprocessing
+import os
+import statistics
+import time
+from db_setup import setup_database, CodingExample
+from config import load_inference_config, save_inference_config
+
+# Runs whose timings vary more than this (coefficient of variation) are not trusted
+MAX_VARIATION = 0.15
+
+def candidate_thread_counts(cpu_count):
+    """Thread counts worth trying: powers of two up to the core count, plus the core count itself."""
+    counts = set()
+    n = 1
+    while n <= cpu_count:
+        counts.add(n)
+        n *= 2
+    counts.add(cpu_count)
+    # Hyper-threaded hosts often decode fastest on the physical cores only
+    if cpu_count >= 4:
+        counts.add(cpu_count // 2)
+    return sorted(counts)
+
+def load_sample_texts(session, samples):
+    """Load a fixed, reproducible sample of coding example texts."""
+    examples = session.query(CodingExample).order_by(CodingExample.id).limit(samples).all()
+    return [example.text for example in examples]
+
+def time_configuration(handler, texts, repeats):
+    """
+    Time the analysis of the sample texts.
+
+    The completion is generated without storing results, so tuning doesn't
+    touch the result cache or the analysis history.
+
+    Returns:
+        The total time of each repeat, in seconds
+    """
+    timings = []
+    for _ in range(repeats):
+        start_time = time.time()
+        for text in texts:
+            for _ in handler._stream_completion(handler._create_coding_prompt(text)):
+                pass
+        timings.append(time.time() - start_time)
+    return timings
+
+def tune(model_path, samples=8, repeats=3, max_tokens=None):
+    """
+    Sweep thread counts and n_batch and return the fastest stable configuration.
+
+    Args:
+        model_path: Path to the GGUF model file
+        samples: Number of coding examples to analyze per run
+        repeats: Number of timed runs per configuration
+        max_tokens: Cap on generated tokens while tuning (defaults to the configured value)
+
+    Returns:
+        The best configuration dictionary, or None if no run was stable
+    """
+    # Imported here so --help works without llama-cpp-python installed
+    from model_handler import LlamaModelHandler
+
+    base_config = load_inference_config()
+
+    session = setup_database()
+    texts = load_sample_texts(session, samples)
+    if not texts:
+        raise RuntimeError("No coding examples in the database; run populate_comb_data.py first")
+
+    cpu_count = multiprocessing.cpu_count() or 1
+    thread_counts = candidate_thread_counts(cpu_count)
+    batch_sizes = [128, 256, 512, 1024]
+
+    print(f"Tuning on {len(texts)} examples, {repeats} runs each, {cpu_count} CPUs")
+    results = []
+    for n_batch in batch_sizes:
+        # n_batch is fixed when the context is created, so reload for each value
+        config = dict(base_config, n_batch=n_batch)
+        handler = LlamaModelHandler(model_path, db_session=session, **config)
+        if max_tokens:
+            handler.max_tokens = max_tokens
+        # The samples are the pre-classifier's own training examples, so it would answer them
+        handler.prefilter_threshold = 0
+        handler.warm_up()
+
+        for n_threads in thread_counts:
+            for n_threads_batch in thread_counts:
+                # Prompt evaluation never benefits from fewer threads than decoding
+                if n_threads_batch < n_threads:
+                    continue
+                handler.set_threads(n_threads, n_threads_batch)
+                try:
+                    timings = time_configuration(handler, texts, repeats)
+                except Exception as e:
+                    print(f"n_batch={n_batch} n_threads={n_threads} "
+                          f"n_threads_batch={n_threads_batch}: failed ({str(e)})")
+                    continue
+
+                mean = statistics.mean(timings)
+                variation = statistics.pstdev(timings) / mean if mean > 0 else 0.0
+                stable = variation <= MAX_VARIATION
+                print(f"n_batch={n_batch} n_threads={n_threads} n_threads_batch={n_threads_batch}: "
+                      f"{mean:.2f}s per run (variation {variation:.1%}){'' if stable else ' unstable'}")
+                if stable:
+                    results.append((mean, dict(config, n_threads=n_threads,
+                                               n_threads_batch=n_threads_batch)))
+
+        # Release the model before loading the next one
+        handler.close()
+        del handler
+
+    if not results:
+        return None
+    results.sort(key=lambda result: result[0])
+    return results[0][1]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tune llama inference settings for this machine.")
+    parser.add_argument('--model', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                        "Llama-3.2-3B-Instruct-Q8_0.gguf"),
+                        help="Path to the GGUF model file")
+    parser.add_argument('--samples', type=int, default=8, help="Coding examples analyzed per run")
+    parser.add_argument('--repeats', type=int, default=3, help="Timed runs per configuration")
+    parser.add_argument('--max-tokens', type=int, default=None,
+                        help="Cap on generated tokens while tuning, to shorten the sweep")
+    parser.add_argument('--dry-run', action='store_true', help="Print the result without saving it")
+    args = parser.parse_args()
+
+    best = tune(args.model, samples=args.samples, repeats=args.repeats, max_tokens=args.max_tokens)
+    if best is None:
+        print("No stable configuration found; the configuration file was not changed.")
+    elif args.dry_run:
+        print(f"Fastest stable configuration: {best}")
+    else:
+        save_inference_config(best)
+        print(f"Saved fastest stable configuration: {best}")
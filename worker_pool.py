@@ -0,0 +1,581 @@
+# worker_pool.py
+
+import copy
+import hashlib
+import math
+import multiprocessing
+import queue
+import threading
+import time
+import uuid
+import metrics
+from result_cache import normalize_text
+from single_flight import SingleFlight, coalesce_stream
+
+# Seconds between checks for worker processes that died
+CHECK_INTERVAL = 1.0
+# A worker that dies before its model is loaded is restarted after 2, 4, 8...
+# seconds (at most MAX_RESTART_DELAY), and given up on after MAX_START_ATTEMPTS tries
+RESTART_BACKOFF = 2.0
+MAX_RESTART_DELAY = 60.0
+MAX_START_ATTEMPTS = 5
+
+class PoolFullError(Exception):
+    """Raised when the request queue is full and a request cannot be admitted."""
+    def __init__(self, retry_after):
+        super().__init__("The analysis queue is full")
+        self.retry_after = retry_after
+
+def _worker_main(worker_id, model_path, inference_config, task_queue, event_queue, taxonomy_generation):
+    """
+    Entry point of a model worker process.
+
+    Loads its own LlamaModelHandler (and database session) and processes
+    tasks from the shared task queue until it receives None. Tasks whose
+    deadline passed while they were queued are skipped. The taxonomy
+    is reloaded before the next task whenever the pool's taxonomy_generation
+    counter was increased.
+    """
+    # Imported here so the parent process never loads the model
+    from model_handler import LlamaModelHandler
+
+    # Metrics are recorded by the pool in the serving process
+    try:
+        handler = LlamaModelHandler(model_path, record_metrics=False, **inference_config)
+        handler.warm_up()
+    except Exception as e:
+        # Reported so the pool can show why the worker didn't start
+        event_queue.put(("failed", None, worker_id, f"{type(e).__name__}: {e}"))
+        return
+    event_queue.put(("ready", None, worker_id, None))
+    reloaded_generation = taxonomy_generation.value
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+
+        if taxonomy_generation.value != reloaded_generation:
+            reloaded_generation = taxonomy_generation.value
+            try:
+                handler.reload_taxonomy()
+            except Exception as e:
+                print(f"Model worker {worker_id} could not reload the taxonomy: {e}")
+
+        request_id, kind, text, use_cache, stream, deadline = task
+        if time.time() >= deadline:
+            # The request timed out while queued; nobody waits for its result anymore
+            event_queue.put(("result", request_id, worker_id, ({"error": "Request timed out in the queue"}, None)))
+            continue
+        event_queue.put(("started", request_id, worker_id, None))
+        # The trace travels back with the result
+        trace = {}
+        try:
+            if kind == "document":
+                # The windows of a document are analyzed by this worker's handler
+                results = handler.code_document(text, use_cache=use_cache, trace=trace)
+                event_queue.put(("result", request_id, worker_id, (results, trace)))
+                continue
+            for event, payload in handler.stream_code_text(text, use_cache=use_cache, trace=trace):
+                if event == "result":
+                    event_queue.put((event, request_id, worker_id, (payload, trace)))
+                elif stream:
+                    event_queue.put((event, request_id, worker_id, payload))
+        except Exception as e:
+            event_queue.put(("result", request_id, worker_id,
+                             ({"error": f"Error analyzing text: {str(e)}"}, trace)))
+
+    # Processes started by multiprocessing skip atexit handlers, so flush explicitly
+    handler.close()
+
+class ModelWorkerPool:
+    """
+    Pool of model worker processes behind a bounded request queue.
+
+    Each worker process owns a LlamaModelHandler with its own thread budget.
+    Requests beyond the worker count wait in the queue; once the queue is
+    full, new requests are rejected with PoolFullError so callers can shed
+    load instead of piling up. The pool exposes the same code_text and
+    stream_code_text methods as LlamaModelHandler, and code_document,
+    which analyzes all windows of a document on one worker.
+
+    Unless coalesce_requests is turned off in the inference config, a
+    request identical to one in progress joins it instead of taking a
+    queue slot, as LlamaModelHandler.stream_code_text does.
+
+    Dead workers are noticed within CHECK_INTERVAL seconds: the request
+    they were processing fails and the worker is restarted. Workers that
+    can't load the model are retried with a growing delay and eventually
+    given up on (see stats() and failed()).
+    """
+    def __init__(self, model_path, num_workers, queue_size=16, threads_per_worker=None,
+                 inference_config=None, request_timeout=600):
+        """
+        Start the worker processes.
+
+        Args:
+            model_path: Path to the GGUF model file
+            num_workers: Number of model worker processes
+            queue_size: Number of requests allowed to wait for a free worker
+            threads_per_worker: CPU threads per worker (defaults to an even share of the cores)
+            inference_config: Keyword arguments for each worker's LlamaModelHandler;
+                the thread counts are replaced by threads_per_worker
+            request_timeout: Seconds a request may take, queueing included,
+                before it fails with an error
+        """
+        self.model_path = model_path
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+        self.request_timeout = request_timeout
+        if threads_per_worker is None:
+            threads_per_worker = max(1, (multiprocessing.cpu_count() or 1) // num_workers)
+        self.threads_per_worker = threads_per_worker
+        self.inference_config = dict(inference_config or {})
+        self.inference_config['n_threads'] = threads_per_worker
+        self.inference_config['n_threads_batch'] = threads_per_worker
+
+        # Spawn rather than fork so workers don't inherit the server's threads
+        self._mp = multiprocessing.get_context("spawn")
+        self._task_queue = self._mp.Queue()
+        self._event_queue = self._mp.Queue()
+        # Increased to make every worker reload the taxonomy, see reload_taxonomy()
+        self._taxonomy_generation = self._mp.Value('i', 0)
+
+        self._lock = threading.Lock()
+        self._pending = {}          # request_id -> queue.Queue of events, None once the caller gave up
+        self._assigned = {}         # worker_id -> request_id being processed
+        self._busy_since = {}       # worker_id -> start time of the current request
+        self._busy_seconds = [0.0] * num_workers
+        self._completed = [0] * num_workers
+        self._ready = [False] * num_workers
+        self._start_failures = [0] * num_workers  # Consecutive deaths before the model was loaded
+        self._restart_at = [None] * num_workers   # Monotonic time a dead worker is due to be restarted
+        self._failed = [False] * num_workers      # Given up after MAX_START_ATTEMPTS
+        self._errors = [None] * num_workers       # Why the worker last failed to start
+        self._avg_service_time = None
+        self._started_at = time.time()
+
+        # Requests in progress, joined by identical requests arriving meanwhile
+        self.coalesce_requests = self.inference_config.get('coalesce_requests', True)
+        self._in_flight = SingleFlight()
+        # Rows of the joined requests' results are written here, see _store_copy()
+        self._store_lock = threading.Lock()
+        self._session_factory = None
+        self._result_writer = None
+        self._stored_taxonomy = None
+
+        self._workers = [self._start_worker(worker_id) for worker_id in range(num_workers)]
+
+        self._collector = threading.Thread(target=self._collect_events, daemon=True)
+        self._collector.start()
+
+    def _start_worker(self, worker_id):
+        """Start (or restart) the process for a worker slot."""
+        process = self._mp.Process(
+            target=_worker_main,
+            args=(worker_id, self.model_path, self.inference_config,
+                  self._task_queue, self._event_queue, self._taxonomy_generation),
+            daemon=True
+        )
+        process.start()
+        return process
+
+    def _admit(self, text, use_cache, stream, kind="text"):
+        """
+        Queue a request if there is room.
+
+        Returns:
+            The request ID, the queue its events will be delivered to and
+            the monotonic deadline of the request
+
+        Raises:
+            PoolFullError: If the request queue is full
+            RuntimeError: If no worker could load the model
+        """
+        if self.failed():
+            raise RuntimeError("No model worker could load the model")
+        with self._lock:
+            if len(self._pending) >= self.num_workers + self.queue_size:
+                raise PoolFullError(self._retry_after())
+            request_id = str(uuid.uuid4())
+            events = queue.Queue()
+            self._pending[request_id] = events
+
+        # Workers skip the task if it is still queued past its deadline (wall clock, shared with them)
+        self._task_queue.put((request_id, kind, text, use_cache, stream, time.time() + self.request_timeout))
+        return request_id, events, time.monotonic() + self.request_timeout
+
+    def _next_event(self, request_id, events, deadline):
+        """
+        Wait for the next event of a request, or fail it once its deadline has passed.
+
+        A request that timed out keeps its slot until a worker finished or
+        skipped its task, so the admission limit counts the work really left.
+        """
+        try:
+            return events.get(timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Empty:
+            with self._lock:
+                if request_id in self._pending:
+                    self._pending[request_id] = None
+            return "result", ({"error": f"No result from the model workers within {self.request_timeout} seconds"},
+                              None)
+
+    def _retry_after(self):
+        """Estimate how many seconds until a queue slot frees up. Called with the lock held."""
+        if self._avg_service_time is None:
+            return 1
+        waiting = max(0, len(self._pending) - self.num_workers)
+        return max(1, math.ceil(self._avg_service_time * (waiting + 1) / self.num_workers))
+
+    def code_text(self, text, use_cache=True, trace=None):
+        """
+        Code a piece of text on the next free worker.
+
+        Raises:
+            PoolFullError: If the request queue is full
+        """
+        results = None
+        for event, results in self._analyze("text", text, use_cache, trace, stream=False):
+            pass
+        return results
+
+    def stream_code_text(self, text, use_cache=True, trace=None):
+        """
+        Code a piece of text on the next free worker, relaying generated text.
+
+        Raises:
+            PoolFullError: If the request queue is full (before the first event)
+        """
+        yield from self._analyze("text", text, use_cache, trace, stream=True)
+
+    def code_document(self, text, use_cache=True, trace=None):
+        """
+        Code a long transcript in windows on the next free worker.
+
+        Raises:
+            PoolFullError: If the request queue is full
+        """
+        results = None
+        for event, results in self._analyze("document", text, use_cache, trace, stream=False):
+            pass
+        return results
+
+    def _analyze(self, kind, text, use_cache, trace, stream):
+        """
+        Run a request, or join an identical one in progress, yielding its events.
+
+        Requests of the same kind for the same normalized text and cache
+        setting share one worker task while it runs, unless the taxonomy
+        reload requested in between; the requests that join it get only the
+        ("result", results) event, a copy under their own session ID with
+        tier and cache set to "coalesced".
+        """
+        if not self.coalesce_requests:
+            yield from self._dispatch(kind, text, use_cache, trace, stream)
+            return
+
+        digest = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+        key = (kind, digest, use_cache, self._taxonomy_generation.value)
+        wait_start = time.perf_counter()
+        events = coalesce_stream(self._in_flight, key,
+                                 lambda: self._dispatch(kind, text, use_cache, trace, stream),
+                                 context=text, on_shared=self._count_shared)
+        try:
+            for event, payload in events:
+                if event == "joined":
+                    leader_text, shared = payload
+                    yield "result", self._join_results(text, leader_text, shared, trace,
+                                                       time.perf_counter() - wait_start)
+                else:
+                    yield event, payload
+        finally:
+            # Lets a leader finish the request for its followers when the caller stops reading
+            events.close()
+
+    def _dispatch(self, kind, text, use_cache, trace, stream):
+        """Run a request on the next free worker, yielding its events."""
+        request_id, events, deadline = self._admit(text, use_cache, stream, kind=kind)
+        while True:
+            event, payload = self._next_event(request_id, events, deadline)
+            if event == "result":
+                results, worker_trace = payload
+                self._finish_request(results, worker_trace, trace)
+                yield event, results
+                return
+            yield event, payload
+
+    @staticmethod
+    def _count_shared(followers):
+        """Count a request whose results were shared with followers."""
+        metrics.COALESCED_ANALYSES.labels(role="leader").inc()
+
+    def _join_results(self, text, leader_text, shared, trace, wait):
+        """
+        Results of an identical request that ran, for a request that waited for it.
+
+        Args:
+            text: The text of this request
+            leader_text: The text the analysis was run on, equal to text once normalized
+            shared: The analysis results, not to be modified
+            trace: The caller's trace dictionary, if any
+            wait: Seconds spent waiting for the analysis
+
+        Returns:
+            A copy of the results with its own session ID
+        """
+        results = copy.deepcopy(shared)
+        if "error" not in results:
+            session_id = str(uuid.uuid4())
+            # Span offsets only apply to the very text they were computed on
+            spans = results.get("spans") if text == leader_text else None
+            self._store_copy(text, results, session_id, spans)
+            results["session_id"] = session_id
+            results["tier"] = "coalesced"
+        results["cache"] = "coalesced"
+        metrics.COALESCED_ANALYSES.labels(role="follower").inc()
+        self._finish_request(results, {"phases": {"coalesce_wait": wait}}, trace)
+        return results
+
+    def _store_copy(self, text, results, session_id, spans):
+        """
+        Store the results of a request that joined another one.
+
+        Workers only store the analyses they ran, so the copy is written
+        from this process, the way code_corpus stores its workers' results.
+        """
+        # Imported here so the pool can be created without loading the handler's dependencies
+        from db_setup import create_session_factory
+        from db_writer import BatchWriter
+        from model_handler import build_result_write
+        from taxonomy import TaxonomySnapshot, load_taxonomy
+
+        with self._store_lock:
+            if self._result_writer is None:
+                self._session_factory = create_session_factory()
+                self._result_writer = BatchWriter(self._session_factory)
+            taxonomy = self._stored_taxonomy
+            if taxonomy is None or taxonomy.version != results.get("taxonomy_version"):
+                session = self._session_factory()
+                try:
+                    taxonomy = self._stored_taxonomy = TaxonomySnapshot(*load_taxonomy(session))
+                finally:
+                    session.close()
+        if taxonomy.version != results.get("taxonomy_version"):
+            # The taxonomy changed again since the analysis; its category IDs are gone
+            print(f"Not storing coalesced results of taxonomy {results.get('taxonomy_version')}, "
+                  f"the database has {taxonomy.version}")
+            return
+        write = build_result_write(text, results, session_id, taxonomy, spans=spans)
+        if write is not None:
+            self._result_writer.submit(write)
+
+    @staticmethod
+    def _finish_request(results, worker_trace, trace):
+        """Record the metrics of a finished request and hand its trace to the caller."""
+        metrics.record_analysis(worker_trace, results)
+        if trace is not None:
+            trace.clear()
+            trace.update(worker_trace or {})
+
+    def reload_taxonomy(self):
+        """
+        Make every worker reload the taxonomy before its next analysis.
+
+        Workers also pick up taxonomy changes on their own, every
+        taxonomy_poll_interval seconds.
+
+        Returns:
+            A dictionary saying the reload was requested from the workers
+        """
+        with self._taxonomy_generation.get_lock():
+            self._taxonomy_generation.value += 1
+        return {"requested": True, "workers": self.num_workers}
+
+    def queue_depth(self):
+        """Number of requests waiting for a free worker."""
+        with self._lock:
+            return max(0, len(self._pending) - len(self._busy_since))
+
+    def _collect_events(self):
+        """Route events from the workers to waiting requests and restart dead workers."""
+        next_check = time.monotonic() + CHECK_INTERVAL
+        while True:
+            try:
+                event, request_id, worker_id, payload = self._event_queue.get(timeout=CHECK_INTERVAL)
+            except queue.Empty:
+                event = None
+            # Checked on a timer, since busy workers may keep the queue from ever going quiet
+            if time.monotonic() >= next_check:
+                self._check_workers()
+                next_check = time.monotonic() + CHECK_INTERVAL
+            if event is None:
+                continue
+
+            now = time.time()
+            with self._lock:
+                if event == "ready":
+                    self._ready[worker_id] = True
+                    self._start_failures[worker_id] = 0
+                    self._errors[worker_id] = None
+                    print(f"Model worker {worker_id} ready")
+                    continue
+                if event == "failed":
+                    self._errors[worker_id] = payload
+                    print(f"Model worker {worker_id} could not load the model: {payload}")
+                    continue
+                if event == "started":
+                    self._assigned[worker_id] = request_id
+                    self._busy_since[worker_id] = now
+                    continue
+                if event == "result":
+                    self._finish(worker_id, now)
+                    events = self._pending.pop(request_id, None)
+                else:
+                    events = self._pending.get(request_id)
+
+            if events is not None:
+                events.put((event, payload))
+
+    def _finish(self, worker_id, now):
+        """Record a finished request for the worker. Called with the lock held."""
+        self._assigned.pop(worker_id, None)
+        started = self._busy_since.pop(worker_id, None)
+        if started is None:
+            return
+        elapsed = now - started
+        self._busy_seconds[worker_id] += elapsed
+        self._completed[worker_id] += 1
+        if self._avg_service_time is None:
+            self._avg_service_time = elapsed
+        else:
+            self._avg_service_time = 0.9 * self._avg_service_time + 0.1 * elapsed
+
+    def _check_workers(self):
+        """
+        Fail the request of any worker that died and restart it.
+
+        A worker that died while serving is restarted right away. One that
+        died before loading its model is restarted with a growing delay, so
+        a broken model file isn't reloaded every second, and given up on
+        after MAX_START_ATTEMPTS tries. Once every worker is given up on,
+        the waiting requests fail.
+        """
+        now = time.monotonic()
+        for worker_id, process in enumerate(self._workers):
+            if process is None:
+                # Waiting for its restart, or given up on
+                if self._restart_at[worker_id] is not None and now >= self._restart_at[worker_id]:
+                    self._restart_at[worker_id] = None
+                    self._workers[worker_id] = self._start_worker(worker_id)
+                continue
+            if process.is_alive():
+                continue
+            with self._lock:
+                request_id = self._assigned.get(worker_id)
+                self._finish(worker_id, time.time())
+                loaded = self._ready[worker_id]
+                self._ready[worker_id] = False
+                events = self._pending.pop(request_id, None) if request_id else None
+            if events is not None:
+                events.put(("result", ({"error": "Model worker crashed while analyzing text"}, None)))
+
+            if loaded:
+                print(f"Model worker {worker_id} exited with code {process.exitcode}, restarting")
+                self._workers[worker_id] = self._start_worker(worker_id)
+                continue
+            self._workers[worker_id] = None
+            self._start_failures[worker_id] += 1
+            failures = self._start_failures[worker_id]
+            if failures >= MAX_START_ATTEMPTS:
+                print(f"Model worker {worker_id} failed to start {failures} times, giving up")
+                self._failed[worker_id] = True
+            else:
+                delay = min(RESTART_BACKOFF * 2 ** (failures - 1), MAX_RESTART_DELAY)
+                print(f"Model worker {worker_id} failed to start (exit code {process.exitcode}), "
+                      f"retrying in {delay:.0f} seconds")
+                self._restart_at[worker_id] = now + delay
+
+        if self.failed():
+            with self._lock:
+                waiting = [events for events in self._pending.values() if events is not None]
+                self._pending.clear()
+            for events in waiting:
+                events.put(("result", ({"error": "No model worker could load the model"}, None)))
+
+    def failed(self):
+        """Whether every worker has been given up on, so no request can be served."""
+        return all(self._failed)
+
+    def failed_workers(self):
+        """
+        Workers that were given up on.
+
+        Returns:
+            A list of {"id", "error"} dictionaries
+        """
+        return [{'id': worker_id, 'error': self._errors[worker_id]}
+                for worker_id in range(self.num_workers) if self._failed[worker_id]]
+
+    def wait_until_ready(self, timeout=None):
+        """
+        Block until every worker has loaded and warmed up its model, or was given up on.
+
+        Returns:
+            True if at least one worker is ready and the others were given
+            up on or are ready too, False if none could load the model or
+            the timeout expired
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                ready = sum(self._ready)
+            if ready + sum(self._failed) == self.num_workers:
+                return ready > 0
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.1)
+
+    def stats(self):
+        """
+        Report queue depth and per-worker utilisation.
+
+        Returns:
+            A JSON-serializable dictionary
+        """
+        now = time.time()
+        uptime = now - self._started_at
+        with self._lock:
+            in_flight = len(self._pending)
+            busy = len(self._busy_since)
+            workers = []
+            for worker_id in range(self.num_workers):
+                busy_seconds = self._busy_seconds[worker_id]
+                if worker_id in self._busy_since:
+                    busy_seconds += now - self._busy_since[worker_id]
+                workers.append({
+                    'id': worker_id,
+                    'ready': self._ready[worker_id],
+                    'failed': self._failed[worker_id],
+                    'error': self._errors[worker_id],
+                    'busy': worker_id in self._busy_since,
+                    'completed': self._completed[worker_id],
+                    'utilisation': round(busy_seconds / uptime, 4) if uptime > 0 else 0.0
+                })
+            return {
+                'workers': workers,
+                'in_flight': in_flight,
+                'queue_depth': max(0, in_flight - busy),
+                'queue_capacity': self.queue_size,
+                'avg_service_time': self._avg_service_time
+            }
+
+    def shutdown(self):
+        """Stop all worker processes after their current request."""
+        for _ in self._workers:
+            self._task_queue.put(None)
+        for process in self._workers:
+            if process is not None:
+                process.join(timeout=30)
+        if self._result_writer is not None:
+            self._result_writer.close()